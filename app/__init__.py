@@ -25,6 +25,19 @@ def create_app(config_class=Config):
 
     # Importação dos Models
     from . import models 
+    # Registra os listeners que mantêm as tabelas monthly_rollups e invoice_snapshots
+    from . import rollup_service, invoice_service
+
+    from .dashboard_cache import DashboardCache
+    from .user_cache import UserCache
+    from .assets import Assets
+    from .avatar_service import AvatarService
+    DashboardCache.init_app(app)
+    UserCache.init_app(app)
+    # asset_url() nos templates + cache imutável dos arquivos com hash de static/dist
+    Assets.init_app(app)
+    # avatar_url() nos templates (miniaturas servidas por /avatars/<hash>/<variante>)
+    AvatarService.init_app(app)
 
     @app.context_processor
     def inject_version():
@@ -35,7 +48,8 @@ def create_app(config_class=Config):
     @login_manager.user_loader
     def load_user(user_id):
         if user_id is not None:
-            return models.User.query.get(int(user_id))
+            # Snapshot em cache (TTL curto, invalidado nas alterações de perfil/segurança)
+            return UserCache.load(int(user_id))
         return None
 
     # Registro dos Blueprints
@@ -47,10 +61,22 @@ def create_app(config_class=Config):
 
     from .settings_controller import settings_bp
     app.register_blueprint(settings_bp)
+
+    # Comandos de linha (flask jobs run / flask jobs invoice-snapshots)
+    from .scheduler import jobs_cli
+    app.cli.add_command(jobs_cli)
+
+    # flask email send / flask email status
+    from .email_outbox import email_cli
+    app.cli.add_command(email_cli)
+
+    # flask rollups rebuild [--user-id N] [--verify]
+    from .rollup_service import rollups_cli
+    app.cli.add_command(rollups_cli)
     
     @app.route('/health')
     def health_check():
-        return {'status': 'healthy', 'db': 'connected'}, 200
+        return {'status': 'healthy', 'db': 'connected', 'dashboard_cache': DashboardCache.get_stats()}, 200
 
     # --- CORREÇÃO DO ERRO 404 NA RAIZ ---
     @app.route('/')
@@ -0,0 +1,45 @@
+import os
+import json
+
+from flask import current_app, request, url_for
+
+# --- ASSETS DO FRONTEND (static/dist) ---
+# Gerados por assets/build.py com o hash do conteúdo no nome, então podem ser
+# servidos como imutáveis: um deploy com CSS novo muda a URL, nunca o arquivo.
+
+ONE_YEAR = 365 * 24 * 3600
+
+class Assets:
+    """Lê static/dist/manifest.json (nome lógico -> arquivo com hash) e o expõe aos templates."""
+
+    @staticmethod
+    def init_app(app):
+        manifest = {}
+        path = os.path.join(app.static_folder, 'dist', 'manifest.json')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        app.extensions['assets'] = manifest
+        app.jinja_env.globals['asset_url'] = Assets.url
+        app.after_request(Assets.add_cache_headers)
+
+    @staticmethod
+    def url(filename):
+        """
+        URL do arquivo com hash; None se o build não foi feito (ambiente local
+        sem `npm run build`), e o template cai no fallback via CDN.
+        """
+        hashed = current_app.extensions.get('assets', {}).get(filename)
+        return url_for('static', filename=hashed) if hashed else None
+
+    @staticmethod
+    def add_cache_headers(response):
+        if request.endpoint != 'static' or response.status_code not in (200, 304):
+            return response
+        filename = (request.view_args or {}).get('filename')
+        if filename in current_app.extensions.get('assets', {}).values():
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = ONE_YEAR
+            response.cache_control.immutable = True
+        return response
@@ -4,6 +4,8 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
 from app.models import User, Category, BankAccount
 from app.email_utils import send_email
+from app.dashboard_cache import invalidates_dashboard
+from app.user_cache import UserCache
 from datetime import date, datetime, timedelta
 import re
 import secrets
@@ -114,8 +116,10 @@ def login():
                 if user.two_factor_method == 'email':
                     try:
                         send_2fa_email(user)
+                        db.session.commit()
                         flash('Código de verificação enviado para seu e-mail.', 'info')
                     except Exception as e:
+                        db.session.rollback()
                         print(f"Erro ao enviar 2FA email: {e}")
                         flash('Erro ao enviar e-mail. Tente novamente.', 'danger')
 
@@ -214,8 +218,10 @@ def register():
                 subject="Bem-vindo! Confirme sua conta",
                 html_content=html_content
             )
+            db.session.commit()
             flash('Cadastro realizado! Verifique seu e-mail para ativar a conta.', 'info')
         except Exception as e:
+            db.session.rollback()
             print(f"Erro email: {e}")
             flash('Erro ao enviar e-mail de confirmação. Contate o suporte.', 'danger')
 
@@ -242,6 +248,7 @@ def confirm_email(token):
         user.is_verified = True
         user.welcome_seen = False
         db.session.add(user)
+        UserCache.invalidate(user.id)
         db.session.commit()
         flash('Sua conta foi confirmada! Você já pode fazer login.', 'success')
         
@@ -291,8 +298,10 @@ def resend_2fa_code():
     if user and user.two_factor_method == 'email':
         try:
             send_2fa_email(user)
+            db.session.commit()
             flash('Código reenviado com sucesso!', 'success')
         except Exception as e:
+            db.session.rollback()
             print(f"Erro reenvio: {e}")
             flash('Erro ao enviar e-mail.', 'danger')
     return redirect(url_for('auth.verify_2fa_login'))
@@ -306,7 +315,6 @@ def forgot_password():
             token = secrets.token_urlsafe(32)
             user.auth_token = token
             user.token_expiration = datetime.utcnow() + timedelta(hours=1)
-            db.session.commit()
             
             link = f"{get_base_url()}/reset-password/{token}"
             
@@ -324,7 +332,10 @@ def forgot_password():
                     subject="Recuperação de Senha",
                     html_content=html_content
                 )
+                # Token e e-mail na mesma transação
+                db.session.commit()
             except Exception as e:
+                db.session.rollback()
                 print(f"Erro email: {e}")
                 
         flash('Se o e-mail existir, as instruções foram enviadas.', 'info')
@@ -352,6 +363,7 @@ def reset_password(token):
         user.auth_token = None
         user.token_expiration = None
         user.is_verified = True
+        UserCache.invalidate(user.id)
         db.session.commit()
         flash('Senha alterada com sucesso!', 'success')
         return redirect(url_for('auth.login'))
@@ -363,6 +375,7 @@ def setup_2fa():
     method = request.form.get('method')
     if not current_user.two_factor_secret:
         current_user.two_factor_secret = pyotp.random_base32()
+        UserCache.invalidate(current_user.id)
         db.session.commit()
     resp = {'status': 'ok', 'method': method, 'secret': current_user.two_factor_secret}
     if method == 'app':
@@ -376,7 +389,9 @@ def setup_2fa():
     elif method == 'email':
         try:
             send_2fa_email(current_user, method='email')
+            db.session.commit()
         except Exception as e:
+            db.session.rollback()
             return jsonify({'status': 'error', 'message': 'Erro ao enviar e-mail.'}), 500
     return jsonify(resp)
 
@@ -393,6 +408,7 @@ def enable_2fa():
         totp = pyotp.TOTP(current_user.two_factor_secret)
     if totp.verify(code, valid_window=1):
         current_user.two_factor_method = method
+        UserCache.invalidate(current_user.id)
         db.session.commit()
         flash(f'Autenticação de Dois Fatores ({method.upper()}) ativada com sucesso!', 'success')
         resp = make_response(redirect(url_for('settings.index', tab='account')))
@@ -408,6 +424,7 @@ def enable_2fa():
 def disable_2fa():
     current_user.two_factor_method = None
     current_user.two_factor_secret = None
+    UserCache.invalidate(current_user.id)
     db.session.commit()
     resp = make_response(redirect(url_for('settings.index', tab='account')))
     resp.set_cookie('trusted_device', '', expires=0)
@@ -423,6 +440,7 @@ def logout():
 
 @auth_bp.route('/api/mark-welcome-seen', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def mark_welcome_seen():
     try:
         user = User.query.get(current_user.id)
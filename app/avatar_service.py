@@ -0,0 +1,200 @@
+import io
+import os
+import re
+import shutil
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request, url_for
+from werkzeug.utils import send_file
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app.models import User
+
+logger = logging.getLogger("avatar_service")
+
+# --- AVATARES ---
+# O upload original fica em uploads/avatars/<sha256>/source, endereçado pelo
+# conteúdo: o mesmo arquivo enviado duas vezes (ou por dois usuários) vira um
+# único diretório. As variantes (quadradas, em WebP e JPEG) são geradas fora da
+# requisição de upload, por um executor em segundo plano; se alguém pedir uma
+# variante antes de ela ficar pronta, a rota de serviço a gera na hora.
+
+AVATAR_PREFIX = 'avatars/'
+SIZES = (96, 256)   # 96: menu/barra (até 40px em telas 2x), 256: tela de perfil
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 82, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP'}
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+BACKGROUND = (51, 65, 85)  # slate-700, fundo das imagens com transparência no JPEG
+ONE_YEAR = 365 * 24 * 3600
+
+# Uma thread por processo basta: a codificação é curta e não deve disputar CPU com as requisições
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='avatar')
+render_locks = {}
+render_locks_guard = threading.Lock()
+
+class AvatarError(ValueError):
+    pass
+
+class AvatarService:
+
+    @staticmethod
+    def init_app(app):
+        app.jinja_env.globals['avatar_url'] = AvatarService.url
+
+    @staticmethod
+    def storage_root():
+        return os.path.join(current_app.root_path, 'static', 'uploads', 'avatars')
+
+    @staticmethod
+    def variant_name(size, ext):
+        return f'{size}.{ext}'
+
+    @staticmethod
+    def is_variant(variant):
+        size, _, ext = variant.partition('.')
+        return ext in FORMATS and size.isdigit() and int(size) in SIZES
+
+    @staticmethod
+    def store(data):
+        """
+        Valida a imagem (só lê o cabeçalho) e grava o original endereçado pelo
+        conteúdo. Retorna a chave (sha256 do arquivo).
+        """
+        if len(data) > current_app.config['AVATAR_MAX_BYTES']:
+            raise AvatarError('Imagem muito grande.')
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                if img.format not in ALLOWED_FORMATS:
+                    raise AvatarError('Formato de imagem não suportado.')
+                if img.width * img.height > current_app.config['AVATAR_MAX_PIXELS']:
+                    raise AvatarError('Resolução da imagem muito alta.')
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+            raise AvatarError('Arquivo de imagem inválido.')
+
+        key = hashlib.sha256(data).hexdigest()
+        folder = os.path.join(AvatarService.storage_root(), key)
+        source = os.path.join(folder, 'source')
+        if not os.path.exists(source):
+            os.makedirs(folder, exist_ok=True)
+            tmp = f'{source}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, source)
+        return key
+
+    @staticmethod
+    def save_upload(file):
+        """Grava o upload e agenda a geração das variantes. Retorna o valor para User.avatar_path."""
+        key = AvatarService.store(file.read())
+        executor.submit(AvatarService.render_all, AvatarService.storage_root(), key)
+        return AVATAR_PREFIX + key
+
+    @staticmethod
+    def render_all(root, key):
+        try:
+            for size in SIZES:
+                for ext in FORMATS:
+                    AvatarService.render(root, key, size, ext)
+        except Exception as e:
+            logger.error(f"Falha ao gerar as variantes do avatar {key}: {e}")
+
+    @staticmethod
+    def render(root, key, size, ext):
+        """Gera (se ainda não existir) uma variante e retorna o caminho dela."""
+        folder = os.path.join(root, key)
+        path = os.path.join(folder, AvatarService.variant_name(size, ext))
+        if os.path.exists(path):
+            return path
+
+        with render_locks_guard:
+            lock = render_locks.setdefault(key, threading.Lock())
+        with lock:
+            if os.path.exists(path):
+                return path
+            with Image.open(os.path.join(folder, 'source')) as img:
+                img.seek(0)  # GIF animado: primeiro quadro
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                    flat = Image.new('RGB', img.size, BACKGROUND)
+                    flat.paste(img, mask=img.getchannel('A'))
+                    img = flat
+                else:
+                    img = img.convert('RGB')
+                # Recorte quadrado centralizado (o avatar é exibido em círculo)
+                img = ImageOps.fit(img, (size, size), Image.LANCZOS)
+                fmt, _, options = FORMATS[ext]
+                tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                img.save(tmp, fmt, **options)
+                os.replace(tmp, path)
+        with render_locks_guard:
+            render_locks.pop(key, None)
+        return path
+
+    @staticmethod
+    def key_from_path(avatar_path):
+        if avatar_path and avatar_path.startswith(AVATAR_PREFIX):
+            return avatar_path[len(AVATAR_PREFIX):]
+        return None
+
+    @staticmethod
+    def url(user, size, ext='webp'):
+        """URL do avatar para os templates; avatares antigos (antes do pipeline) saem do static direto."""
+        if not user.avatar_path:
+            return None
+        key = AvatarService.key_from_path(user.avatar_path)
+        if key is None:
+            return url_for('static', filename='uploads/' + user.avatar_path)
+        return url_for('settings.serve_avatar', key=key, variant=AvatarService.variant_name(size, ext))
+
+    @staticmethod
+    def release(avatar_path, user_id):
+        """Apaga o avatar antigo do usuário, a menos que outro usuário use o mesmo arquivo."""
+        if not avatar_path:
+            return
+        key = AvatarService.key_from_path(avatar_path)
+        if key is None:
+            path = os.path.join(current_app.root_path, 'static', 'uploads', avatar_path)
+        else:
+            if User.query.filter(User.avatar_path == avatar_path, User.id != user_id).first():
+                return
+            path = os.path.join(AvatarService.storage_root(), key)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Erro ao deletar avatar antigo: {e}")
+
+    @staticmethod
+    def send(key, variant):
+        """
+        Resposta de uma variante: imutável (o conteúdo nunca muda para a mesma URL)
+        com ETag. Com AVATAR_SENDFILE, quem envia o arquivo é o servidor da frente
+        (X-Sendfile no Apache/lighttpd, X-Accel-Redirect no nginx).
+        """
+        size, _, ext = variant.partition('.')
+        path = AvatarService.render(AvatarService.storage_root(), key, int(size), ext)
+        mimetype = FORMATS[ext][1]
+        mode = current_app.config['AVATAR_SENDFILE']
+
+        if mode == 'x-accel':
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = f"{current_app.config['AVATAR_ACCEL_PREFIX'].rstrip('/')}/{key}/{variant}"
+            response.set_etag(f'{key}-{variant}')
+        else:
+            response = send_file(
+                path, request.environ, mimetype=mimetype, etag=f'{key}-{variant}', conditional=True,
+                max_age=ONE_YEAR, use_x_sendfile=(mode == 'x-sendfile'), response_class=current_app.response_class
+            )
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+        return response
@@ -0,0 +1,101 @@
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# --- BACKENDS DE CACHE ---
+# Usados pelo cache de respostas do dashboard e pelo cache do user_loader.
+
+class LRUBackend:
+    """Cache em memória do processo, limitado a max_entries (descarta o menos usado)."""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class FileSystemBackend:
+    """
+    Cache em disco, compartilhado entre os workers do Gunicorn do mesmo container.
+    Cada entrada é um arquivo; a gravação é atômica (arquivo temporário + rename).
+    """
+
+    def __init__(self, directory, max_entries=1024, ttl=300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.cache')
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at, stored_key, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires_at < time.time() or stored_key != key:
+            return None
+        return value
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + self.ttl, key, value), f)
+        os.replace(tmp_path, self.path_for(key))
+        self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.cache')]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def make_backend(kind, size, ttl, directory=None):
+    """'lru' (memória do worker), 'filesystem' (compartilhado entre workers) ou None para desligado."""
+    if kind == 'lru':
+        return LRUBackend(size, ttl)
+    if kind == 'filesystem':
+        return FileSystemBackend(directory, size, ttl)
+    return None
@@ -13,7 +13,56 @@ class Config:
     
     if DB_USER and DB_PASS and DB_HOST and DB_NAME:
         SQLALCHEMY_DATABASE_URI = f"mysql+mysqlconnector://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
+        # Pool de conexões por processo (worker). Com workers gthread, pool_size + max_overflow
+        # deve cobrir GUNICORN_THREADS; pre_ping/recycle evitam conexões derrubadas pelo MySQL.
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),   # segundos
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),     # segundos
+            'pool_pre_ping': True,
+        }
     else:
         SQLALCHEMY_DATABASE_URI = 'sqlite:///local_finance.db'
         
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Agendador em segundo plano (renovação de fixos de cartão)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    SCHEDULER_INTERVAL = int(os.environ.get('SCHEDULER_INTERVAL', 60))    # segundos entre verificações
+    SCHEDULER_LOCK_TTL = int(os.environ.get('SCHEDULER_LOCK_TTL', 300))   # validade do lease de líder
+
+    # Fila de e-mails (email_outbox): thread sender em cada worker, envio em lotes com backoff
+    EMAIL_SENDER_ENABLED = os.environ.get('EMAIL_SENDER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    EMAIL_POLL_INTERVAL = int(os.environ.get('EMAIL_POLL_INTERVAL', 5))    # segundos entre verificações da fila
+    EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', 20))         # e-mails por lote
+    EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 6))      # tentativas antes de marcar 'failed'
+    EMAIL_RETRY_BASE = int(os.environ.get('EMAIL_RETRY_BASE', 30))         # segundos; dobra a cada falha (máx. 1h)
+    EMAIL_CLAIM_LEASE = int(os.environ.get('EMAIL_CLAIM_LEASE', 300))      # segundos de reserva de um lote
+    EMAIL_OUTBOX_RETENTION = int(os.environ.get('EMAIL_OUTBOX_RETENTION', 7))  # dias mantendo os já enviados
+
+    # Avatares: limites do upload e envio das miniaturas ('none', 'x-sendfile' ou 'x-accel' para nginx)
+    AVATAR_MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', 10 * 1024 * 1024))
+    AVATAR_MAX_PIXELS = int(os.environ.get('AVATAR_MAX_PIXELS', 40_000_000))
+    AVATAR_SENDFILE = os.environ.get('AVATAR_SENDFILE', 'none').lower()
+    AVATAR_ACCEL_PREFIX = os.environ.get('AVATAR_ACCEL_PREFIX', '/_avatars/')   # location internal do nginx
+
+    # Importação de extratos (CSV/OFX)
+    IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 50 * 1024 * 1024))
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 2000))   # lançamentos por INSERT
+
+    # Teto do corpo de qualquer requisição, aplicado pelo Werkzeug ao ler o formulário
+    # (inclusive uploads chunked, sem Content-Length): o maior upload aceito mais 1 MB
+    MAX_CONTENT_LENGTH = max(AVATAR_MAX_BYTES, IMPORT_MAX_BYTES) + 1024 * 1024
+
+    # Cache de respostas do dashboard: 'lru' (memória de cada worker), 'filesystem' (compartilhado) ou 'none'
+    DASHBOARD_CACHE_BACKEND = os.environ.get('DASHBOARD_CACHE_BACKEND', 'lru').lower()
+    DASHBOARD_CACHE_SIZE = int(os.environ.get('DASHBOARD_CACHE_SIZE', 256))   # máximo de páginas em cache
+    DASHBOARD_CACHE_TTL = int(os.environ.get('DASHBOARD_CACHE_TTL', 300))     # segundos
+    DASHBOARD_CACHE_DIR = os.environ.get('DASHBOARD_CACHE_DIR', '/tmp/financeiro-dashboard-cache')
+
+    # Cache do usuário logado (user_loader): mesmos backends do cache do dashboard
+    USER_CACHE_BACKEND = os.environ.get('USER_CACHE_BACKEND', 'lru').lower()
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))   # segundos
+    USER_CACHE_DIR = os.environ.get('USER_CACHE_DIR', '/tmp/financeiro-user-cache')
\ No newline at end of file
@@ -0,0 +1,95 @@
+import threading
+from functools import wraps
+
+from flask import current_app
+from flask_login import current_user
+
+from app import db
+from app.cache_backends import make_backend
+from app.user_cache import UserCache
+
+# --- CACHE DE RESPOSTAS DO DASHBOARD ---
+# A chave inclui o data_version do usuário, incrementado por toda rota que altera
+# dados (decorador invalidates_dashboard). Nada é apagado na invalidação: as
+# entradas antigas simplesmente deixam de ser consultadas e saem por LRU/TTL.
+
+class DashboardCache:
+    """Backend escolhido em DASHBOARD_CACHE_BACKEND, guardado em app.extensions, com contadores de acerto."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0}
+        self.stats_lock = threading.Lock()
+
+    @staticmethod
+    def init_app(app):
+        backend = make_backend(
+            app.config.get('DASHBOARD_CACHE_BACKEND', 'lru'),
+            app.config.get('DASHBOARD_CACHE_SIZE', 256),
+            app.config.get('DASHBOARD_CACHE_TTL', 300),
+            app.config.get('DASHBOARD_CACHE_DIR')
+        )
+        app.extensions['dashboard_cache'] = DashboardCache(backend)
+
+    @staticmethod
+    def current():
+        return current_app.extensions.get('dashboard_cache')
+
+    @staticmethod
+    def make_key(user, month, year, today, *extra):
+        # data_version guardado no cache do usuário (o banco só é lido quando ele não
+        # está lá), não do objeto do usuário, que pode ter vindo de um snapshot antigo
+        parts = [str(user.id), str(UserCache.data_version(user.id) or 0), f"{year}-{month:02d}", today.isoformat()] + [str(e) for e in extra]
+        return 'dashboard:' + ':'.join(parts)
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def get(key):
+        cache = DashboardCache.current()
+        if cache is None or cache.backend is None:
+            return None
+        value = cache.backend.get(key)
+        cache.count('hits' if value is not None else 'misses')
+        return value
+
+    @staticmethod
+    def set(key, value):
+        cache = DashboardCache.current()
+        if cache is None or cache.backend is None:
+            return
+        cache.backend.set(key, value)
+        cache.count('stores')
+
+    @staticmethod
+    def get_stats():
+        cache = DashboardCache.current()
+        if cache is None or cache.backend is None:
+            return {'enabled': False}
+        with cache.stats_lock:
+            stats = dict(cache.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['enabled'] = True
+        return stats
+
+    @staticmethod
+    def bump_version(user_id):
+        """Invalida os dashboards em cache do usuário (sem commit)."""
+        # O mesmo data_version é a chave do snapshot do usuário (UserCache)
+        UserCache.invalidate(user_id)
+
+
+def invalidates_dashboard(view):
+    """Rotas que alteram dados do usuário: ao final, incrementa o data_version dele."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = current_user.id if current_user.is_authenticated else None
+        response = view(*args, **kwargs)
+        if user_id is not None:
+            DashboardCache.bump_version(user_id)
+            db.session.commit()
+        return response
+    return wrapper
@@ -0,0 +1,176 @@
+import os
+import uuid
+import socket
+import threading
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import EmailOutbox
+from app.email_utils import build_message, deliver_messages
+
+logger = logging.getLogger("email_outbox")
+
+# --- FILA DE E-MAILS (OUTBOX) ---
+# As rotas só gravam o e-mail em email_outbox. Cada worker do Gunicorn sobe uma
+# thread sender que reserva lotes da fila (UPDATE condicional com um claim_token,
+# então dois workers nunca pegam o mesmo e-mail) e os envia pelo pool de conexões
+# SMTP. Falhas são reagendadas com backoff exponencial até EMAIL_MAX_ATTEMPTS.
+
+# Acorda o sender deste processo assim que o e-mail enfileirado é commitado (os
+# demais workers o encontram na próxima verificação de EMAIL_POLL_INTERVAL)
+wakeup = threading.Event()
+
+@event.listens_for(Session, 'after_commit')
+def wake_sender_after_commit(session):
+    if session.info.pop('email_enqueued', False):
+        wakeup.set()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_enqueued_after_rollback(session):
+    session.info.pop('email_enqueued', None)
+
+class EmailOutboxService:
+
+    @staticmethod
+    def enqueue(to_email, subject, html_content):
+        """Grava o e-mail na fila (sem commit): ele só sai depois do commit da rota."""
+        email = EmailOutbox(to_email=to_email, subject=subject, html_content=html_content)
+        db.session.add(email)
+        db.session.flush()
+        db.session.info['email_enqueued'] = True
+        return email
+
+    @staticmethod
+    def claim_batch(size, lease):
+        """
+        Reserva até `size` e-mails vencidos (pendentes e sem reserva válida) por
+        `lease` segundos e os retorna. Quem vence o UPDATE fica com o lote.
+        """
+        now = datetime.utcnow()
+        claimable = (
+            (EmailOutbox.status == 'pending') &
+            (EmailOutbox.next_attempt_at <= now) &
+            ((EmailOutbox.locked_until == None) | (EmailOutbox.locked_until < now))
+        )
+        ids = [row[0] for row in db.session.query(EmailOutbox.id).filter(claimable).order_by(EmailOutbox.id).limit(size).all()]
+        if not ids:
+            db.session.rollback()
+            return []
+
+        token = uuid.uuid4().hex
+        outbox = EmailOutbox.__table__
+        db.session.execute(
+            outbox.update()
+            .where(outbox.c.id.in_(ids), claimable)
+            .values(claim_token=token, locked_until=now + timedelta(seconds=lease))
+        )
+        db.session.commit()
+        return EmailOutbox.query.filter_by(claim_token=token).order_by(EmailOutbox.id).all()
+
+    @staticmethod
+    def retry_delay(attempts):
+        base = current_app.config['EMAIL_RETRY_BASE']
+        return timedelta(seconds=min(base * 2 ** (attempts - 1), 3600))
+
+    @staticmethod
+    def send_batch(size=None):
+        """Envia um lote da fila. Retorna (enviados, falhas)."""
+        config = current_app.config
+        batch = EmailOutboxService.claim_batch(size or config['EMAIL_BATCH_SIZE'], config['EMAIL_CLAIM_LEASE'])
+        if not batch:
+            return 0, 0
+
+        results = deliver_messages([build_message(e.to_email, e.subject, e.html_content) for e in batch])
+
+        now = datetime.utcnow()
+        sent = failed = 0
+        for email, error in zip(batch, results):
+            email.attempts += 1
+            email.claim_token = None
+            email.locked_until = None
+            if error is None:
+                email.status = 'sent'
+                email.sent_at = now
+                email.last_error = None
+                sent += 1
+            else:
+                email.last_error = error[:255]
+                if email.attempts >= config['EMAIL_MAX_ATTEMPTS']:
+                    email.status = 'failed'
+                    logger.error(f"E-mail {email.id} para {email.to_email} descartado após {email.attempts} tentativas: {error}")
+                else:
+                    email.next_attempt_at = now + EmailOutboxService.retry_delay(email.attempts)
+                failed += 1
+        db.session.commit()
+        return sent, failed
+
+    @staticmethod
+    def send_pending(max_batches=None):
+        """Esvazia a fila (o que já venceu), lote a lote. Retorna (enviados, falhas)."""
+        total_sent = total_failed = batches = 0
+        while max_batches is None or batches < max_batches:
+            sent, failed = EmailOutboxService.send_batch()
+            if not sent and not failed:
+                break
+            total_sent += sent
+            total_failed += failed
+            batches += 1
+        return total_sent, total_failed
+
+    @staticmethod
+    def purge_sent(days):
+        """Apaga os e-mails enviados há mais de `days` dias."""
+        outbox = EmailOutbox.__table__
+        result = db.session.execute(
+            outbox.delete().where(outbox.c.status == 'sent', outbox.c.sent_at < datetime.utcnow() - timedelta(days=days))
+        )
+        db.session.commit()
+        return result.rowcount
+
+
+def sender_loop(app):
+    interval = app.config['EMAIL_POLL_INTERVAL']
+    while True:
+        wakeup.wait(interval)
+        wakeup.clear()
+        try:
+            with app.app_context():
+                EmailOutboxService.send_pending()
+        except Exception as e:
+            logger.error(f"Erro no envio da fila de e-mails: {e}")
+
+def start_email_sender(app):
+    """
+    Sobe a thread sender neste processo (mesmos pontos de partida do agendador:
+    post_fork do gunicorn.conf.py ou run.py executado direto).
+    """
+    if not app.config.get('EMAIL_SENDER_ENABLED'):
+        return None
+    thread = threading.Thread(target=sender_loop, args=(app,), name='email-sender', daemon=True)
+    thread.start()
+    logger.info(f"Sender de e-mails iniciado ({socket.gethostname()}:{os.getpid()}).")
+    return thread
+
+# --- CLI: flask email <comando> ---
+
+email_cli = AppGroup('email', help='Fila de e-mails (email_outbox).')
+
+@email_cli.command('send')
+def send_command():
+    """Envia agora todos os e-mails pendentes que já venceram."""
+    sent, failed = EmailOutboxService.send_pending()
+    click.echo(f"{sent} e-mails enviados, {failed} falhas.")
+
+@email_cli.command('status')
+def status_command():
+    """Mostra quantos e-mails há em cada estado."""
+    counts = db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id)).group_by(EmailOutbox.status).all()
+    for status, count in sorted(counts):
+        click.echo(f"{status}: {count}")
@@ -1,6 +1,8 @@
 import smtplib
 import os
+import time
 import logging
+import threading
 from email.message import EmailMessage
 
 # --- CONFIGURAÇÃO DE LOGS ---
@@ -9,21 +11,29 @@ logger = logging.getLogger("email_utils")
 
 # Configurações de SMTP (Environment Variables)
 SMTP_HOST = os.getenv("SMTP_HOST")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587)) 
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SMTP_FROM = os.getenv("SMTP_FROM", "Financeiro <noreply@financeiro.com>")
+SMTP_TIMEOUT = int(os.getenv("SMTP_TIMEOUT", 30))        # segundos por operação
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))     # conexões ociosas mantidas por processo
+SMTP_POOL_IDLE = int(os.getenv("SMTP_POOL_IDLE", 60))    # segundos até descartar uma conexão ociosa
+
+# 'smtp' envia de verdade; 'console' só registra o e-mail no log (desenvolvimento/testes).
+# Sem SMTP_HOST configurado, o padrão é 'console'.
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "smtp" if SMTP_HOST else "console").lower()
 
 def send_email(to_email: str, subject: str, html_content: str):
     """
-    Envia um e-mail HTML usando SMTP.
-    Agora recebe o HTML pronto renderizado pelo Jinja2.
+    Coloca um e-mail HTML na fila (tabela email_outbox), sem commit: a rota
+    commita junto com o restante do que gravou e o sender em segundo plano envia.
+    Recebe o HTML pronto renderizado pelo Jinja2.
     """
-    
-    if not SMTP_HOST:
-        logger.error("Configurações de SMTP (Host) não encontradas. O e-mail não será enviado.")
-        return False
+    from app.email_outbox import EmailOutboxService
+    EmailOutboxService.enqueue(to_email, subject, html_content)
+    return True
 
+def build_message(to_email, subject, html_content):
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = SMTP_FROM
@@ -32,11 +42,25 @@ def send_email(to_email: str, subject: str, html_content: str):
     # Define o conteúdo HTML
     msg.set_content("Por favor habilite HTML para ver este e-mail.") # Fallback texto puro
     msg.add_alternative(html_content, subtype="html")
+    return msg
 
-    try:
-        logger.info(f"Conectando ao SMTP {SMTP_HOST}:{SMTP_PORT} para enviar a {to_email}...")
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        
+class SMTPConnectionPool:
+    """
+    Conexões SMTP já autenticadas (STARTTLS + login feitos uma vez), reaproveitadas
+    entre lotes. Conexões ociosas há mais de SMTP_POOL_IDLE segundos são
+    descartadas, já que os servidores costumam derrubá-las.
+    """
+
+    def __init__(self, size, max_idle):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = []  # (conexão, instante da última utilização)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def connect():
+        logger.info(f"Conectando ao SMTP {SMTP_HOST}:{SMTP_PORT}...")
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
         server.ehlo()
         if SMTP_PORT == 587:
             server.starttls()
@@ -44,12 +68,80 @@ def send_email(to_email: str, subject: str, html_content: str):
 
         if SMTP_USER and SMTP_PASSWORD:
             server.login(SMTP_USER, SMTP_PASSWORD)
-            
-        server.send_message(msg)
-        server.quit()
-        logger.info("E-mail enviado com sucesso!")
-        return True
+        return server
+
+    @staticmethod
+    def discard(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def acquire(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                server, last_used = self.idle.pop()
+            if now - last_used < self.max_idle:
+                return server
+            self.discard(server)
+        return self.connect()
+
+    def release(self, server):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((server, time.monotonic()))
+                return
+        self.discard(server)
 
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server, _ in idle:
+            self.discard(server)
+
+smtp_pool = SMTPConnectionPool(SMTP_POOL_SIZE, SMTP_POOL_IDLE)
+
+def deliver_messages(messages):
+    """
+    Envia um lote de EmailMessage e retorna, na mesma ordem, None (enviado) ou
+    a mensagem de erro. O lote inteiro usa uma única conexão do pool; se ela
+    cair no meio do caminho, reconecta uma vez e continua.
+    """
+    if EMAIL_BACKEND == 'console':
+        for msg in messages:
+            # O corpo tem links de redefinição e códigos de 2FA: só em DEBUG
+            logger.info(f"[console] E-mail para {msg['To']}: {msg['Subject']}")
+            logger.debug(msg.get_body(('html',)).get_content())
+        return [None] * len(messages)
+
+    if not SMTP_HOST:
+        return ["Configurações de SMTP (Host) não encontradas."] * len(messages)
+
+    results = []
+    server = None
+    try:
+        server = smtp_pool.acquire()
+        for msg in messages:
+            try:
+                try:
+                    server.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    server = SMTPConnectionPool.connect()
+                    server.send_message(msg)
+                results.append(None)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # Recusa da mensagem: a conexão continua válida para as próximas
+                results.append(str(e))
     except Exception as e:
         logger.error(f"Falha ao enviar e-mail: {e}")
-        return False
\ No newline at end of file
+        if server is not None:
+            server.close()
+            server = None
+        results.extend([str(e)] * (len(messages) - len(results)))
+
+    if server is not None:
+        smtp_pool.release(server)
+    return results
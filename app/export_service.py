@@ -0,0 +1,207 @@
+import io
+import csv
+import json
+import zlib
+import heapq
+from datetime import date, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, or_
+
+from app import db
+from app.models import Transaction, Category, BankAccount, CreditCard
+from app.transaction_service import TransactionService
+from app.recurrence_service import RecurrenceService, HORIZON_MONTHS
+from app.installment_service import InstallmentService
+
+# --- EXPORTAÇÃO DAS TRANSAÇÕES ---
+# As transações gravadas saem em lotes de CURSOR_BATCH linhas, paginados por keyset
+# em (date, id), já com os nomes de categoria, conta e cartão (LEFT JOIN na mesma
+# consulta). Não dá para contar com cursor no servidor: o mysqlconnector (produção)
+# sempre bufferiza o resultado inteiro no cliente. As ocorrências
+# virtuais (fixos de cartão e parcelas) são geradas janela a janela. As duas
+# sequências, ambas em ordem de data, são intercaladas com heapq.merge e escritas
+# em pedaços de CHUNK_ROWS linhas: a memória não cresce com o tamanho do histórico.
+
+FIELDS = ('id', 'date', 'type', 'description', 'amount', 'category', 'account', 'card',
+          'invoice', 'installment', 'is_anticipated', 'is_virtual')
+CURSOR_BATCH = 1000   # linhas por consulta (LIMIT)
+CHUNK_ROWS = 500      # linhas por pedaço da resposta
+VIRTUAL_WINDOW_MONTHS = 12
+
+class ExportService:
+
+    @staticmethod
+    def iter_rows(user_id, filters, categories, cards):
+        """
+        Linhas do extrato (dicionários com FIELDS) em ordem de data. filters: os de
+        ledger_query, aplicados às gravadas e às virtuais. categories e cards:
+        {id: objeto} do usuário, para os nomes das ocorrências virtuais.
+        """
+        return heapq.merge(
+            ExportService.stored_rows(user_id, filters),
+            ExportService.virtual_rows(user_id, filters, categories, cards),
+            key=lambda row: row['date']
+        )
+
+    @staticmethod
+    def ledger_query(user_id, filters, *extra_columns):
+        """
+        SELECT das transações gravadas com os nomes de categoria, conta e cartão
+        (LEFT JOIN). filters: start, end, account_id, card_id, category_id,
+        min_amount e max_amount (None = sem filtro). Sem ORDER BY.
+        """
+        query = select(
+            Transaction.id, Transaction.date, Transaction.type, Transaction.description, Transaction.amount,
+            Category.name.label('category'), BankAccount.name.label('account'), CreditCard.name.label('card'),
+            Transaction.invoice_year, Transaction.invoice_month, Transaction.installment_current,
+            Transaction.installment_total, Transaction.is_anticipated, *extra_columns
+        ).outerjoin(Category, Category.id == Transaction.category_id) \
+         .outerjoin(BankAccount, BankAccount.id == Transaction.account_id) \
+         .outerjoin(CreditCard, CreditCard.id == Transaction.card_id) \
+         .where(Transaction.user_id == user_id)
+
+        if filters['start']: query = query.where(Transaction.date >= filters['start'])
+        if filters['end']: query = query.where(Transaction.date <= filters['end'])
+        if filters['account_id']: query = query.where(Transaction.account_id == filters['account_id'])
+        if filters['card_id']: query = query.where(Transaction.card_id == filters['card_id'])
+        if filters['category_id']: query = query.where(Transaction.category_id == filters['category_id'])
+        if filters['min_amount'] is not None: query = query.where(Transaction.amount >= filters['min_amount'])
+        if filters['max_amount'] is not None: query = query.where(Transaction.amount <= filters['max_amount'])
+        return query
+
+    @staticmethod
+    def ledger_row(row):
+        """Dicionário (FIELDS) de uma linha de ledger_query."""
+        (trans_id, trans_date, trans_type, description, amount, category, account, card,
+         invoice_year, invoice_month, current, total, is_anticipated) = row[:13]
+        return {
+            'id': trans_id, 'date': trans_date.isoformat(), 'type': trans_type, 'description': description,
+            'amount': round(float(amount), 2), 'category': category, 'account': account, 'card': card,
+            'invoice': f'{invoice_year}-{invoice_month:02d}' if invoice_year else None,
+            'installment': f'{current}/{total}' if current and total else None,
+            'is_anticipated': bool(is_anticipated), 'is_virtual': False
+        }
+
+    @staticmethod
+    def stored_rows(user_id, filters):
+        query = ExportService.ledger_query(user_id, filters).order_by(Transaction.date, Transaction.id).limit(CURSOR_BATCH)
+        last = None
+        while True:
+            batch = query
+            if last:
+                # Depois da última linha do lote anterior (índice user_id + date)
+                batch = batch.where(Transaction.date >= last.date, or_(Transaction.date > last.date, Transaction.id > last.id))
+            rows = db.session.execute(batch).all()
+            for row in rows:
+                yield ExportService.ledger_row(row)
+            if len(rows) < CURSOR_BATCH:
+                break
+            last = rows[-1]
+
+    @staticmethod
+    def virtual_rows(user_id, filters, categories, cards):
+        """
+        Ocorrências virtuais em ordem de data, geradas por janelas de
+        VIRTUAL_WINDOW_MONTHS. Sem data final, os fixos vão até o horizonte de
+        navegação do dashboard e as parcelas até a última.
+        """
+        if filters['account_id']:
+            return
+
+        def wanted(plan):
+            if plan.card_id not in cards:
+                return False
+            if filters['card_id'] and plan.card_id != filters['card_id']:
+                return False
+            return not filters['category_id'] or plan.category_id == filters['category_id']
+
+        def amount_wanted(amount):
+            if filters['min_amount'] is not None and amount < filters['min_amount']:
+                return False
+            return filters['max_amount'] is None or amount <= filters['max_amount']
+
+        today = date.today()
+        fixed_plans = [p for p in RecurrenceService.get_card_plans(user_id) if p.start_date and wanted(p)]
+        installment_plans = [p for p in InstallmentService.get_plans(user_id, cards.keys(), filters['start'], filters['end']) if wanted(p)]
+        if not fixed_plans and not installment_plans:
+            return
+
+        fixed_end = filters['end'] or today + relativedelta(months=HORIZON_MONTHS)
+        start = filters['start'] or min([p.start_date for p in fixed_plans] + [p.first_date for p in installment_plans])
+        end = filters['end'] or max([fixed_end] + [p.last_date for p in installment_plans])
+
+        window_start = start
+        while window_start <= end:
+            window_end = min(window_start + relativedelta(months=VIRTUAL_WINDOW_MONTHS) - timedelta(days=1), end)
+            items = InstallmentService.get_installments(
+                [p for p in installment_plans if p.first_date <= window_end and p.last_date >= window_start],
+                window_start, window_end
+            )
+            if window_start <= fixed_end:
+                items += RecurrenceService.get_occurrences(user_id, fixed_plans, window_start, min(window_end, fixed_end))
+            items.sort(key=lambda t: t.date)
+
+            for t in items:
+                if not amount_wanted(Decimal(str(t.amount))):
+                    continue
+                card = cards[t.card_id]
+                invoice_year, invoice_month = TransactionService.get_invoice_month(card.closing_day, t.date)
+                category = categories.get(t.category_id)
+                yield {
+                    'id': None, 'date': t.date.isoformat(), 'type': t.type, 'description': t.description,
+                    'amount': round(float(t.amount), 2), 'category': category.name if category else None,
+                    'account': None, 'card': card.name, 'invoice': f'{invoice_year}-{invoice_month:02d}',
+                    'installment': f'{t.installment_current}/{t.installment_total}' if t.installment_current else None,
+                    'is_anticipated': bool(t.is_anticipated), 'is_virtual': True
+                }
+            window_start = window_end + timedelta(days=1)
+
+    # --- FORMATOS ---
+
+    @staticmethod
+    def csv_chunks(rows):
+        """CSV com BOM (o Excel reconhece o UTF-8) e valores com ponto decimal."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(FIELDS)
+        for i, row in enumerate(rows, 1):
+            writer.writerow([ExportService.csv_value(row[field]) for field in FIELDS])
+            if i % CHUNK_ROWS == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+    @staticmethod
+    def csv_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, float):
+            return f'{value:.2f}'
+        return value
+
+    @staticmethod
+    def jsonl_chunks(rows):
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(row, ensure_ascii=False))
+            if len(lines) == CHUNK_ROWS:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    @staticmethod
+    def gzip_chunks(chunks):
+        """Comprime os pedaços à medida que são gerados (wbits 31: formato gzip)."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
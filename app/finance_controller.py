@@ -1,16 +1,26 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, current_app, abort, stream_with_context
 from flask_login import login_required, current_user
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import extract, func, or_, and_
+from sqlalchemy import func, or_, and_
 from decimal import Decimal
 import uuid
 import calendar
-import re 
+import hashlib
+import json
+import os
 
 from app import db
 from app.models import Transaction, BankAccount, FixedExpense, FixedRevenue, CreditCard, Category
 from app.transaction_service import TransactionService
+from app.rollup_service import RollupService
+from app.recurrence_service import RecurrenceService, HORIZON_MONTHS
+from app.installment_service import InstallmentService
+from app.forecast_service import ForecastService, MIN_MONTHS
+from app.export_service import ExportService
+from app.search_service import SearchService, MAX_PAGE
+from app.dashboard_cache import DashboardCache, invalidates_dashboard
+from app.user_data import UserData
 
 finance_bp = Blueprint('finance', __name__)
 
@@ -19,133 +29,171 @@ MONTH_NAMES = {
     7: 'JULHO', 8: 'AGOSTO', 9: 'SETEMBRO', 10: 'OUTUBRO', 11: 'NOVEMBRO', 12: 'DEZEMBRO'
 }
 
-# --- FUNÇÃO AUXILIAR: GERADOR DE PARCELAS FIXAS ---
-def generate_fixed_installments(fixed_expense, start_date, months=12):
-    created_count = 0
-    current_dt = start_date
-    
-    for i in range(months):
-        target_date = TransactionService.get_safe_date(current_dt.year, current_dt.month, fixed_expense.day_of_month)
-        
-        new_trans = Transaction(
-            user_id=fixed_expense.user_id,
-            description=fixed_expense.description,
-            amount=fixed_expense.amount,
-            date=target_date,
-            type='despesa',
-            category_id=fixed_expense.category_id,
-            account_id=None,
-            card_id=fixed_expense.card_id,
-            fixed_expense_id=fixed_expense.id
-        )
-        db.session.add(new_trans)
-        created_count += 1
-        current_dt = current_dt + relativedelta(months=1)
-        
-    return created_count
-
-# --- NOVA FUNÇÃO: RENOVAÇÃO AUTOMÁTICA ---
-def check_and_renew_fixed_expenses(user_id):
-    fixed_cards = FixedExpense.query.filter_by(user_id=user_id).filter(FixedExpense.card_id != None).all()
-    
-    renewed_count = 0
-    today = date.today()
-    safety_horizon = today + relativedelta(months=3)
+def get_requested_month(today):
+    try:
+        month = int(request.args.get('month', today.month))
+        year = int(request.args.get('year', today.year))
+        date(year, month, 1)
+    except ValueError:
+        month = today.month
+        year = today.year
+    return month, year
 
-    for fixed in fixed_cards:
-        last_trans = Transaction.query.filter_by(fixed_expense_id=fixed.id).order_by(Transaction.date.desc()).first()
-        
-        if last_trans:
-            if last_trans.date < safety_horizon:
-                start_next = last_trans.date + relativedelta(months=1)
-                count = generate_fixed_installments(fixed, start_next, 12)
-                if count > 0:
-                    renewed_count += 1
-    
-    if renewed_count > 0:
-        db.session.commit()
+def get_start_month_redirect(endpoint, month, year):
+    """Meses anteriores ao início do usuário no sistema redirecionam para o mês de início."""
+    if current_user.start_date:
+        start_month = current_user.start_date.replace(day=1)
+        if date(year, month, 1) < start_month:
+            return redirect(url_for(endpoint, month=start_month.month, year=start_month.year))
+    return None
 
 @finance_bp.route('/dashboard')
 @login_required
 def dashboard():
-    check_and_renew_fixed_expenses(current_user.id)
-
+    # Somente leitura: os fixos de cartão entram como ocorrências virtuais (app/recurrence_service.py)
     today = date.today()
+    month, year = get_requested_month(today)
+
+    start_redirect = get_start_month_redirect('finance.dashboard', month, year)
+    if start_redirect:
+        return start_redirect
+
+    # Cache por (usuário, versão dos dados, mês, dia): trocar de mês sem alterar nada não vai ao banco.
+    # Com mensagens flash pendentes a página não é cacheada (elas só podem aparecer uma vez).
+    use_cache = '_flashes' not in session
+    cache_key = DashboardCache.make_key(current_user, month, year, today, os.environ.get('APP_VERSION', 'dev-local'), request.url_root)
+    if use_cache:
+        cached = DashboardCache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    html = render_template('dashboard.html', **build_dashboard_context(month, year, today))
+    if use_cache:
+        DashboardCache.set(cache_key, html)
+    return html
+
+@finance_bp.route('/api/dashboard')
+@login_required
+def dashboard_api():
+    """
+    Dados do mês em JSON (resumo, cartões, fixos e uma página das transações) e os
+    trechos de HTML que o dashboard troca ao navegar entre meses sem recarregar.
+    O ETag vem da mesma chave do cache (usuário, data_version, mês, dia): enquanto
+    nada mudar, o navegador revalida e recebe 304 sem o servidor montar o mês.
+    """
+    today = date.today()
+    month, year = get_requested_month(today)
+
+    start_redirect = get_start_month_redirect('finance.dashboard_api', month, year)
+    if start_redirect:
+        return start_redirect
+
     try:
-        month = int(request.args.get('month', today.month))
-        year = int(request.args.get('year', today.year))
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 50)), 1), 200)
     except ValueError:
-        month = today.month
-        year = today.year
+        page, per_page = 1, 50
 
+    cache_key = DashboardCache.make_key(current_user, month, year, today, 'api', page, per_page, os.environ.get('APP_VERSION', 'dev-local'), request.url_root)
+    etag = hashlib.sha1(cache_key.encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        body = DashboardCache.get(cache_key)
+        if body is None:
+            context = build_dashboard_context(month, year, today)
+            payload = serialize_dashboard(context, page, per_page)
+            payload['html'] = {
+                'header': render_template('components/header_nav.html', **context),
+                'content': render_template('components/month_view.html', **context)
+            }
+            body = json.dumps(payload)
+            DashboardCache.set(cache_key, body)
+        response = current_app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    # Sempre revalida com o servidor (no-cache), mas a resposta só pertence a este usuário
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def build_dashboard_context(month, year, today):
     req_date = date(year, month, 1)
-    prev_month_date = req_date - relativedelta(months=1)
-    
-    if current_user.start_date:
-        start_month = current_user.start_date.replace(day=1)
-        if req_date < start_month:
-            return redirect(url_for('finance.dashboard', month=start_month.month, year=start_month.year))
+
+    # Categorias, contas e cartões do usuário: um SELECT cada, reaproveitados por toda a renderização.
+    # Com eles no identity map, t.category/t.account/t.card das linhas não geram consultas.
+    user_data = UserData.get()
+
+    all_fixed_expenses = FixedExpense.query.filter_by(user_id=current_user.id).order_by(FixedExpense.day_of_month).all()
+    card_plans = [f for f in all_fixed_expenses if f.card_id]
 
     last_db_trans = Transaction.query.filter_by(user_id=current_user.id).order_by(Transaction.date.desc()).first()
     max_nav_date = last_db_trans.date if last_db_trans else today
     if max_nav_date < today: max_nav_date = today
+    last_installment = InstallmentService.get_last_date(current_user.id)
+    if last_installment and last_installment > max_nav_date: max_nav_date = last_installment
+    # Fixos de cartão em vigor geram ocorrências futuras: navegação até o horizonte (ou o fim do plano)
+    for plan in card_plans:
+        if plan.end_date is None or plan.end_date > max_nav_date:
+            max_nav_date = max(max_nav_date, min(plan.end_date or date.max, today + relativedelta(months=HORIZON_MONTHS)))
 
     next_view_date = date(year, month, 1) + relativedelta(months=1)
     allow_next = True
     if next_view_date > max_nav_date.replace(day=1): allow_next = False
 
-    all_fixed_expenses = FixedExpense.query.filter_by(user_id=current_user.id).order_by(FixedExpense.day_of_month).all()
-    fixed_account_expenses = [f for f in all_fixed_expenses if not f.card_id]
-    fixed_revenues_defs = FixedRevenue.query.filter_by(user_id=current_user.id).order_by(FixedRevenue.day_of_month).all()
-
-    ref_pattern = f"%Ref: {month:02d}/{year}%"
-    
-    # 1. Buscamos do banco o mês atual E o mês anterior
-    db_transactions = Transaction.query.filter(
+    # Painel de fixos e previsão: só os planos em vigor no mês consultado
+    fixed_account_expenses = [f for f in all_fixed_expenses if not f.card_id and RecurrenceService.is_active(f, year, month)]
+    fixed_revenues_defs = [
+        r for r in FixedRevenue.query.filter_by(user_id=current_user.id).order_by(FixedRevenue.day_of_month).all()
+        if RecurrenceService.is_active(r, year, month)
+    ]
+
+    # Compras/pagamentos de cartão entram pela fatura gravada (invoice_year/invoice_month);
+    # as demais transações pelo mês literal ou pelo mês de referência (ref_year/ref_month)
+    month_start, month_end = TransactionService.get_month_range(year, month)
+    transactions = Transaction.query.filter(
         Transaction.user_id == current_user.id,
         or_(
             and_(
-                extract('month', Transaction.date) == month,
-                extract('year', Transaction.date) == year
+                Transaction.invoice_year == year,
+                Transaction.invoice_month == month
             ),
             and_(
-                extract('month', Transaction.date) == prev_month_date.month,
-                extract('year', Transaction.date) == prev_month_date.year
-            ),
-            Transaction.description.like(ref_pattern)
+                Transaction.invoice_year == None,
+                or_(
+                    and_(Transaction.date >= month_start, Transaction.date < month_end),
+                    and_(Transaction.ref_year == year, Transaction.ref_month == month)
+                )
+            )
         ),
         Transaction.type.in_(['receita', 'despesa', 'transf_saida', 'transf_entrada']) 
     ).order_by(Transaction.date.desc(), Transaction.created_at.desc()).all()
 
-    # 2. Filtro inteligente para colocar compras de cartão no mês da fatura correspondente
-    transactions = []
-    for t in db_transactions:
-        if t.card_id and t.type in ['despesa', 'pagamento_cartao']:
-            card = t.card if t.card else CreditCard.query.get(t.card_id)
-            # Se a compra foi DEPOIS do fechamento, pertence à fatura seguinte
-            if t.date.day > card.closing_day:
-                inv_date = t.date + relativedelta(months=1)
-            else:
-                inv_date = t.date
-                
-            if inv_date.month != month or inv_date.year != year:
-                continue # Pula se a fatura não pertencer ao dashboard sendo visualizado
-        else:
-            # Para transações de conta normais, respeita o mês literal
-            is_current = (t.date.month == month and t.date.year == year)
-            has_ref = f"Ref: {month:02d}/{year}" in (t.description or "")
-            if not is_current and not has_ref:
-                continue
-                
-        transactions.append(t)
+    # Exceções dos fixos de cartão, uma vez para a fatura do mês, os totais dos cartões
+    # (desde o início dos planos) e as próximas datas (até o horizonte)
+    card_exceptions = RecurrenceService.get_card_exceptions(
+        current_user.id, card_plans,
+        min(month_start - relativedelta(months=1), today), max(month_end, today + relativedelta(months=HORIZON_MONTHS))
+    )
+
+    # Fixos de cartão e parcelas não gravados: ocorrências virtuais da fatura do mês, na mesma ordenação
+    virtual = (
+        RecurrenceService.get_invoice_occurrences(current_user.id, user_data.cards, year, month, card_plans, card_exceptions) +
+        InstallmentService.get_invoice_installments(current_user.id, user_data.cards, year, month)
+    )
+    if virtual:
+        transactions = sorted(transactions + virtual, key=lambda t: (t.date, t.created_at), reverse=True)
 
     paid_expense_ids = []
     received_revenue_ids = []
 
+    # Próxima ocorrência futura de cada fixo: só ela pode ser antecipada (as demais ficam travadas)
+    next_expense_dates, next_revenue_dates = RecurrenceService.get_next_dates(current_user.id, today, card_plans, card_exceptions)
+
     fixed_map = {}
     for t in transactions:
-        is_anticipated = "(Ref:" in (t.description or "") or "(Repassado" in (t.description or "") or "(Antecipado)" in (t.description or "")
-        if t.date > today and not is_anticipated and not t.account_id:
+        if t.date > today and not t.is_anticipated and not t.account_id:
             t.is_scheduled = True
         else:
             t.is_scheduled = False
@@ -154,13 +202,11 @@ def dashboard():
         if t.fixed_revenue_id: received_revenue_ids.append(t.fixed_revenue_id)
 
         if (t.fixed_expense_id or t.fixed_revenue_id) and t.is_scheduled:
-            fid_col = Transaction.fixed_expense_id if t.fixed_expense_id else Transaction.fixed_revenue_id
-            fid_val = t.fixed_expense_id or t.fixed_revenue_id
-            pending = Transaction.query.filter(
-                Transaction.user_id == current_user.id, fid_col == fid_val,
-                Transaction.date < t.date, Transaction.date > today 
-            ).first()
-            t.is_locked_anticipate = bool(pending)
+            if t.fixed_expense_id:
+                next_date = next_expense_dates.get(t.fixed_expense_id)
+            else:
+                next_date = next_revenue_dates.get(t.fixed_revenue_id)
+            t.is_locked_anticipate = bool(next_date and next_date < t.date)
 
         fid = t.fixed_expense_id or t.fixed_revenue_id
         if fid:
@@ -170,97 +216,224 @@ def dashboard():
     for fid, items in fixed_map.items():
         if len(items) > 1:
             def get_ref_date(trans):
-                match = re.search(r'Ref: (\d{2})/(\d{4})', trans.description)
-                if match: return date(int(match.group(2)), int(match.group(1)), 1)
+                if trans.ref_year: return date(trans.ref_year, trans.ref_month, 1)
                 return trans.date
             items.sort(key=get_ref_date)
             for i in range(len(items) - 1): items[i].is_locked_by_cascade = True
             items[-1].is_locked_by_cascade = False
 
-    pagamento_cats = Category.query.filter_by(user_id=current_user.id, type='pagamento').all()
-    pagamento_ids = [c.id for c in pagamento_cats]
+    # Estatísticas de todos os cartões numa única consulta agrupada (já com a dívida acumulada)
+    cards_data = TransactionService.get_all_card_stats(current_user.id, month, year, user_data.cards, card_plans, card_exceptions)
 
-    # --- CÁLCULO DO BALANÇO REAL (O que de fato impactou o saldo HOJE) ---
-    receitas_real = 0
-    despesas_real = 0
-    
-    for t in transactions:
-        if t.type == 'receita':
-             receitas_real += t.amount
-        elif t.type == 'despesa':
-            is_payment_cat = t.category_id in pagamento_ids
-            is_payment_desc = "Pagamento Fatura" in (t.description or "") or "Pagamento de Cartão" in (t.description or "")
-            
-            if is_payment_cat or is_payment_desc:
-                continue
+    # --- TOTAIS DO MÊS (pré-calculados na tabela monthly_rollups pelas rotas de escrita) ---
+    summary = RollupService.get_month_summary(current_user.id, year, month, [c['obj'] for c in cards_data], today, virtual)
 
-            if t.card_id:
-                if t.date <= today: despesas_real += t.amount
-            else:
-                despesas_real += t.amount
-    
-    receitas = receitas_real
-    despesas = despesas_real
+    # --- CÁLCULO DO BALANÇO REAL (O que de fato impactou o saldo HOJE) ---
+    receitas = summary['receitas']
+    despesas = summary['despesas']
     saldo_mensal = receitas - despesas
 
     # --- CÁLCULO DA PREVISÃO (Saldo Final após tudo pago) ---
     
     # 1. Receitas: Fixas + Avulsas
-    total_receitas_prev = sum(r.amount for r in fixed_revenues_defs)
-    
-    for t in transactions:
-        if t.type == 'receita' and not t.fixed_revenue_id:
-            total_receitas_prev += t.amount
+    total_receitas_prev = sum(r.amount for r in fixed_revenues_defs) + summary['receitas_avulsas']
 
     # 2. Despesas: Fixas de Conta + Avulsos de Conta (SEM PAGAMENTO DE FATURA) + Faturas Totais
-    total_despesas_prev = sum(f.amount for f in fixed_account_expenses)
-    
-    for t in transactions:
-        if t.type == 'despesa' and not t.fixed_expense_id and not t.card_id:
-            is_payment_cat = t.category_id in pagamento_ids
-            is_payment_desc = "Pagamento Fatura" in (t.description or "") or "Pagamento de Cartão" in (t.description or "")
-            
-            if not is_payment_cat and not is_payment_desc:
-                total_despesas_prev += t.amount
+    total_despesas_prev = sum(f.amount for f in fixed_account_expenses) + summary['despesas_conta_avulsas']
 
     # 3. Soma TOTAL das Faturas de Cartão (Agora inclui o ROLLOVER/Dívida Passada)
-    cards_data = []
-    for card in current_user.cards:
-        # Pega as estatísticas JÁ com o cálculo de dívida acumulada via Service
-        stats = TransactionService.get_card_stats(current_user.id, card.id, month, year)
-        cards_data.append(stats)
-        
+    for stats in cards_data:
         # O campo 'invoice_amount' já contém (Dívida Anterior + Gastos do Mês - Pagamentos do Mês)
         total_despesas_prev += Decimal(stats['invoice_amount'])
 
     saldo_previsao = total_receitas_prev - total_despesas_prev
     
-    saldo_contas = sum(acc.current_balance for acc in current_user.accounts)
+    saldo_contas = sum(acc.current_balance for acc in user_data.accounts)
 
     expenses_status = [{'obj': e, 'is_paid': e.id in paid_expense_ids} for e in fixed_account_expenses]
     revenues_status = [{'obj': r, 'is_received': r.id in received_revenue_ids} for r in fixed_revenues_defs]
 
     is_future_view = req_date.replace(day=1) > today.replace(day=1)
 
-    return render_template('dashboard.html', 
-                         transactions=transactions,
-                         receitas=receitas,
-                         despesas=despesas,
-                         saldo_mensal=saldo_mensal,
-                         saldo_previsao=saldo_previsao,
-                         saldo_contas=saldo_contas,
-                         current_month=month,
-                         current_year=year,
-                         month_name=MONTH_NAMES[month],
-                         fixed_expenses=expenses_status, 
-                         fixed_revenues=revenues_status,
-                         cards_data=cards_data,
-                         allow_next=allow_next,
-                         is_future_view=is_future_view,
-                         today=today)
+    return dict(transactions=transactions,
+                receitas=receitas,
+                despesas=despesas,
+                saldo_mensal=saldo_mensal,
+                saldo_previsao=saldo_previsao,
+                saldo_contas=saldo_contas,
+                current_month=month,
+                current_year=year,
+                month_name=MONTH_NAMES[month],
+                fixed_expenses=expenses_status,
+                fixed_revenues=revenues_status,
+                cards_data=cards_data,
+                allow_next=allow_next,
+                is_future_view=is_future_view,
+                today=today)
+
+@finance_bp.route('/api/forecast')
+@login_required
+def forecast_api():
+    """
+    Previsão mês a mês (12 a 36 meses, parâmetro months) do saldo de cada conta,
+    da fatura de cada cartão e dos totais. Em cache e com ETag como o dashboard:
+    a chave muda com o data_version do usuário e com o dia.
+    """
+    today = date.today()
+    try:
+        months = int(request.args.get('months', MIN_MONTHS))
+    except ValueError:
+        months = MIN_MONTHS
+
+    cache_key = DashboardCache.make_key(current_user, today.month, today.year, today, 'forecast', months)
+    etag = hashlib.sha1(cache_key.encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        body = DashboardCache.get(cache_key)
+        if body is None:
+            user_data = UserData.get()
+            forecast = ForecastService.build(current_user.id, user_data.accounts, user_data.cards, today, months)
+            body = json.dumps(forecast)
+            DashboardCache.set(cache_key, body)
+        response = current_app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+def get_ledger_filters():
+    """Filtros da exportação e da busca; valores inválidos ou ausentes ficam sem limite."""
+    def parse_date(name):
+        try:
+            return date.fromisoformat(request.args.get(name, ''))
+        except ValueError:
+            return None
+
+    def parse_amount(name):
+        try:
+            value = Decimal(request.args[name].replace(',', '.'))
+        except (KeyError, ArithmeticError):
+            return None
+        return value if value.is_finite() else None
+
+    return {
+        'start': parse_date('start'),
+        'end': parse_date('end'),
+        'account_id': request.args.get('account_id', type=int),
+        'card_id': request.args.get('card_id', type=int),
+        'category_id': request.args.get('category_id', type=int),
+        'min_amount': parse_amount('min_amount'),
+        'max_amount': parse_amount('max_amount'),
+    }
+
+@finance_bp.route('/export/transactions.<fmt>')
+@login_required
+def export_transactions(fmt):
+    """
+    Exporta as transações (gravadas e virtuais) em CSV ou JSON Lines, em fluxo:
+    as linhas saem do cursor do banco direto para a resposta. gzip=1 comprime
+    durante o envio.
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+
+    user_data = UserData.get()
+    rows = ExportService.iter_rows(
+        current_user.id, get_ledger_filters(),
+        {c.id: c for c in user_data.categories}, {c.id: c for c in user_data.cards}
+    )
+    chunks = ExportService.csv_chunks(rows) if fmt == 'csv' else ExportService.jsonl_chunks(rows)
+    filename, mimetype = f'transacoes-{date.today().isoformat()}.{fmt}', EXPORT_FORMATS[fmt]
+    if request.args.get('gzip') == '1':
+        chunks = ExportService.gzip_chunks(chunks)
+        filename, mimetype = filename + '.gz', 'application/gzip'
+
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
+@finance_bp.route('/api/search')
+@login_required
+def search_api():
+    """
+    Busca nas descrições (q), com os filtros da exportação mais min_amount e
+    max_amount. Paginação por cursor: next_cursor volta em ?cursor=. As compras
+    parceladas encontradas vêm em 'plans' e os fixos em 'fixed', só na primeira página.
+    """
+    filters = get_ledger_filters()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE)
+    try:
+        cursor = SearchService.decode_cursor(request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+    query_text = request.args.get('q', '')
+    items, next_cursor = SearchService.search(current_user.id, query_text, filters, limit, cursor)
+    plans, fixed = [], []
+    if cursor is None:
+        plans = SearchService.search_plans(current_user.id, query_text, filters, limit)
+        fixed = SearchService.search_fixed(current_user.id, query_text, filters, limit)
+    return jsonify({'items': items, 'plans': plans, 'fixed': fixed, 'next_cursor': next_cursor})
+
+def to_money(value):
+    return round(float(value or 0), 2)
+
+def serialize_dashboard(context, page, per_page):
+    transactions = context['transactions']
+    start = (page - 1) * per_page
+    return {
+        'month': context['current_month'],
+        'year': context['current_year'],
+        'month_name': context['month_name'],
+        'allow_next': context['allow_next'],
+        'is_future_view': context['is_future_view'],
+        'summary': {
+            'saldo_contas': to_money(context['saldo_contas']),
+            'receitas': to_money(context['receitas']),
+            'despesas': to_money(context['despesas']),
+            'saldo_mensal': to_money(context['saldo_mensal']),
+            'saldo_previsao': to_money(context['saldo_previsao'])
+        },
+        'cards': [{
+            'id': c['obj'].id, 'name': c['obj'].name,
+            'limit': to_money(c['limit']), 'used': to_money(c['used']), 'available': to_money(c['available']),
+            'percent': round(float(c['percent']), 1), 'invoice_amount': to_money(c['invoice_amount']), 'is_paid': c['is_paid'],
+            'due_date': c['full_due_date'], 'closing_date': c['full_closing_date']
+        } for c in context['cards_data']],
+        'fixed_expenses': [{
+            'id': f['obj'].id, 'description': f['obj'].description, 'amount': to_money(f['obj'].amount),
+            'day_of_month': f['obj'].day_of_month, 'account_id': f['obj'].account_id, 'is_paid': f['is_paid']
+        } for f in context['fixed_expenses']],
+        'fixed_revenues': [{
+            'id': r['obj'].id, 'description': r['obj'].description, 'amount': to_money(r['obj'].amount),
+            'day_of_month': r['obj'].day_of_month, 'account_id': r['obj'].account_id, 'is_received': r['is_received']
+        } for r in context['fixed_revenues']],
+        'transactions': {
+            'page': page,
+            'per_page': per_page,
+            'total': len(transactions),
+            'items': [{
+                'id': t.id, 'description': t.description, 'amount': to_money(t.amount), 'type': t.type,
+                'date': t.date.strftime('%d/%m/%Y'),
+                'category': t.category.name if t.category else None,
+                'account': t.account.name if t.account_id else None,
+                'card': t.card.name if t.card_id else None,
+                'installment_current': t.installment_current, 'installment_total': t.installment_total,
+                'is_scheduled': t.is_scheduled, 'is_virtual': t.is_virtual
+            } for t in transactions[start:start + per_page]]
+        }
+    }
 
 @finance_bp.route('/transaction/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_transaction():
     trans_type = request.form.get('type')
     description = request.form.get('description')
@@ -295,19 +468,21 @@ def add_transaction():
             new_fixed = FixedExpense(
                 user_id=current_user.id, description=description, amount=amount,
                 day_of_month=day_fixed, category_id=category_id,
-                account_id=account_id, card_id=card_id
+                account_id=account_id, card_id=card_id, start_date=base_date_obj
             )
             db.session.add(new_fixed)
-            db.session.flush()
             if card_id:
-                generate_fixed_installments(new_fixed, base_date_obj, 12)
-                flash('Despesa fixa de cartão cadastrada! Lançamentos gerados para 12 meses.', 'success')
+                # Nada é gravado por mês: as ocorrências são geradas a partir de start_date.
+                # Começando no passado, as faturas já fechadas precisam ser recalculadas.
+                RecurrenceService.invalidate_snapshots(card_id, base_date_obj)
+                flash('Despesa fixa de cartão cadastrada! Ela será lançada todo mês na fatura.', 'success')
             else:
                 flash('Despesa fixa de conta cadastrada! Ative-a no painel para lançar.', 'info')
         elif trans_type == 'receita':
             new_fixed = FixedRevenue(
                 user_id=current_user.id, description=description, amount=amount,
-                day_of_month=day_fixed, category_id=category_id, account_id=account_id
+                day_of_month=day_fixed, category_id=category_id, account_id=account_id,
+                start_date=base_date_obj
             )
             db.session.add(new_fixed)
             flash('Receita fixa cadastrada! Ative-a no painel para lançar.', 'info')
@@ -330,31 +505,17 @@ def add_transaction():
 
         if trans_type == 'despesa' and payment_mode == 'credit' and installments > 1:
             card = CreditCard.query.get(card_id)
-            identifier = str(uuid.uuid4())
-            installment_value = amount / installments
             first_due_date = TransactionService.calculate_card_date(base_date_obj, card)
-            
-            for i in range(installments):
-                due_date = first_due_date + relativedelta(months=i)
-                # Mantém a data original na descrição para referência visual
-                desc_text = description
-                if first_due_date != base_date_obj:
-                    desc_text = f"{description} (Ref: {base_date_obj.strftime('%d/%m')})"
-                    
-                new_trans = Transaction(
-                    user_id=current_user.id,
-                    description=f"{desc_text} ({i+1}/{installments})",
-                    amount=installment_value,
-                    date=due_date,
-                    type='despesa',
-                    category_id=category_id,
-                    card_id=card_id,
-                    installment_total=installments,
-                    installment_current=i+1,
-                    installment_identifier=identifier,
-                    total_purchase_amount=amount
-                )
-                db.session.add(new_trans)
+            # Mantém a data original na descrição para referência visual
+            desc_text = description
+            if first_due_date != base_date_obj:
+                desc_text = f"{description} (Ref: {base_date_obj.strftime('%d/%m')})"
+
+            # Uma linha para a compra inteira: as parcelas são derivadas do plano
+            InstallmentService.create_plan(
+                current_user.id, str(uuid.uuid4()), desc_text, amount, installments, first_due_date,
+                card_id, category_id, is_anticipated=first_due_date != base_date_obj
+            )
             flash(f'Compra parcelada em {installments}x lançada!', 'success')
         else:
             final_date = base_date_obj
@@ -368,7 +529,8 @@ def add_transaction():
             new_trans = Transaction(
                 user_id=current_user.id, description=description, amount=amount,
                 date=final_date, type=trans_type, category_id=category_id,
-                account_id=account_id, card_id=card_id
+                account_id=account_id, card_id=card_id,
+                is_anticipated=final_date != base_date_obj
             )
             db.session.add(new_trans)
             flash('Lançamento adicionado!', 'success')
@@ -378,28 +540,29 @@ def add_transaction():
 
 @finance_bp.route('/transaction/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_transaction(id):
     trans = Transaction.query.get_or_404(id)
     
     if trans.fixed_expense_id:
-        fixed_id = trans.fixed_expense_id
+        fixed = FixedExpense.query.get(trans.fixed_expense_id)
+        occurrence_date = trans.occurrence_date or trans.date
         today = date.today()
         
         if trans.date > today:
-            Transaction.query.filter(
-                Transaction.fixed_expense_id == fixed_id,
-                Transaction.date >= trans.date
-            ).delete()
-            
-            Transaction.query.filter_by(fixed_expense_id=fixed_id).update({Transaction.fixed_expense_id: None})
-            FixedExpense.query.filter_by(id=fixed_id).delete()
-            
+            # Encerra o plano antes desta ocorrência; o histórico fica intacto
+            if fixed:
+                RecurrenceService.end_plan(fixed, occurrence_date - timedelta(days=1))
+            db.session.delete(trans)
             db.session.commit()
             flash('Plano fixo cancelado e lançamentos futuros removidos.', 'success')
             return redirect(url_for('finance.dashboard', month=trans.date.month, year=trans.date.year))
         
         else:
             db.session.delete(trans)
+            # Sem a exceção gravada a ocorrência voltaria como virtual: fica registrada como pulada
+            if fixed and trans.occurrence_date:
+                RecurrenceService.skip(fixed, trans.occurrence_date)
             db.session.commit()
             flash('Lançamento atual removido. O plano continua ativo para os próximos meses.', 'info')
             return redirect(url_for('finance.dashboard', month=trans.date.month, year=trans.date.year))
@@ -408,28 +571,26 @@ def delete_transaction(id):
         if TransactionService.has_invoice_payment(current_user.id, trans.card_id, trans.date):
             flash('Não é possível excluir: fatura já paga.', 'danger')
             return redirect(url_for('finance.dashboard', month=trans.date.month, year=trans.date.year))
+
+        # Parcela de um plano: sem o registro da exclusão ela voltaria a ser gerada
+        plan, installment_date = InstallmentService.get_plan_for(trans)
+        if plan:
+            InstallmentService.skip(plan, installment_date)
             
-    if trans.account_id and trans.type == 'despesa' and trans.description.startswith('Pagamento Fatura '):
-        card_name = trans.description[17:] 
-        card = CreditCard.query.filter_by(user_id=current_user.id, name=card_name).first()
-        if card:
-            card_payment = Transaction.query.filter_by(
-                user_id=current_user.id, card_id=card.id, type='pagamento_cartao',
-                date=trans.date, amount=trans.amount
-            ).first()
-            if card_payment: db.session.delete(card_payment)
+    # Pagamento de fatura: os dois lados (conta e cartão) saem juntos
+    if trans.account_id and trans.type == 'despesa' and trans.is_invoice_payment and trans.paired_transaction_id:
+        card_payment = Transaction.query.filter_by(
+            id=trans.paired_transaction_id, user_id=current_user.id, type='pagamento_cartao'
+        ).first()
+        if card_payment: db.session.delete(card_payment)
     elif trans.card_id and trans.type == 'pagamento_cartao':
-        card = CreditCard.query.get(trans.card_id)
-        if card:
-            bank_payment = Transaction.query.filter(
-                Transaction.user_id == current_user.id, type='despesa',
-                description=f"Pagamento Fatura {card.name}",
-                date=trans.date, amount=trans.amount
-            ).first()
-            if bank_payment:
-                acc = BankAccount.query.get(bank_payment.account_id)
-                acc.current_balance += bank_payment.amount
-                db.session.delete(bank_payment)
+        bank_payment = Transaction.query.filter_by(
+            user_id=current_user.id, is_invoice_payment=True, paired_transaction_id=trans.id
+        ).first()
+        if bank_payment:
+            acc = BankAccount.query.get(bank_payment.account_id)
+            acc.current_balance += bank_payment.amount
+            db.session.delete(bank_payment)
 
     if trans.account_id:
         account = BankAccount.query.get(trans.account_id)
@@ -442,6 +603,7 @@ def delete_transaction(id):
 
 @finance_bp.route('/transaction/anticipate_fixed/<int:id>')
 @login_required
+@invalidates_dashboard
 def anticipate_fixed(id):
     today = date.today()
     trans = Transaction.query.get_or_404(id)
@@ -454,6 +616,8 @@ def anticipate_fixed(id):
     else:
         original_ref = f"(Ref: {trans.date.strftime('%m/%Y')})"
         trans.description = f"Adiantamento {trans.description} {original_ref}"
+        trans.ref_year, trans.ref_month = trans.date.year, trans.date.month
+        trans.is_anticipated = True
     
     trans.date = target_date
     
@@ -463,13 +627,19 @@ def anticipate_fixed(id):
 
 @finance_bp.route('/transaction/undo_anticipate/<int:id>')
 @login_required
+@invalidates_dashboard
 def undo_anticipate(id):
     trans = Transaction.query.get_or_404(id)
-    match = re.search(r'Ref: (\d{2})/(\d{4})', trans.description)
-    
-    if match:
-        original_month = int(match.group(1))
-        original_year = int(match.group(2))
+    if trans.card_id and trans.fixed_expense_id and trans.occurrence_date:
+        # Ocorrência de fixo de cartão gravada como exceção: sem ela, volta a ser gerada na data original
+        db.session.delete(trans)
+        db.session.commit()
+        flash('Antecipação desfeita!', 'info')
+        return redirect(url_for('finance.dashboard'))
+
+    if trans.ref_year:
+        original_month = trans.ref_month
+        original_year = trans.ref_year
     elif trans.fixed_expense_id:
         flash('Não foi possível identificar a data original automaticamente para este item de cartão.', 'warning')
         return redirect(url_for('finance.dashboard'))
@@ -484,6 +654,8 @@ def undo_anticipate(id):
             restored_date = TransactionService.get_safe_date(original_year, original_month, target_day)
             trans.date = restored_date
             trans.description = fixed.description 
+            trans.ref_year = trans.ref_month = None
+            trans.is_anticipated = False
             db.session.commit()
             flash('Antecipação desfeita!', 'info')
         else:
@@ -491,8 +663,102 @@ def undo_anticipate(id):
     
     return redirect(url_for('finance.dashboard'))
 
+# --- OCORRÊNCIAS VIRTUAIS DE FIXOS DE CARTÃO ---
+# Não têm id: são identificadas pelo plano e pela data programada. Antecipar ou
+# editar grava a ocorrência como Transaction; excluir pula a ocorrência (passada)
+# ou encerra o plano (futura), como delete_transaction faz com as gravadas.
+
+def get_virtual_occurrence(fixed_id, occurrence):
+    try:
+        occurrence_date = datetime.strptime(occurrence, '%Y-%m-%d').date()
+    except ValueError:
+        abort(404)
+    plan = RecurrenceService.get_plan('expense', fixed_id, current_user.id)
+    if plan is None or not plan.card_id or not RecurrenceService.is_occurrence(plan, occurrence_date):
+        abort(404)
+    # Já gravada ou pulada: não é mais virtual
+    if (plan.id, None, occurrence_date) in RecurrenceService.get_exceptions(current_user.id, occurrence_date, occurrence_date):
+        abort(404)
+    return plan, occurrence_date
+
+@finance_bp.route('/fixed/<int:fixed_id>/<occurrence>/anticipate')
+@login_required
+@invalidates_dashboard
+def anticipate_occurrence(fixed_id, occurrence):
+    plan, occurrence_date = get_virtual_occurrence(fixed_id, occurrence)
+    RecurrenceService.materialize(
+        plan, occurrence_date, date=date.today(),
+        description=f"Adiantamento {plan.description}", is_anticipated=True
+    )
+    db.session.commit()
+    flash('Despesa antecipada para a fatura atual!', 'success')
+    return redirect(url_for('finance.dashboard'))
+
+@finance_bp.route('/fixed/<int:fixed_id>/<occurrence>/edit', methods=['POST'])
+@login_required
+@invalidates_dashboard
+def edit_occurrence(fixed_id, occurrence):
+    plan, occurrence_date = get_virtual_occurrence(fixed_id, occurrence)
+    RecurrenceService.materialize(
+        plan, occurrence_date,
+        description=request.form.get('description') or plan.description,
+        amount=Decimal(request.form.get('amount', '0').replace(',', '.'))
+    )
+    RecurrenceService.invalidate_snapshots(plan.card_id, occurrence_date)
+    db.session.commit()
+    return redirect(url_for('finance.dashboard', month=occurrence_date.month, year=occurrence_date.year))
+
+@finance_bp.route('/fixed/<int:fixed_id>/<occurrence>/delete')
+@login_required
+@invalidates_dashboard
+def delete_occurrence(fixed_id, occurrence):
+    plan, occurrence_date = get_virtual_occurrence(fixed_id, occurrence)
+    if occurrence_date > date.today():
+        RecurrenceService.end_plan(plan, occurrence_date - timedelta(days=1))
+        flash('Plano fixo cancelado e lançamentos futuros removidos.', 'success')
+    else:
+        RecurrenceService.skip(plan, occurrence_date)
+        flash('Lançamento atual removido. O plano continua ativo para os próximos meses.', 'info')
+    db.session.commit()
+    return redirect(url_for('finance.dashboard', month=occurrence_date.month, year=occurrence_date.year))
+
+# --- PARCELAS VIRTUAIS ---
+# Identificadas pelo plano e pelo número: editar grava a parcela como Transaction
+# e excluir a registra como pulada.
+
+def get_virtual_installment(plan_id, number):
+    found = InstallmentService.get_installment(current_user.id, plan_id, number)
+    if found is None:
+        abort(404)
+    return found
+
+@finance_bp.route('/installment/<int:plan_id>/<int:number>/edit', methods=['POST'])
+@login_required
+@invalidates_dashboard
+def edit_installment(plan_id, number):
+    plan, installment_date, _ = get_virtual_installment(plan_id, number)
+    fields = {'amount': Decimal(request.form.get('amount', '0').replace(',', '.'))}
+    if request.form.get('description'):
+        fields['description'] = request.form.get('description')
+    db.session.add(Transaction(**InstallmentService.row(plan, number, installment_date, **fields)))
+    db.session.commit()
+    return redirect(url_for('finance.dashboard', month=installment_date.month, year=installment_date.year))
+
+@finance_bp.route('/installment/<int:plan_id>/<int:number>/delete')
+@login_required
+@invalidates_dashboard
+def delete_installment(plan_id, number):
+    plan, installment_date, _ = get_virtual_installment(plan_id, number)
+    if TransactionService.has_invoice_payment(current_user.id, plan.card_id, installment_date):
+        flash('Não é possível excluir: fatura já paga.', 'danger')
+    else:
+        InstallmentService.skip(plan, installment_date)
+        db.session.commit()
+    return redirect(url_for('finance.dashboard', month=installment_date.month, year=installment_date.year))
+
 @finance_bp.route('/transaction/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_transaction(id):
     trans = Transaction.query.get_or_404(id)
 
@@ -517,6 +783,7 @@ def edit_transaction(id):
 
 @finance_bp.route('/transfer', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def transfer_values():
     source_id = int(request.form.get('source_id'))
     target_id = int(request.form.get('target_id'))
@@ -537,6 +804,7 @@ def transfer_values():
 
 @finance_bp.route('/card/pay', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def pay_card_invoice():
     card_id = int(request.form.get('card_id'))
     account_id = int(request.form.get('account_id'))
@@ -560,20 +828,44 @@ def pay_card_invoice():
 @finance_bp.route('/api/card/<int:card_id>/installments')
 @login_required
 def get_card_installments(card_id):
-    installments = TransactionService.get_future_installments(current_user.id, card_id)
-    grouped = {}
-    for t in installments:
-        key = t.installment_identifier if t.installment_identifier else t.description
-        if key not in grouped:
-            clean_desc = t.description.split('(')[0].strip()
-            grouped[key] = {'identifier': key, 'description': clean_desc, 'count': 0, 'total_remaining': 0.0, 'items': []}
-        grouped[key]['count'] += 1
-        grouped[key]['total_remaining'] += float(t.amount)
-        grouped[key]['items'].append({'id': t.id, 'description': t.description, 'amount': float(t.amount), 'date': t.date.strftime('%d/%m/%Y'), 'current': t.installment_current, 'total': t.installment_total})
-    return jsonify(list(grouped.values()))
+    """
+    Uma página das compras parceladas do cartão (só os totais de cada uma); as
+    parcelas de cada compra vêm de get_card_installment_items, ao expandi-la.
+    """
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), 100)
+    except ValueError:
+        page, per_page = 1, 20
+
+    groups, has_more = InstallmentService.get_future_groups(current_user.id, card_id, page, per_page)
+    return jsonify({
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more,
+        'groups': [{
+            'identifier': g.identifier,
+            'description': g.description.split('(')[0].strip(),
+            'count': g.count,
+            'total_remaining': to_money(g.total_remaining),
+            'next_date': g.next_date.strftime('%d/%m/%Y')
+        } for g in groups]
+    })
+
+@finance_bp.route('/api/card/<int:card_id>/installments/items')
+@login_required
+def get_card_installment_items(card_id):
+    identifier = request.args.get('identifier', '')
+    installments = InstallmentService.get_future_items(current_user.id, card_id, identifier)
+    return jsonify([{
+        # Parcelas virtuais não têm id: o checkbox envia 'plan_id:número'
+        'id': t.advance_key if t.is_virtual else t.id, 'description': t.description, 'amount': to_money(t.amount), 'date': t.date.strftime('%d/%m/%Y'),
+        'current': t.installment_current, 'total': t.installment_total
+    } for t in installments])
 
 @finance_bp.route('/card/advance', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def advance_card_installments():
     card_id = int(request.form.get('card_id'))
     transaction_ids = request.form.getlist('installments[]')
@@ -587,6 +879,7 @@ def advance_card_installments():
 
 @finance_bp.route('/toggle_fixed/<string:type_fixed>/<int:id>')
 @login_required
+@invalidates_dashboard
 def toggle_fixed(type_fixed, id):
     today = date.today()
     try:
@@ -598,20 +891,24 @@ def toggle_fixed(type_fixed, id):
     
     view_date = date(target_year, target_month, 1)
     current_view_date = today.replace(day=1)
+    month_start, month_end = TransactionService.get_month_range(target_year, target_month)
     
     if view_date > current_view_date:
         final_date = today 
         ref_desc = f" (Ref: {target_month:02d}/{target_year})"
+        ref_fields = {'ref_year': target_year, 'ref_month': target_month, 'is_anticipated': True}
         flash_msg = f"Antecipado para hoje com referência a {target_month:02d}/{target_year}."
     elif view_date == current_view_date:
         # Se for o mês atual, ignora o dia programado e lança com a data do clique (hoje)
         final_date = today 
         ref_desc = ""
+        ref_fields = {}
         flash_msg = None
     else:
         # Se for um mês passado (esqueceu de marcar), mantém a data programada para não bagunçar o passado
         final_date = None 
         ref_desc = ""
+        ref_fields = {}
         flash_msg = None
 
     if type_fixed == 'expense':
@@ -625,10 +922,10 @@ def toggle_fixed(type_fixed, id):
             Transaction.fixed_expense_id == fixed_item.id,
             or_(
                 and_(
-                    extract('month', Transaction.date) == target_month,
-                    extract('year', Transaction.date) == target_year
+                    Transaction.date >= month_start,
+                    Transaction.date < month_end
                 ),
-                Transaction.description.like(f"%Ref: {target_month:02d}/{target_year}%")
+                and_(Transaction.ref_year == target_year, Transaction.ref_month == target_month)
             )
         ).first()
         
@@ -655,7 +952,9 @@ def toggle_fixed(type_fixed, id):
                     amount=fixed_item.amount, 
                     date=final_date, 
                     type='despesa', 
-                    fixed_expense_id=fixed_item.id
+                    fixed_expense_id=fixed_item.id,
+                    occurrence_date=TransactionService.get_safe_date(target_year, target_month, fixed_item.day_of_month),
+                    **ref_fields
                 )
                 account.current_balance -= fixed_item.amount
                 db.session.add(new_trans)
@@ -669,10 +968,10 @@ def toggle_fixed(type_fixed, id):
             Transaction.fixed_revenue_id == fixed_item.id,
             or_(
                 and_(
-                    extract('month', Transaction.date) == target_month,
-                    extract('year', Transaction.date) == target_year
+                    Transaction.date >= month_start,
+                    Transaction.date < month_end
                 ),
-                Transaction.description.like(f"%Ref: {target_month:02d}/{target_year}%")
+                and_(Transaction.ref_year == target_year, Transaction.ref_month == target_month)
             )
         ).first()
         
@@ -689,7 +988,9 @@ def toggle_fixed(type_fixed, id):
                     user_id=current_user.id, category_id=fixed_item.category_id, account_id=fixed_item.account_id,
                     description=fixed_item.description + ref_desc, amount=fixed_item.amount, 
                     date=final_date, type='receita', 
-                    fixed_revenue_id=fixed_item.id
+                    fixed_revenue_id=fixed_item.id,
+                    occurrence_date=TransactionService.get_safe_date(target_year, target_month, fixed_item.day_of_month),
+                    **ref_fields
                 )
                 account.current_balance += fixed_item.amount
                 db.session.add(new_trans)
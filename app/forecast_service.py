@@ -0,0 +1,201 @@
+from datetime import date
+
+import numpy as np
+
+from app import db
+from app.models import FixedExpense, FixedRevenue, MonthlyRollup
+from app.transaction_service import TransactionService
+from app.recurrence_service import RecurrenceService
+from app.installment_service import InstallmentService
+
+# --- PREVISÃO DE FLUXO DE CAIXA ---
+# Projeta, mês a mês a partir do atual, o saldo de cada conta e a fatura de cada
+# cartão. O calendário dos fixos e das parcelas é expandido como matrizes
+# (plano x mês) do NumPy: as datas de cada célula, a vigência e o deslocamento
+# para a fatura seguinte (compra após o fechamento) são operações vetoriais, e as
+# somas por conta/cartão saem de um np.add.at. Como no dashboard, a fatura do mês
+# entra como despesa do próprio mês (saldo_previsao).
+#
+# Ponto de partida: o saldo atual das contas (que já inclui tudo o que foi lançado
+# nelas) e a fatura atual de cada cartão, calculada como no dashboard. Daí em
+# diante somam-se só as ocorrências ainda não gravadas (sem exceção) e, nas faturas
+# futuras, as compras gravadas (tabela monthly_rollups).
+
+MIN_MONTHS = 12
+MAX_MONTHS = 36
+NO_END = np.datetime64('9999-12-31')
+
+class ForecastService:
+
+    @staticmethod
+    def calendar(today, months):
+        """
+        Eixo dos meses: primeiro dia e número de dias de cada mês da previsão, mais
+        um mês extra (compras após o fechamento do último mês caem nele e são descartadas).
+        """
+        first = np.datetime64(f'{today.year}-{today.month:02d}', 'M')
+        axis = np.arange(first, first + months + 1)
+        starts = axis.astype('datetime64[D]')
+        lengths = ((axis + 1).astype('datetime64[D]') - starts).astype(int)
+        return starts, lengths
+
+    @staticmethod
+    def expand(days, starts, lengths):
+        """Data de cada célula (plano x mês): o dia do plano, ajustado ao último dia nos meses curtos."""
+        safe_days = np.minimum(days[:, None], lengths[None, :])
+        return starts[None, :] + (safe_days - 1), safe_days
+
+    @staticmethod
+    def month_index(value, today):
+        return (value.year * 12 + value.month) - (today.year * 12 + today.month)
+
+    @staticmethod
+    def build(user_id, accounts, cards, today, months=MIN_MONTHS):
+        months = min(max(months, MIN_MONTHS), MAX_MONTHS)
+        starts, lengths = ForecastService.calendar(today, months)
+        window_start = today.replace(day=1)
+        window_end = starts[-1].astype(date)
+
+        account_rows = {acc.id: i for i, acc in enumerate(accounts)}
+        card_rows = {card.id: i for i, card in enumerate(cards)}
+        # Linha extra para fixos sem conta: entram nos totais, não em uma conta
+        flows = np.zeros((len(accounts) + 1, months + 1))
+        invoices = np.zeros((len(cards), months + 2))
+        revenues = np.zeros(months + 1)
+        expenses = np.zeros(months + 1)
+
+        # --- FIXOS (receitas, despesas de conta e despesas de cartão) ---
+        plans = [
+            p for p in FixedExpense.query.filter_by(user_id=user_id).all() + FixedRevenue.query.filter_by(user_id=user_id).all()
+            if p.start_date is not None and p.start_date <= window_end and (p.end_date is None or p.end_date >= window_start)
+            and (not isinstance(p, FixedExpense) or not p.card_id or p.card_id in card_rows)
+        ]
+        if plans:
+            occurrences, safe_days = ForecastService.expand(np.array([p.day_of_month for p in plans]), starts, lengths)
+            first_dates = np.array([p.start_date for p in plans], dtype='datetime64[D]')
+            last_dates = np.array([p.end_date or NO_END for p in plans], dtype='datetime64[D]')
+            active = (occurrences >= first_dates[:, None]) & (occurrences <= last_dates[:, None])
+
+            # Exceções (realizadas por uma Transaction ou puladas) não são geradas de novo
+            rows = {}
+            for i, p in enumerate(plans):
+                rows[(p.id, None) if isinstance(p, FixedExpense) else (None, p.id)] = i
+            exceptions = [
+                (rows[(expense_id, revenue_id)], ForecastService.month_index(occurrence_date, today), occurrence_date)
+                for expense_id, revenue_id, occurrence_date in RecurrenceService.get_exceptions(user_id, window_start, window_end)
+                if (expense_id, revenue_id) in rows
+            ]
+            if exceptions:
+                exception_rows, exception_cols, exception_dates = zip(*exceptions)
+                exception_rows, exception_cols = np.array(exception_rows), np.array(exception_cols)
+                # Só conta a exceção que corresponde à data da ocorrência daquele mês
+                matches = occurrences[exception_rows, exception_cols] == np.array(exception_dates, dtype='datetime64[D]')
+                active[exception_rows[matches], exception_cols[matches]] = False
+
+            amounts = np.array([float(p.amount) for p in plans])[:, None] * active
+            is_revenue = np.array([isinstance(p, FixedRevenue) for p in plans])
+            card_ids = [getattr(p, 'card_id', None) for p in plans]
+            is_card = np.array([c is not None for c in card_ids])
+            is_account = ~is_card
+
+            # Contas: receitas somam, despesas subtraem
+            signs = np.where(is_revenue, 1.0, -1.0)[:, None]
+            account_index = np.array([account_rows.get(p.account_id, len(accounts)) for p in plans])
+            np.add.at(flows, account_index[is_account], (amounts * signs)[is_account])
+            revenues += amounts[is_revenue].sum(axis=0)
+            expenses += amounts[is_account & ~is_revenue].sum(axis=0)
+
+            # Cartões: compra após o dia de fechamento vai para a fatura do mês seguinte.
+            # As da fatura atual até hoje já estão no valor do dashboard.
+            if is_card.any():
+                card_index = np.array([card_rows[c] for c in card_ids if c is not None])
+                closing = np.array([cards[i].closing_day for i in card_index])
+                invoice_cols = np.arange(months + 1)[None, :] + (safe_days[is_card] > closing[:, None])
+                card_amounts = np.where((invoice_cols == 0) & (occurrences[is_card] <= np.datetime64(today)), 0, amounts[is_card])
+                np.add.at(invoices, (np.broadcast_to(card_index[:, None], invoice_cols.shape), invoice_cols), card_amounts)
+
+        # --- PARCELAS ---
+        installment_plans = InstallmentService.get_plans(user_id, card_rows.keys(), window_start, window_end)
+        if installment_plans:
+            count = np.array([p.installment_count for p in installment_plans])
+            first = np.array([ForecastService.month_index(p.first_date, today) for p in installment_plans])
+            number = np.arange(months + 1)[None, :] - first[:, None]
+            active = (number >= 0) & (number < count[:, None])
+
+            stored, skipped = InstallmentService.get_exceptions(installment_plans)
+            by_identifier = {p.identifier: i for i, p in enumerate(installment_plans)}
+            by_id = {p.id: i for i, p in enumerate(installment_plans)}
+            exceptions = [(by_identifier[identifier], first[by_identifier[identifier]] + n - 1) for identifier, n in stored]
+            exceptions += [(by_id[plan_id], ForecastService.month_index(d, today)) for plan_id, d in skipped]
+            exceptions = [(row, col) for row, col in exceptions if 0 <= col <= months]
+            if exceptions:
+                exception_rows, exception_cols = np.array(exceptions).T
+                active[exception_rows, exception_cols] = False
+
+            # Mesma divisão de InstallmentService.amounts, em centavos: a sobra vai na última
+            total = np.array([int(p.total_amount * 100) for p in installment_plans])
+            base = total // count
+            last = total - base * (count - 1)
+            amounts = np.where(number == count[:, None] - 1, last[:, None], base[:, None]) * active / 100
+
+            _, safe_days = ForecastService.expand(np.array([p.first_date.day for p in installment_plans]), starts, lengths)
+            card_index = np.array([card_rows[p.card_id] for p in installment_plans])
+            closing = np.array([cards[i].closing_day for i in card_index])
+            invoice_cols = np.arange(months + 1)[None, :] + (safe_days > closing[:, None])
+            # A fatura atual do dashboard já soma todas as parcelas virtuais dela
+            amounts = np.where(invoice_cols == 0, 0, amounts)
+            np.add.at(invoices, (np.broadcast_to(card_index[:, None], invoice_cols.shape), invoice_cols), amounts)
+
+        # --- FATURAS: atual (como no dashboard) e compras gravadas das futuras ---
+        if cards:
+            for stats in TransactionService.get_all_card_stats(user_id, today.month, today.year, cards):
+                invoices[card_rows[stats['obj'].id], 0] += float(stats['invoice_amount'])
+
+            base_index = today.year * 12 + today.month
+            period = MonthlyRollup.year * 12 + MonthlyRollup.month
+            stored = db.session.query(
+                MonthlyRollup.card_id, period, db.func.sum(MonthlyRollup.total)
+            ).filter(
+                MonthlyRollup.user_id == user_id,
+                MonthlyRollup.card_id.in_(list(card_rows.keys())),
+                MonthlyRollup.type == 'despesa',
+                MonthlyRollup.is_payment == False,
+                period > base_index,
+                period <= base_index + months
+            ).group_by(MonthlyRollup.card_id, period).all()
+            if stored:
+                card_ids, periods, totals = zip(*stored)
+                np.add.at(invoices, ([card_rows[c] for c in card_ids], np.array(periods) - base_index), [float(t) for t in totals])
+
+        invoices = invoices[:, :months]
+        flows, revenues, expenses = flows[:, :months], revenues[:months], expenses[:months]
+        invoice_totals = invoices.sum(axis=0)
+
+        opening = np.array([float(acc.current_balance or 0) for acc in accounts])
+        balances = opening[:, None] + np.cumsum(flows[:len(accounts)], axis=1)
+        net = revenues - expenses - invoice_totals
+        total_balance = opening.sum() + np.cumsum(net)
+
+        labels = [str(m) for m in starts[:months].astype('datetime64[M]')]
+        return {
+            'months': labels,
+            'accounts': [
+                {'id': acc.id, 'name': acc.name, 'balance': ForecastService.to_list(balances[i])}
+                for i, acc in enumerate(accounts)
+            ],
+            'cards': [
+                {'id': card.id, 'name': card.name, 'invoices': ForecastService.to_list(invoices[i])}
+                for i, card in enumerate(cards)
+            ],
+            'totals': {
+                'revenues': ForecastService.to_list(revenues),
+                'expenses': ForecastService.to_list(expenses),
+                'invoices': ForecastService.to_list(invoice_totals),
+                'net': ForecastService.to_list(net),
+                'balance': ForecastService.to_list(total_balance)
+            }
+        }
+
+    @staticmethod
+    def to_list(values):
+        return [round(float(v), 2) for v in np.round(values, 2)]
@@ -0,0 +1,42 @@
+import os
+import multiprocessing
+
+# --- PERFIL DO GUNICORN ---
+# Lido pelo entrypoint.sh (gunicorn --config gunicorn.conf.py run:app).
+# Todos os valores podem ser sobrescritos por variáveis de ambiente.
+
+# Usar apenas [::]:5000 habilita Dual-Stack (IPv4 e IPv6) automaticamente no Linux
+bind = os.environ.get('GUNICORN_BIND', '[::]:5000')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+# 'gthread': cada worker atende GUNICORN_THREADS requisições ao mesmo tempo, então
+# uma espera de I/O (MySQL, SMTP) não bloqueia o processo inteiro. 'sync': um por vez.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) if worker_class == 'gthread' else 1
+
+# Padrão: (2 x CPUs) + 1 para sync; com threads, um worker por CPU (mínimo 2) já basta
+cpus = multiprocessing.cpu_count()
+default_workers = max(2, cpus) if worker_class == 'gthread' else cpus * 2 + 1
+workers = int(os.environ.get('GUNICORN_WORKERS', default_workers))
+
+# Carrega o app uma vez no master e faz fork dos workers (menos memória, boot mais rápido)
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+def post_fork(server, worker):
+    """
+    Conexões abertas pelo master (preload) não podem ser compartilhadas entre
+    processos: cada worker descarta o pool herdado sem fechá-lo (close=False,
+    para não derrubar o socket que o master ainda usa) e abre o seu.
+    """
+    from run import app
+    from app import db
+    from app.scheduler import start_scheduler
+    from app.email_outbox import start_email_sender
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    # Threads não sobrevivem ao fork: agendador e sender de e-mails sobem em cada worker
+    start_scheduler(app)
+    start_email_sender(app)
@@ -0,0 +1,286 @@
+import io
+import re
+import csv
+import codecs
+import hashlib
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app
+
+from app import db
+from app.models import Transaction, BankAccount, Category
+from app.transaction_service import TransactionService
+
+# --- IMPORTAÇÃO DE EXTRATOS ---
+# O arquivo (CSV ou OFX) é lido como fluxo, linha a linha ou bloco a bloco, sem
+# carregá-lo inteiro: cada lançamento vira um dicionário de colunas e entra num
+# lote, gravado com TransactionService.bulk_insert a cada IMPORT_BATCH_SIZE. Antes
+# de gravar, o lote é comparado numa única consulta (índice user_id + import_hash)
+# com o que já foi importado. O saldo das contas é ajustado uma vez, no final.
+
+CENT = Decimal('0.01')
+SNIFF_BYTES = 64 * 1024
+OFX_CHUNK = 64 * 1024
+
+# Cabeçalhos aceitos no CSV (minúsculos e sem acento)
+CSV_COLUMNS = {
+    'date': ('data', 'date', 'data lancamento', 'data do lancamento', 'data movimento', 'dt'),
+    'description': ('descricao', 'description', 'historico', 'lancamento', 'estabelecimento', 'memo'),
+    'amount': ('valor', 'amount', 'valor (r$)', 'valor r$', 'quantia'),
+    'credit': ('credito', 'entrada', 'credit'),
+    'debit': ('debito', 'saida', 'debit'),
+    'category': ('categoria', 'category'),
+    'account': ('conta', 'account'),
+}
+DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y')
+# Linhas de saldo que alguns bancos intercalam no extrato
+BALANCE_LINES = ('SALDO ANTERIOR', 'SALDO DO DIA', 'SALDO FINAL', 'SALDO EM ', 'SALDO DISPONIVEL', 'SALDO TOTAL')
+
+OFX_TRANSACTION = re.compile(r'<STMTTRN>(.*?)</STMTTRN>', re.S | re.I)
+OFX_START = re.compile(r'<STMTTRN>', re.I)
+OFX_FIELD = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+ImportResult = namedtuple('ImportResult', 'inserted duplicates skipped before_start')
+
+class StatementError(ValueError):
+    pass
+
+class ImportService:
+
+    # --- LEITURA ---
+
+    @staticmethod
+    def normalize(text):
+        """Maiúsculas, sem acentos e com espaços simples (descrições e cabeçalhos)."""
+        if not text:
+            return ''
+        if not text.isascii():
+            text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+        return ' '.join(text.upper().split())
+
+    @staticmethod
+    def parse_amount(value):
+        """Valores como '1.234,56', '-50,00', '(50.00)', 'R$ 10,00 D'. None se não for um valor."""
+        value = (value or '').strip().upper().replace('R$', '').replace(' ', '')
+        if not value:
+            return None
+        negative = value.startswith('-') or value.endswith('-') or value.endswith('D') or (value.startswith('(') and value.endswith(')'))
+        value = value.strip('-+()CD')
+        # O último separador é o decimal
+        if ',' in value and value.rfind(',') > value.rfind('.'):
+            value = value.replace('.', '').replace(',', '.')
+        else:
+            value = value.replace(',', '')
+        try:
+            amount = Decimal(value).quantize(CENT)
+        except InvalidOperation:
+            return None
+        return -amount if negative else amount
+
+    @staticmethod
+    def parse_date(value):
+        value = (value or '').strip()[:10]
+        for fmt in DATE_FORMATS:
+            try:
+                return datetime.strptime(value, fmt).date()
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def open_text(stream):
+        """
+        Texto do arquivo enviado, decodificado sob demanda. A codificação sai do início
+        do arquivo: UTF-8 se ele for válido, senão Windows-1252 (comum nos extratos).
+        """
+        head = stream.read(SNIFF_BYTES)
+        stream.seek(0)
+        try:
+            # Um caractere multibyte cortado no fim da amostra não conta como erro
+            codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+            encoding = 'utf-8-sig'
+        except UnicodeDecodeError:
+            encoding = 'cp1252'
+        return io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline=''), head
+
+    @staticmethod
+    def read_csv(text):
+        """Lançamentos do CSV: dicionários com date, amount, description, category, account e fitid (vazio)."""
+        sample = text.read(SNIFF_BYTES)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample.split('\n', 1)[0], delimiters=';,\t|')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(text, dialect)
+
+        header = [ImportService.normalize(h).lower() for h in next(reader, [])]
+        columns = {}
+        for field, names in CSV_COLUMNS.items():
+            for i, name in enumerate(header):
+                if name in names and field not in columns:
+                    columns[field] = i
+        if 'date' not in columns or 'description' not in columns or not ('amount' in columns or 'credit' in columns or 'debit' in columns):
+            raise StatementError('CSV sem as colunas de data, descrição e valor.')
+
+        def cell(row, field):
+            i = columns.get(field)
+            return row[i] if i is not None and i < len(row) else ''
+
+        for row in reader:
+            if not any(row):
+                continue
+            if 'amount' in columns:
+                amount = ImportService.parse_amount(cell(row, 'amount'))
+            else:
+                credit = ImportService.parse_amount(cell(row, 'credit')) or Decimal('0')
+                debit = ImportService.parse_amount(cell(row, 'debit')) or Decimal('0')
+                amount = abs(credit) - abs(debit)
+            yield {
+                'date': ImportService.parse_date(cell(row, 'date')),
+                'amount': amount,
+                'description': cell(row, 'description').strip(),
+                'category': cell(row, 'category').strip(),
+                'account': cell(row, 'account').strip(),
+                'fitid': '',
+            }
+
+    @staticmethod
+    def read_ofx(text):
+        """Lançamentos do OFX (SGML ou XML), bloco <STMTTRN> a bloco, lendo o arquivo em pedaços."""
+        buffer = ''
+        while True:
+            chunk = text.read(OFX_CHUNK)
+            buffer += chunk
+            end = 0
+            for match in OFX_TRANSACTION.finditer(buffer):
+                fields = {name.upper(): value.strip() for name, value in OFX_FIELD.findall(match.group(1))}
+                posted = fields.get('DTPOSTED', '')
+                yield {
+                    # DTPOSTED: AAAAMMDD, às vezes seguido de hora e fuso
+                    'date': ImportService.parse_date(f"{posted[:4]}-{posted[4:6]}-{posted[6:8]}"),
+                    'amount': ImportService.parse_amount(fields.get('TRNAMT')),
+                    'description': fields.get('MEMO') or fields.get('NAME') or '',
+                    'category': '',
+                    'account': '',
+                    # Identificador do lançamento dado pelo banco, estável entre downloads
+                    'fitid': fields.get('FITID', ''),
+                }
+                end = match.end()
+            # Só fica no buffer o começo de um bloco cortado pelo pedaço
+            buffer = buffer[end:]
+            start = OFX_START.search(buffer)
+            buffer = buffer[start.start():] if start else buffer[-len('<STMTTRN>'):]
+            if not chunk:
+                break
+
+    @staticmethod
+    def read_statement(file):
+        text, head = ImportService.open_text(file.stream)
+        is_ofx = file.filename.lower().endswith(('.ofx', '.qfx')) or b'OFXHEADER' in head[:512] or b'<OFX>' in head.upper()
+        return ImportService.read_ofx(text) if is_ofx else ImportService.read_csv(text)
+
+    # --- GRAVAÇÃO ---
+
+    @staticmethod
+    def content_key(account_id, entry_date, amount, description):
+        """Conteúdo que identifica o lançamento: data, valor (com sinal), descrição normalizada e conta."""
+        return f"{account_id}|{entry_date.isoformat()}|{amount}|{description}"
+
+    @staticmethod
+    def fitid_key(account_id, fitid):
+        """No OFX, o FITID identifica o lançamento mesmo se o banco mudar a descrição ou a data."""
+        return f"{account_id}|FITID|{fitid}"
+
+    @staticmethod
+    def content_hash(key, repeat):
+        """
+        `repeat` diferencia lançamentos idênticos no mesmo arquivo (dois cafés iguais
+        no mesmo dia): o segundo só é descartado se já houver dois importados.
+        """
+        return hashlib.sha256(f"{key}|{repeat}".encode()).hexdigest()
+
+    @staticmethod
+    def import_statement(user_id, file, account, expense_category_id, revenue_category_id, start_date=None):
+        """
+        Importa o extrato para a conta (ou para a conta citada na coluna 'conta' do
+        CSV). Categorias citadas na coluna 'categoria' são usadas se existirem;
+        senão, as categorias padrão de despesa e de receita. Lançamentos de meses
+        anteriores ao start_date do usuário são descartados, como nos lançamentos
+        manuais. Sem commit.
+        """
+        batch_size = current_app.config['IMPORT_BATCH_SIZE']
+        accounts = {ImportService.normalize(a.name): a.id for a in BankAccount.query.filter_by(user_id=user_id).all()}
+        categories = {
+            (ImportService.normalize(c.name), c.type): c.id
+            for c in Category.query.filter(Category.user_id == user_id, Category.type.in_(['despesa', 'receita'])).all()
+        }
+
+        repeats = {}
+        balances = {}
+        start_month = start_date.replace(day=1) if start_date else None
+        inserted = duplicates = skipped = before_start = 0
+        batch = []
+
+        def flush(batch):
+            hashes = [row['import_hash'] for row in batch]
+            existing = {h for (h,) in db.session.query(Transaction.import_hash).filter(
+                Transaction.user_id == user_id,
+                Transaction.import_hash.in_(hashes)
+            )}
+            rows = [row for row in batch if row['import_hash'] not in existing]
+            TransactionService.bulk_insert(rows)
+            for row in rows:
+                delta = row['amount'] if row['type'] == 'receita' else -row['amount']
+                balances[row['account_id']] = balances.get(row['account_id'], Decimal('0')) + delta
+            return len(rows), len(batch) - len(rows)
+
+        for entry in ImportService.read_statement(file):
+            description = ImportService.normalize(entry['description'])
+            if entry['date'] is None or not entry['amount'] or not description or description.startswith(BALANCE_LINES):
+                skipped += 1
+                continue
+            if start_month and entry['date'] < start_month:
+                before_start += 1
+                continue
+
+            account_id = accounts.get(ImportService.normalize(entry['account']), account.id)
+            trans_type = 'receita' if entry['amount'] > 0 else 'despesa'
+            default_category = revenue_category_id if trans_type == 'receita' else expense_category_id
+
+            # Contagem dos repetidos pelo digest da chave (16 bytes por lançamento distinto)
+            if entry['fitid']:
+                key = ImportService.fitid_key(account_id, entry['fitid'])
+            else:
+                key = ImportService.content_key(account_id, entry['date'], entry['amount'], description)
+            digest = hashlib.md5(key.encode()).digest()
+            repeat = repeats[digest] = repeats.get(digest, 0) + 1
+
+            batch.append({
+                'user_id': user_id,
+                'description': entry['description'][:200],
+                'amount': abs(entry['amount']),
+                'date': entry['date'],
+                'type': trans_type,
+                'account_id': account_id,
+                'category_id': categories.get((ImportService.normalize(entry['category']), trans_type), default_category),
+                'import_hash': ImportService.content_hash(key, repeat),
+            })
+            if len(batch) >= batch_size:
+                new, repeated = flush(batch)
+                inserted, duplicates, batch = inserted + new, duplicates + repeated, []
+
+        if batch:
+            new, repeated = flush(batch)
+            inserted, duplicates = inserted + new, duplicates + repeated
+
+        # Saldo das contas: um ajuste por conta, no final
+        for account_id, delta in balances.items():
+            if delta:
+                BankAccount.query.filter_by(id=account_id).update(
+                    {BankAccount.current_balance: BankAccount.current_balance + delta}, synchronize_session=False
+                )
+        return ImportResult(inserted, duplicates, skipped, before_start)
@@ -0,0 +1,411 @@
+import calendar
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, ROUND_DOWN
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, func, case, and_, or_, union_all
+
+from app import db
+from app.models import Transaction, InstallmentPlan, FixedSkip
+from app.transaction_service import TransactionService
+from app.recurrence_service import RecurrenceService
+
+# --- COMPRAS PARCELADAS ---
+# Uma compra em N vezes é uma linha em installment_plans (total, quantidade, primeiro
+# vencimento, cartão e categoria); as parcelas são derivadas do plano na hora da
+# consulta. Como nos fixos (recurrence_service), só as exceções ficam gravadas: a
+# parcela antecipada ou editada vira uma Transaction com o installment_identifier
+# do plano e o número da parcela, e a excluída vira um registro em fixed_skips.
+
+CENT = Decimal('0.01')
+
+# Compra com parcelas futuras, no formato que a API de antecipação devolve
+FutureGroup = namedtuple('FutureGroup', 'identifier description count total_remaining next_date')
+
+class Installment:
+    """Parcela virtual de um plano, com os atributos de Transaction lidos por dashboard, faturas e templates."""
+    is_virtual = True
+    endpoint = 'installment'
+    id = None
+    type = 'despesa'
+    account_id = None
+    account = None
+    fixed_expense_id = None
+    fixed_revenue_id = None
+    occurrence_date = None
+    ref_year = None
+    ref_month = None
+    is_invoice_payment = False
+
+    def __init__(self, plan, number, installment_date, amount):
+        self.plan = plan
+        self.user_id = plan.user_id
+        self.description = f"{plan.description} ({number}/{plan.installment_count})"
+        self.amount = amount
+        self.date = installment_date
+        self.category_id = plan.category_id
+        self.card_id = plan.card_id
+        self.installment_identifier = plan.identifier
+        self.installment_current = number
+        self.installment_total = plan.installment_count
+        self.is_anticipated = plan.is_anticipated
+        self.created_at = plan.created_at or datetime.combine(installment_date, time.min)
+
+    @property
+    def key(self):
+        return (self.installment_identifier, self.installment_current)
+
+    @property
+    def advance_key(self):
+        """Valor do checkbox da antecipação (as parcelas gravadas usam o id)."""
+        return f"{self.plan.id}:{self.installment_current}"
+
+    @property
+    def url_args(self):
+        return {'plan_id': self.plan.id, 'number': self.installment_current}
+
+    @property
+    def category(self):
+        return self.plan.category
+
+    @property
+    def card(self):
+        return self.plan.card
+
+
+class InstallmentService:
+
+    @staticmethod
+    def amounts(plan):
+        """Valor de cada parcela: o total dividido em centavos, com a sobra na última."""
+        total = Decimal(str(plan.total_amount))
+        count = plan.installment_count
+        base = (total / count).quantize(CENT, rounding=ROUND_DOWN)
+        return [base] * (count - 1) + [total - base * (count - 1)]
+
+    @staticmethod
+    def schedule(plan):
+        """(número, vencimento, valor) de todas as parcelas do plano."""
+        dates = TransactionService.monthly_dates(plan.first_date, plan.first_date.day, plan.installment_count)
+        return [(i + 1, d, amount) for i, (d, amount) in enumerate(zip(dates, InstallmentService.amounts(plan)))]
+
+    @staticmethod
+    def get_exceptions(plans):
+        """
+        Parcelas que não devem ser geradas: as gravadas como Transaction, no formato
+        de Installment.key, e as puladas, como (plan_id, vencimento).
+        """
+        if not plans:
+            return set(), set()
+        stored = db.session.query(Transaction.installment_identifier, Transaction.installment_current).filter(
+            Transaction.installment_identifier.in_([p.identifier for p in plans])
+        ).all()
+        skipped = db.session.query(FixedSkip.installment_plan_id, FixedSkip.occurrence_date).filter(
+            FixedSkip.installment_plan_id.in_([p.id for p in plans])
+        ).all()
+        return {tuple(row) for row in stored}, {tuple(row) for row in skipped}
+
+    @staticmethod
+    def iter_schedule(plans, start=None, end=None):
+        """(plano, número, vencimento, valor) das parcelas sem exceção gravada em [start, end]."""
+        stored, skipped = InstallmentService.get_exceptions(plans)
+        for plan in plans:
+            for number, installment_date, amount in InstallmentService.schedule(plan):
+                if (start and installment_date < start) or (end and installment_date > end):
+                    continue
+                if (plan.identifier, number) in stored or (plan.id, installment_date) in skipped:
+                    continue
+                yield plan, number, installment_date, amount
+
+    @staticmethod
+    def get_installments(plans, start=None, end=None):
+        """Parcelas virtuais (sem exceção gravada) dos planos em [start, end], ordenadas pelo vencimento."""
+        installments = [Installment(*item) for item in InstallmentService.iter_schedule(plans, start, end)]
+        installments.sort(key=lambda i: i.date)
+        return installments
+
+    @staticmethod
+    def get_plans(user_id, card_ids=None, start=None, end=None):
+        """Planos do usuário com alguma parcela em [start, end]."""
+        query = InstallmentPlan.query.filter(InstallmentPlan.user_id == user_id)
+        if card_ids is not None:
+            if not card_ids:
+                return []
+            query = query.filter(InstallmentPlan.card_id.in_(list(card_ids)))
+        if start is not None:
+            query = query.filter(InstallmentPlan.last_date >= start)
+        if end is not None:
+            query = query.filter(InstallmentPlan.first_date <= end)
+        return query.order_by(InstallmentPlan.id).all()
+
+    # --- JUNÇÃO COM AS TRANSAÇÕES GRAVADAS ---
+
+    @staticmethod
+    def get_invoice_installments(user_id, cards, year, month):
+        """Parcelas virtuais que caem na fatura (year, month), com invoice_year/invoice_month preenchidos."""
+        closing_days = {c.id: c.closing_day for c in cards}
+        month_start, month_end = TransactionService.get_month_range(year, month)
+        window_start = month_start - relativedelta(months=1)
+        plans = InstallmentService.get_plans(user_id, closing_days.keys(), window_start, month_end)
+
+        installments = []
+        for installment in InstallmentService.get_installments(plans, window_start, month_end):
+            invoice = TransactionService.get_invoice_month(closing_days[installment.card_id], installment.date)
+            if invoice == (year, month):
+                installment.invoice_year, installment.invoice_month = invoice
+                installments.append(installment)
+        return installments
+
+    @staticmethod
+    def get_card_totals(user_id, invoice_dates, snapshots):
+        """
+        Somas das parcelas virtuais de cada cartão nas três faixas de
+        _build_cards_stats ({card_id: [antes da abertura, dentro da fatura, total]}).
+        Como as parcelas gravadas, as futuras também ocupam o limite; o que já está
+        num snapshot não é somado de novo.
+        """
+        totals = {}
+
+        def add(card_id, installment_date, amount):
+            open_date, close_date, _ = invoice_dates[card_id]
+            sums = totals.setdefault(card_id, [Decimal('0')] * 3)
+            if installment_date < open_date:
+                sums[0] += amount
+            elif installment_date <= close_date:
+                sums[1] += amount
+            sums[2] += amount
+
+        # Janela de cada cartão: com snapshot, só os planos que passam do fechamento dele.
+        # Sem snapshot, os planos já encerrados antes da abertura da fatura e sem exceções
+        # entram pela soma do total no banco; só os demais têm o calendário percorrido
+        pending = {cid: dates[0] for cid, dates in invoice_dates.items() if cid not in snapshots}
+        windows = [
+            and_(InstallmentPlan.card_id == cid, InstallmentPlan.last_date > snapshot.close_date)
+            for cid, snapshot in snapshots.items() if cid in invoice_dates
+        ]
+        if pending:
+            settled = and_(
+                InstallmentPlan.card_id.in_(list(pending)),
+                InstallmentPlan.last_date < case(pending, value=InstallmentPlan.card_id)
+            )
+            has_exceptions = or_(
+                InstallmentPlan.identifier.in_(select(Transaction.installment_identifier).where(
+                    Transaction.card_id.in_(list(pending)), Transaction.installment_identifier.isnot(None))),
+                InstallmentPlan.id.in_(select(FixedSkip.installment_plan_id).where(
+                    FixedSkip.user_id == user_id, FixedSkip.installment_plan_id.isnot(None)))
+            )
+            windows.append(and_(InstallmentPlan.card_id.in_(list(pending)), or_(~settled, has_exceptions)))
+
+            settled_totals = db.session.query(InstallmentPlan.card_id, func.sum(InstallmentPlan.total_amount)) \
+                .filter(InstallmentPlan.user_id == user_id, settled, ~has_exceptions) \
+                .group_by(InstallmentPlan.card_id).all()
+            for card_id, total in settled_totals:
+                # Todas as parcelas antes da abertura da fatura
+                add(card_id, pending[card_id] - timedelta(days=1), Decimal(str(total)))
+        if not windows:
+            return totals
+
+        plans = InstallmentPlan.query.filter(InstallmentPlan.user_id == user_id, or_(*windows)).order_by(InstallmentPlan.id).all()
+        # Só as somas interessam: percorre o calendário sem montar as parcelas
+        for plan, _, installment_date, amount in InstallmentService.iter_schedule(plans):
+            snapshot = snapshots.get(plan.card_id)
+            if snapshot and installment_date <= snapshot.close_date:
+                continue
+            add(plan.card_id, installment_date, amount)
+        return totals
+
+    @staticmethod
+    def date_key(year, month, day):
+        """Chave inteira que ordena como a data (mês absoluto * 100 + dia); aceita colunas ou valores."""
+        return (year * 12 + month - 1) * 100 + day
+
+    @staticmethod
+    def next_date_key(today):
+        """
+        Chave (date_key) do próximo vencimento virtual de cada plano em aberto, em SQL:
+        a parcela do mês de hoje, se ainda não venceu, senão a do mês seguinte, no
+        dia do primeiro vencimento ajustado ao tamanho do mês. Não considera exceções.
+        """
+        first = InstallmentPlan.first_date
+        first_year, first_month, day = func.extract('year', first), func.extract('month', first), func.extract('day', first)
+        following = today.replace(day=1) + relativedelta(months=1)
+
+        def clamped(month_start):
+            days = calendar.monthrange(month_start.year, month_start.month)[1]
+            return InstallmentService.date_key(month_start.year, month_start.month, case((day > days, days), else_=day))
+
+        this_month = clamped(today)
+        return case(
+            (InstallmentService.date_key(first_year, first_month, day) > InstallmentService.date_key(today.year, today.month, today.day),
+             InstallmentService.date_key(first_year, first_month, day)),
+            (this_month > InstallmentService.date_key(today.year, today.month, today.day), this_month),
+            else_=clamped(following)
+        )
+
+    @staticmethod
+    def get_future_groups(user_id, card_id, page, per_page):
+        """
+        Compras do cartão com parcelas futuras (virtuais e gravadas), uma por
+        compra, com a quantidade e a soma das parcelas restantes, ordenadas pelo
+        próximo vencimento e paginadas no banco; só as compras da página são
+        calculadas. Retorna (grupos da página, se há mais).
+        """
+        today = date.today()
+        open_plans = and_(InstallmentPlan.user_id == user_id, InstallmentPlan.card_id == card_id, InstallmentPlan.last_date > today)
+        group_key = func.coalesce(Transaction.installment_identifier, Transaction.description)
+
+        # Planos com exceções (parcelas gravadas ou puladas): o próximo vencimento
+        # virtual sai do calendário deles, em Python, e entra na consulta por CASE
+        with_exceptions = InstallmentPlan.query.filter(open_plans, or_(
+            InstallmentPlan.identifier.in_(select(Transaction.installment_identifier).where(
+                Transaction.card_id == card_id, Transaction.installment_identifier.isnot(None))),
+            InstallmentPlan.id.in_(select(FixedSkip.installment_plan_id).where(
+                FixedSkip.user_id == user_id, FixedSkip.installment_plan_id.isnot(None)))
+        )).all()
+        overrides = {plan.id: None for plan in with_exceptions}
+        for installment in InstallmentService.get_installments(with_exceptions, today + timedelta(days=1)):
+            if overrides[installment.plan.id] is None:
+                d = installment.date
+                overrides[installment.plan.id] = InstallmentService.date_key(d.year, d.month, d.day)
+        virtual_key = InstallmentService.next_date_key(today)
+        if overrides:
+            virtual_key = case(overrides, value=InstallmentPlan.id, else_=virtual_key)
+
+        stored_date = Transaction.date
+        next_keys = union_all(
+            select(InstallmentPlan.identifier.label('identifier'), virtual_key.label('next_key')).where(open_plans),
+            # Parcelas gravadas: exceções dos planos e compras anteriores aos planos
+            select(group_key.label('identifier'), func.min(InstallmentService.date_key(
+                func.extract('year', stored_date), func.extract('month', stored_date), func.extract('day', stored_date)
+            )).label('next_key')).where(TransactionService.future_installments_filter(user_id, card_id)).group_by(group_key)
+        ).subquery()
+        next_key = func.min(next_keys.c.next_key)
+        # Um plano com todas as parcelas futuras antecipadas (sem vencimento) não aparece
+        keys = db.session.execute(
+            select(next_keys.c.identifier).group_by(next_keys.c.identifier).having(next_key.isnot(None))
+            .order_by(next_key, next_keys.c.identifier)
+            .offset((page - 1) * per_page).limit(per_page + 1)
+        ).scalars().all()
+        has_more = len(keys) > per_page
+        keys = keys[:per_page]
+        if not keys:
+            return [], has_more
+
+        groups = {}
+
+        def add(key, description, amount, installment_date):
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [description, 1, amount, installment_date]
+            else:
+                group[1] += 1
+                group[2] += amount
+                group[3] = min(group[3], installment_date)
+
+        plans = InstallmentPlan.query.filter(open_plans, InstallmentPlan.identifier.in_(keys)).all()
+        for installment in InstallmentService.get_installments(plans, today + timedelta(days=1)):
+            add(installment.installment_identifier, installment.description, installment.amount, installment.date)
+        stored = Transaction.query.filter(TransactionService.future_installments_filter(user_id, card_id), group_key.in_(keys))
+        for trans in stored.all():
+            add(trans.installment_identifier or trans.description, trans.description, Decimal(str(trans.amount)), trans.date)
+
+        return [FutureGroup(key, *groups[key]) for key in keys if key in groups], has_more
+
+    @staticmethod
+    def get_future_items(user_id, card_id, identifier):
+        """Parcelas futuras (gravadas e virtuais) de uma compra de get_future_groups."""
+        today = date.today()
+        items = TransactionService.get_future_installment_items(user_id, card_id, identifier)
+        plan = InstallmentPlan.query.filter_by(user_id=user_id, card_id=card_id, identifier=identifier).first()
+        if plan:
+            items += InstallmentService.get_installments([plan], today + timedelta(days=1))
+        items.sort(key=lambda t: t.date)
+        return items
+
+    # --- PLANOS E EXCEÇÕES ---
+
+    @staticmethod
+    def create_plan(user_id, identifier, description, total_amount, installment_count, first_date, card_id, category_id, is_anticipated=False):
+        """Grava a compra parcelada (uma linha, sem as parcelas). Sem commit."""
+        plan = InstallmentPlan(
+            user_id=user_id, identifier=identifier, description=description,
+            total_amount=total_amount, installment_count=installment_count,
+            first_date=first_date, card_id=card_id, category_id=category_id,
+            is_anticipated=is_anticipated
+        )
+        plan.last_date = InstallmentService.schedule(plan)[-1][1]
+        db.session.add(plan)
+        # Compra lançada com vencimento no passado muda faturas já fechadas
+        RecurrenceService.invalidate_snapshots(card_id, first_date)
+        return plan
+
+    @staticmethod
+    def get_installment(user_id, plan_id, number):
+        """(plano, vencimento, valor) de uma parcela ainda virtual; None se não existir ou já tiver exceção."""
+        plan = InstallmentPlan.query.filter_by(id=plan_id, user_id=user_id).first()
+        if plan is None or not 1 <= number <= plan.installment_count:
+            return None
+        _, installment_date, amount = InstallmentService.schedule(plan)[number - 1]
+        stored, skipped = InstallmentService.get_exceptions([plan])
+        if (plan.identifier, number) in stored or (plan.id, installment_date) in skipped:
+            return None
+        return plan, installment_date, amount
+
+    @staticmethod
+    def row(plan, number, installment_date, amount, **fields):
+        """Colunas da Transaction que grava a parcela como exceção."""
+        values = dict(
+            user_id=plan.user_id, description=f"{plan.description} ({number}/{plan.installment_count})",
+            amount=amount, date=installment_date, type='despesa',
+            category_id=plan.category_id, card_id=plan.card_id,
+            installment_total=plan.installment_count, installment_current=number,
+            installment_identifier=plan.identifier, is_anticipated=plan.is_anticipated
+        )
+        values.update(fields)
+        return values
+
+    @staticmethod
+    def advance(user_id, keys, target_date):
+        """
+        Antecipa parcelas virtuais ('plan_id:número', como em Installment.advance_key)
+        para target_date, gravando-as num único INSERT. Sem commit. Retorna a quantidade.
+        """
+        wanted = {}
+        for key in keys:
+            plan_id, _, number = str(key).partition(':')
+            if plan_id.isdigit() and number.isdigit():
+                wanted.setdefault(int(plan_id), set()).add(int(number))
+        if not wanted:
+            return 0
+
+        plans = InstallmentPlan.query.filter(InstallmentPlan.user_id == user_id, InstallmentPlan.id.in_(list(wanted))).all()
+        rows = []
+        for installment in InstallmentService.get_installments(plans, target_date + timedelta(days=1)):
+            if installment.installment_current in wanted[installment.plan.id]:
+                rows.append(InstallmentService.row(
+                    installment.plan, installment.installment_current, target_date, installment.amount,
+                    description=f"{installment.description} (Antecipado)", is_anticipated=True
+                ))
+        return TransactionService.bulk_insert(rows)
+
+    @staticmethod
+    def skip(plan, installment_date):
+        """Exclui uma parcela. Sem commit."""
+        db.session.add(FixedSkip(user_id=plan.user_id, installment_plan_id=plan.id, occurrence_date=installment_date))
+        RecurrenceService.invalidate_snapshots(plan.card_id, installment_date)
+
+    @staticmethod
+    def get_plan_for(trans):
+        """Plano da parcela gravada e o vencimento original dela (None se não for de um plano)."""
+        if not trans.installment_identifier or not trans.installment_current:
+            return None, None
+        plan = InstallmentPlan.query.filter_by(user_id=trans.user_id, identifier=trans.installment_identifier).first()
+        if plan is None or trans.installment_current > plan.installment_count:
+            return None, None
+        return plan, InstallmentService.schedule(plan)[trans.installment_current - 1][1]
+
+    @staticmethod
+    def get_last_date(user_id):
+        """Último vencimento entre as compras parceladas do usuário (navegação do dashboard)."""
+        return db.session.query(db.func.max(InstallmentPlan.last_date)).filter(InstallmentPlan.user_id == user_id).scalar()
@@ -0,0 +1,201 @@
+from app import db
+from app.models import Transaction, CreditCard, InvoiceSnapshot
+from app.transaction_service import TransactionService
+from app.recurrence_service import RecurrenceService
+from app.installment_service import InstallmentService
+from sqlalchemy import event, inspect, func, delete, update
+from sqlalchemy.orm import Session
+from dateutil.relativedelta import relativedelta
+from datetime import date, timedelta
+from decimal import Decimal
+
+# Um lançamento na data D pode alterar os acumulados das faturas fechadas a partir de D
+# e o "pago após o fechamento" das faturas que fecharam até ~45 dias antes de D
+# (vencimento + 10 dias de tolerância usados em has_invoice_payment).
+INVALIDATION_WINDOW = timedelta(days=45)
+PAYMENT_TOLERANCE = timedelta(days=10)
+
+# Atributos da Transaction que alteram os saldos de fatura
+SNAPSHOT_FIELDS = ('card_id', 'date', 'amount', 'type')
+
+class InvoiceSnapshotService:
+    """
+    Mantém a tabela invoice_snapshots: o saldo de cada cartão no fechamento de
+    cada fatura. Com ela o rollover de get_card_stats vira "último snapshot +
+    movimento desde então", em vez de somar todo o histórico do cartão.
+    """
+
+    @staticmethod
+    def get_cycle_for_date(card, trans_date):
+        return TransactionService.get_invoice_month(card.closing_day, trans_date)
+
+    @staticmethod
+    def write_card_snapshots(card, today=None):
+        """
+        Grava os snapshots das faturas já fechadas (fechamento antes de hoje) que
+        ainda não existem, continuando do último snapshot válido do cartão.
+        Retorna a quantidade de snapshots gravados. Se um lançamento retroativo do
+        cartão for gravado durante o cálculo, desfaz tudo (rollback) e retorna 0:
+        a próxima execução recalcula com ele.
+        """
+        today = today or date.today()
+        version = db.session.query(CreditCard.snapshot_version).filter(CreditCard.id == card.id).scalar()
+
+        plans = [p for p in RecurrenceService.get_card_plans(card.user_id) if p.card_id == card.id]
+        installment_plans = InstallmentService.get_plans(card.user_id, [card.id])
+        latest = InvoiceSnapshot.query.filter_by(card_id=card.id).order_by(InvoiceSnapshot.close_date.desc()).first()
+        if latest:
+            year, month = latest.cycle_year, latest.cycle_month
+            next_cycle = date(year, month, 1) + relativedelta(months=1)
+            year, month = next_cycle.year, next_cycle.month
+            base_close = latest.close_date
+            total_expenses = Decimal(str(latest.total_expenses))
+            total_payments = Decimal(str(latest.total_payments))
+        else:
+            first_date = db.session.query(func.min(Transaction.date)).filter(Transaction.card_id == card.id).scalar()
+            starts = [d for d in [first_date] + [p.start_date for p in plans] + [p.first_date for p in installment_plans] if d]
+            if not starts:
+                return 0
+            first_date = min(starts)
+            year, month = InvoiceSnapshotService.get_cycle_for_date(card, first_date)
+            base_close = None
+            total_expenses = Decimal('0')
+            total_payments = Decimal('0')
+
+        cycles = []
+        while True:
+            _, close_date, due_date = TransactionService.get_invoice_dates(card, month, year)
+            if close_date >= today:
+                break
+            cycles.append((year, month, close_date, due_date))
+            next_cycle = date(year, month, 1) + relativedelta(months=1)
+            year, month = next_cycle.year, next_cycle.month
+
+        if not cycles:
+            return 0
+
+        last_limit = max(cycles[-1][2], cycles[-1][3] + PAYMENT_TOLERANCE)
+        query = db.session.query(Transaction.date, Transaction.type, func.sum(Transaction.amount)).filter(
+            Transaction.card_id == card.id,
+            Transaction.type.in_(['despesa', 'pagamento_cartao']),
+            Transaction.date <= last_limit
+        )
+        if base_close:
+            query = query.filter(Transaction.date > base_close)
+        daily = query.group_by(Transaction.date, Transaction.type).all()
+
+        # Ocorrências virtuais dos fixos e parcelas dos planos do cartão entram como compras do dia
+        window_start = base_close + timedelta(days=1) if base_close else date.min
+        daily += [(o.date, 'despesa', o.amount) for o in RecurrenceService.get_occurrences(card.user_id, plans, window_start, last_limit)]
+        installment_plans = [p for p in installment_plans if p.last_date >= window_start]
+        daily += [(i.date, 'despesa', i.amount) for i in InstallmentService.get_installments(installment_plans, window_start, last_limit)]
+
+        for cycle_year, cycle_month, close_date, due_date in cycles:
+            paid_after_close = Decimal('0')
+            for trans_date, trans_type, amount in daily:
+                amount = Decimal(str(amount or 0))
+                in_cycle = trans_date <= close_date and (base_close is None or trans_date > base_close)
+                if trans_type == 'despesa' and in_cycle:
+                    total_expenses += amount
+                elif trans_type == 'pagamento_cartao':
+                    if in_cycle:
+                        total_payments += amount
+                    if close_date <= trans_date <= due_date + PAYMENT_TOLERANCE:
+                        paid_after_close += amount
+
+            db.session.add(InvoiceSnapshot(
+                user_id=card.user_id, card_id=card.id,
+                cycle_year=cycle_year, cycle_month=cycle_month,
+                close_date=close_date, due_date=due_date,
+                total_expenses=total_expenses, total_payments=total_payments,
+                closing_balance=total_expenses - total_payments,
+                paid_after_close=paid_after_close
+            ))
+            base_close = close_date
+
+        # Leitura com lock da versão atual: uma invalidação já gravada mudou a versão;
+        # uma em andamento espera o commit e apaga os snapshots recém-gravados
+        db.session.flush()
+        current = db.session.query(CreditCard.snapshot_version).filter(CreditCard.id == card.id).with_for_update().scalar()
+        if current != version:
+            db.session.rollback()
+            return 0
+        return len(cycles)
+
+    @staticmethod
+    def write_all(user_id=None, today=None):
+        query = CreditCard.query
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+
+        written = 0
+        for card in query.order_by(CreditCard.id).all():
+            written += InvoiceSnapshotService.write_card_snapshots(card, today)
+            db.session.commit()
+        return written
+
+    @staticmethod
+    def invalidate(session, cutoffs):
+        """Apaga os snapshots afetados: {card_id: data do lançamento mais antigo, ou None = todas as faturas}."""
+        for card_id, cutoff in cutoffs.items():
+            stmt = delete(InvoiceSnapshot).where(InvoiceSnapshot.card_id == card_id)
+            if cutoff is not None:
+                stmt = stmt.where(InvoiceSnapshot.close_date >= cutoff - INVALIDATION_WINDOW)
+            session.execute(stmt.execution_options(synchronize_session=False))
+            # Depois do DELETE: write_card_snapshots trava o cartão só depois de inserir
+            session.execute(
+                update(CreditCard).where(CreditCard.id == card_id)
+                .values(snapshot_version=func.coalesce(CreditCard.snapshot_version, 0) + 1)
+                .execution_options(synchronize_session=False)
+            )
+
+    @staticmethod
+    def get_snapshot(card_id, cycle_year, cycle_month):
+        return InvoiceSnapshot.query.filter_by(card_id=card_id, cycle_year=cycle_year, cycle_month=cycle_month).first()
+
+
+def snapshot_values(obj, committed):
+    state = inspect(obj)
+    values = {}
+    for f in SNAPSHOT_FIELDS:
+        history = state.attrs[f].history
+        values[f] = history.deleted[0] if committed and history.deleted else getattr(obj, f)
+    return values
+
+@event.listens_for(Session, 'before_flush')
+def invalidate_snapshots_before_flush(session, flush_context, instances):
+    """
+    Lançamentos retroativos (ou edições/exclusões) em faturas já fechadas
+    invalidam os snapshots a partir daquela data; o agendador os recalcula.
+    """
+    cutoffs = {}
+
+    def touch(card_id, trans_date):
+        if card_id and trans_date and cutoffs.get(card_id, trans_date) is not None:
+            cutoffs[card_id] = min(cutoffs.get(card_id, trans_date), trans_date)
+
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            touch(obj.card_id, obj.date)
+
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            values = snapshot_values(obj, committed=True)
+            touch(values['card_id'], values['date'])
+        elif isinstance(obj, CreditCard):
+            cutoffs[obj.id] = None
+
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            state = inspect(obj)
+            if any(state.attrs[f].history.has_changes() for f in SNAPSHOT_FIELDS):
+                for committed in (True, False):
+                    values = snapshot_values(obj, committed)
+                    touch(values['card_id'], values['date'])
+        elif isinstance(obj, CreditCard):
+            state = inspect(obj)
+            # Mudar fechamento/vencimento muda as janelas de todas as faturas
+            if state.attrs.closing_day.history.has_changes() or state.attrs.due_day.history.has_changes():
+                cutoffs[obj.id] = None
+
+    InvoiceSnapshotService.invalidate(session, cutoffs)
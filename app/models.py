@@ -27,6 +27,9 @@ class User(UserMixin, db.Model):
     # Controle de Onboarding (Esta era a coluna que faltava)
     welcome_seen = db.Column(db.Boolean, default=False)
 
+    # Versão dos dados do usuário: muda a cada alteração e invalida o cache do dashboard
+    data_version = db.Column(db.Integer, default=0, nullable=False)
+
     # NOVAS COLUNAS 2FA
     two_factor_secret = db.Column(db.String(32), nullable=True)
     two_factor_method = db.Column(db.String(10), nullable=True) # 'app' ou 'email'
@@ -84,6 +87,10 @@ class CreditCard(db.Model):
     brand = db.Column(db.String(50), default='other') 
     bank = db.Column(db.String(50), default='other')
 
+    # Incrementado a cada invalidação dos snapshots do cartão: quem grava snapshots
+    # confere, antes do commit, que nenhum lançamento retroativo entrou no meio do cálculo
+    snapshot_version = db.Column(db.Integer, default=0, nullable=False)
+
 class FixedExpense(db.Model):
     __tablename__ = 'fixed_expenses'
     id = db.Column(db.Integer, primary_key=True)
@@ -94,6 +101,11 @@ class FixedExpense(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
     account_id = db.Column(db.Integer, db.ForeignKey('bank_accounts.id'))
     card_id = db.Column(db.Integer, db.ForeignKey('credit_cards.id')) 
+
+    # Vigência do plano: as ocorrências mensais são geradas sob demanda (RecurrenceService)
+    # a partir de start_date e até end_date (inclusive; None = sem fim)
+    start_date = db.Column(db.Date, nullable=True)
+    end_date = db.Column(db.Date, nullable=True)
     
     category = db.relationship('Category')
     account = db.relationship('BankAccount')
@@ -108,10 +120,42 @@ class FixedRevenue(db.Model):
     day_of_month = db.Column(db.Integer, nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
     account_id = db.Column(db.Integer, db.ForeignKey('bank_accounts.id'))
+
+    start_date = db.Column(db.Date, nullable=True)
+    end_date = db.Column(db.Date, nullable=True)
     
     category = db.relationship('Category')
     account = db.relationship('BankAccount')
 
+class InstallmentPlan(db.Model):
+    """
+    Compra parcelada no cartão: as parcelas são derivadas do plano (InstallmentService)
+    e só viram Transaction quando têm exceção (antecipada ou editada), ligadas pelo
+    installment_identifier e installment_current.
+    """
+    __tablename__ = 'installment_plans'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    identifier = db.Column(db.String(50), nullable=False, unique=True)
+    description = db.Column(db.String(200), nullable=False)
+    total_amount = db.Column(db.Numeric(10, 2), nullable=False)
+    installment_count = db.Column(db.Integer, nullable=False)
+    # Vencimento da primeira e da última parcela (a última filtra as compras ainda em aberto)
+    first_date = db.Column(db.Date, nullable=False)
+    last_date = db.Column(db.Date, nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=True)
+    card_id = db.Column(db.Integer, db.ForeignKey('credit_cards.id'), nullable=False)
+    # Compra lançada depois do fechamento (descrição com 'Ref:'), como o is_anticipated das parcelas
+    is_anticipated = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    category = db.relationship('Category')
+    card = db.relationship('CreditCard')
+
+    __table_args__ = (
+        db.Index('ix_installment_plans_user_last_date', 'user_id', 'last_date'),
+    )
+
 class Transaction(db.Model):
     __tablename__ = 'transactions'
     id = db.Column(db.Integer, primary_key=True)
@@ -131,7 +175,148 @@ class Transaction(db.Model):
     installment_identifier = db.Column(db.String(50), nullable=True)
     installment_current = db.Column(db.Integer, nullable=True)
     installment_total = db.Column(db.Integer, nullable=True)
+
+    # Fatura (ano/mês) das compras e pagamentos de cartão, calculada pelo fechamento do cartão
+    invoice_year = db.Column(db.Integer, nullable=True)
+    invoice_month = db.Column(db.Integer, nullable=True)
+
+    # Mês de referência de lançamentos antecipados/repassados ('Ref: MM/YYYY' na descrição)
+    ref_year = db.Column(db.Integer, nullable=True)
+    ref_month = db.Column(db.Integer, nullable=True)
+    is_anticipated = db.Column(db.Boolean, default=False, nullable=False)
+    is_invoice_payment = db.Column(db.Boolean, default=False, nullable=False)
+
+    # Pagamento de fatura: a saída na conta aponta para o 'pagamento_cartao' lançado no
+    # cartão (TransactionService.pay_invoice); excluir um dos lados exclui o outro
+    paired_transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id', ondelete='SET NULL'), nullable=True)
+
+    # Data programada da ocorrência de fixo que esta transação realiza (paga, antecipada
+    # ou com valor alterado); enquanto ela existir, a ocorrência virtual não é gerada
+    occurrence_date = db.Column(db.Date, nullable=True)
+
+    # Lançamentos importados de extrato (ImportService): hash da data, valor, descrição
+    # normalizada e conta, usado para não gravar de novo o que já foi importado
+    import_hash = db.Column(db.String(64), nullable=True)
+
+    # Gravada no banco (as ocorrências virtuais de recurrence_service.Occurrence têm True)
+    is_virtual = False
     
     category = db.relationship('Category')
     account = db.relationship('BankAccount')
-    card = db.relationship('CreditCard')
\ No newline at end of file
+    card = db.relationship('CreditCard')
+
+    # Índices compostos para as consultas por período (dashboard, faturas e fixos)
+    __table_args__ = (
+        db.Index('ix_transactions_user_date', 'user_id', 'date'),
+        db.Index('ix_transactions_card_type_date', 'card_id', 'type', 'date'),
+        db.Index('ix_transactions_fixed_expense_date', 'fixed_expense_id', 'date'),
+        db.Index('ix_transactions_fixed_revenue_date', 'fixed_revenue_id', 'date'),
+        db.Index('ix_transactions_user_invoice', 'user_id', 'invoice_year', 'invoice_month'),
+        db.Index('ix_transactions_user_ref', 'user_id', 'ref_year', 'ref_month'),
+        db.Index('ix_transactions_user_occurrence', 'user_id', 'occurrence_date'),
+        db.Index('ix_transactions_installment', 'installment_identifier', 'installment_current'),
+        db.Index('ix_transactions_user_import_hash', 'user_id', 'import_hash'),
+        db.Index('ix_transactions_paired', 'paired_transaction_id'),
+    )
+
+class FixedSkip(db.Model):
+    """Ocorrência de fixo (ou parcela) pulada: a única exceção que não corresponde a uma Transaction."""
+    __tablename__ = 'fixed_skips'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    fixed_expense_id = db.Column(db.Integer, db.ForeignKey('fixed_expenses.id'), nullable=True)
+    fixed_revenue_id = db.Column(db.Integer, db.ForeignKey('fixed_revenues.id'), nullable=True)
+    installment_plan_id = db.Column(db.Integer, db.ForeignKey('installment_plans.id'), nullable=True)
+    occurrence_date = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_fixed_skips_user_occurrence', 'user_id', 'occurrence_date'),
+    )
+
+class MonthlyRollup(db.Model):
+    __tablename__ = 'monthly_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    category_id = db.Column(db.Integer, nullable=True)
+    account_id = db.Column(db.Integer, nullable=True)
+    card_id = db.Column(db.Integer, nullable=True)
+    type = db.Column(db.String(20), nullable=False)
+    is_fixed = db.Column(db.Boolean, default=False, nullable=False)
+    is_payment = db.Column(db.Boolean, default=False, nullable=False)
+    total = db.Column(db.Numeric(12, 2), default=0, nullable=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_monthly_rollups_user_month', 'user_id', 'year', 'month'),
+    )
+
+# Uma linha por chave do rollup. As colunas anuláveis entram com COALESCE: num índice
+# UNIQUE, NULL nunca colide com NULL (nem no MySQL nem no SQLite)
+ROLLUP_KEY = (
+    MonthlyRollup.user_id, MonthlyRollup.year, MonthlyRollup.month,
+    db.func.coalesce(MonthlyRollup.category_id, db.literal_column('0')), db.func.coalesce(MonthlyRollup.account_id, db.literal_column('0')),
+    db.func.coalesce(MonthlyRollup.card_id, db.literal_column('0')), MonthlyRollup.type, MonthlyRollup.is_fixed, MonthlyRollup.is_payment
+)
+db.Index('ux_monthly_rollups_key', *ROLLUP_KEY, unique=True)
+
+class InvoiceSnapshot(db.Model):
+    __tablename__ = 'invoice_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    card_id = db.Column(db.Integer, db.ForeignKey('credit_cards.id'), nullable=False)
+    cycle_year = db.Column(db.Integer, nullable=False)
+    cycle_month = db.Column(db.Integer, nullable=False)
+    close_date = db.Column(db.Date, nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+
+    # Acumulados do cartão desde o início até o fechamento (inclusive)
+    total_expenses = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    total_payments = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    closing_balance = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+    # Pagamentos entre o fechamento e o vencimento (+10 dias) desta fatura
+    paid_after_close = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('card_id', 'cycle_year', 'cycle_month', name='uq_invoice_snapshots_cycle'),
+        db.Index('ix_invoice_snapshots_card_close', 'card_id', 'close_date'),
+    )
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+
+    # 'pending' (na fila ou aguardando nova tentativa), 'sent' ou 'failed' (esgotou as tentativas)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(255), nullable=True)
+
+    # Reserva do lote por um sender (claim_token) até locked_until; depois disso outro worker pode assumir
+    claim_token = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next', 'status', 'next_attempt_at'),
+        db.Index('ix_email_outbox_claim', 'claim_token'),
+    )
+
+class SchedulerLock(db.Model):
+    __tablename__ = 'scheduler_locks'
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.now)
@@ -2,6 +2,7 @@ import time
 import sys
 from sqlalchemy import text, inspect
 from app import create_app, db
+from app.schema_upgrade import upgrade_schema
 
 def wait_for_db():
     """
@@ -47,18 +48,26 @@ def wait_for_db():
         # 2. Verifica e Cria Tabelas (Se necessário)
         try:
             inspector = inspect(db.engine)
-            # Se a tabela 'users' não existir, roda o create_all
             if not inspector.has_table("users"):
                 print("--- PRELOAD: Tabelas não encontradas. Criando estrutura do banco... ---")
-                db.create_all()
-                print("--- PRELOAD: Tabelas criadas com sucesso! ---")
             else:
-                print("--- PRELOAD: Tabelas já existem. ---")
+                print("--- PRELOAD: Tabelas já existem. Verificando tabelas novas... ---")
+            # create_all só cria o que ainda não existe (tabelas novas entre versões)
+            db.create_all()
+            print("--- PRELOAD: Estrutura de tabelas verificada! ---")
                 
         except Exception as e:
             print(f"--- ERRO AO CRIAR TABELAS: {e} ---")
             # Não aborta para tentar subir mesmo assim, mas avisa no log
             pass
 
+        # 3. Aplica migrações pendentes (índices, colunas novas e backfills)
+        try:
+            upgrade_schema()
+            print("--- PRELOAD: Esquema atualizado! ---")
+        except Exception as e:
+            db.session.rollback()
+            print(f"--- ERRO AO APLICAR MIGRAÇÕES: {e} ---")
+
 if __name__ == "__main__":
     wait_for_db()
\ No newline at end of file
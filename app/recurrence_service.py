@@ -0,0 +1,328 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+
+from app import db
+from app.models import Transaction, FixedExpense, FixedRevenue, FixedSkip
+from app.transaction_service import TransactionService
+
+# --- OCORRÊNCIAS DE FIXOS ---
+# Despesas e receitas fixas não são gravadas mês a mês: cada plano gera sob demanda
+# as ocorrências da janela consultada (dia do mês, de start_date até end_date).
+# Só as exceções ficam no banco: a Transaction que realiza uma ocorrência (paga,
+# antecipada ou com valor alterado, ligada a ela pelo occurrence_date) e as
+# ocorrências puladas (fixed_skips). Dashboard, faturas, limites e snapshots
+# juntam as ocorrências virtuais às transações gravadas.
+
+# Horizonte de navegação/antecipação para planos sem fim
+HORIZON_MONTHS = 12
+
+class Occurrence:
+    """Ocorrência virtual de um fixo, com os atributos de Transaction lidos por dashboard, faturas e templates."""
+    is_virtual = True
+    endpoint = 'occurrence'
+    id = None
+    installment_identifier = None
+    installment_current = None
+    installment_total = None
+    ref_year = None
+    ref_month = None
+    is_anticipated = False
+    is_invoice_payment = False
+
+    def __init__(self, fixed, occurrence_date):
+        self.fixed = fixed
+        self.user_id = fixed.user_id
+        self.description = fixed.description
+        self.amount = fixed.amount
+        self.date = occurrence_date
+        self.occurrence_date = occurrence_date
+        self.category_id = fixed.category_id
+        self.account_id = fixed.account_id
+        self.created_at = datetime.combine(occurrence_date, time.min)
+        if isinstance(fixed, FixedExpense):
+            self.type = 'despesa'
+            self.card_id = fixed.card_id
+            self.fixed_expense_id, self.fixed_revenue_id = fixed.id, None
+        else:
+            self.type = 'receita'
+            self.card_id = None
+            self.fixed_expense_id, self.fixed_revenue_id = None, fixed.id
+
+    @property
+    def key(self):
+        return (self.fixed_expense_id, self.fixed_revenue_id, self.occurrence_date)
+
+    @property
+    def url_args(self):
+        """Parâmetros das rotas finance.*_occurrence."""
+        return {'fixed_id': self.fixed_expense_id, 'occurrence': self.occurrence_date.isoformat()}
+
+    # Relacionamentos resolvidos pelo plano (saem do identity map, carregado pelo UserData)
+    @property
+    def category(self):
+        return self.fixed.category
+
+    @property
+    def account(self):
+        return self.fixed.account
+
+    @property
+    def card(self):
+        return self.fixed.card if self.card_id else None
+
+
+class RecurrenceService:
+
+    @staticmethod
+    def occurrence_dates(fixed, start, end):
+        """Datas das ocorrências do plano em [start, end], dentro da vigência dele."""
+        if fixed.start_date is None:
+            return
+        start = max(start, fixed.start_date)
+        if fixed.end_date is not None:
+            end = min(end, fixed.end_date)
+        index = start.year * 12 + start.month - 1
+        last = end.year * 12 + end.month - 1
+        while index <= last:
+            year, month = divmod(index, 12)
+            occurrence = TransactionService.get_safe_date(year, month + 1, fixed.day_of_month)
+            if start <= occurrence <= end:
+                yield occurrence
+            index += 1
+
+    @staticmethod
+    def get_exceptions(user_id, start, end, plans=None):
+        """
+        Ocorrências da janela que não devem ser geradas, no formato de Occurrence.key:
+        as realizadas por uma Transaction e as puladas. Com plans (fixos de cartão),
+        só as exceções desses planos.
+        """
+        stored = db.session.query(Transaction.fixed_expense_id, Transaction.fixed_revenue_id, Transaction.occurrence_date).filter(
+            Transaction.user_id == user_id,
+            Transaction.occurrence_date >= start,
+            Transaction.occurrence_date <= end
+        )
+        skipped = db.session.query(FixedSkip.fixed_expense_id, FixedSkip.fixed_revenue_id, FixedSkip.occurrence_date).filter(
+            FixedSkip.user_id == user_id,
+            FixedSkip.occurrence_date >= start,
+            FixedSkip.occurrence_date <= end
+        )
+        if plans is not None:
+            plan_ids = [p.id for p in plans]
+            stored = stored.filter(Transaction.fixed_expense_id.in_(plan_ids))
+            skipped = skipped.filter(FixedSkip.fixed_expense_id.in_(plan_ids))
+        return {tuple(row) for row in stored.all() + skipped.all()}
+
+    @staticmethod
+    def get_card_exceptions(user_id, plans, start, end):
+        """
+        Exceções dos fixos de cartão (plans) de uma janela que cobre as de todas as
+        consultas de uma requisição (o dashboard), carregadas uma vez e repassadas
+        em exceptions= a get_invoice_occurrences, get_card_totals e get_next_dates.
+        Só editadas e puladas são gravadas, então janelas longas custam pouco.
+        """
+        if not plans:
+            return set()
+        starts = [p.start_date for p in plans if p.start_date]
+        return RecurrenceService.get_exceptions(user_id, min(starts + [start]), end, plans)
+
+    @staticmethod
+    def get_occurrences(user_id, plans, start, end, exceptions=None):
+        """
+        Ocorrências virtuais (sem exceção gravada) dos planos em [start, end], ordenadas
+        pela data. exceptions: as exceções já carregadas, cobrindo a janela.
+        """
+        if not plans or start > end:
+            return []
+        if exceptions is None:
+            exceptions = RecurrenceService.get_exceptions(user_id, start, end)
+        occurrences = []
+        for plan in plans:
+            for occurrence_date in RecurrenceService.occurrence_dates(plan, start, end):
+                occurrence = Occurrence(plan, occurrence_date)
+                if occurrence.key not in exceptions:
+                    occurrences.append(occurrence)
+        occurrences.sort(key=lambda o: o.date)
+        return occurrences
+
+    @staticmethod
+    def get_card_plans(user_id):
+        return FixedExpense.query.filter(FixedExpense.user_id == user_id, FixedExpense.card_id != None).order_by(FixedExpense.id).all()
+
+    @staticmethod
+    def is_active(plan, year, month):
+        """Se o plano tem ocorrência no mês (painel de fixos de conta do dashboard)."""
+        month_start, month_end = TransactionService.get_month_range(year, month)
+        return next(RecurrenceService.occurrence_dates(plan, month_start, month_end - timedelta(days=1)), None) is not None
+
+    # --- JUNÇÃO COM AS TRANSAÇÕES GRAVADAS ---
+
+    @staticmethod
+    def get_invoice_occurrences(user_id, cards, year, month, plans=None, exceptions=None):
+        """
+        Ocorrências virtuais de fixos de cartão que caem na fatura (year, month),
+        com invoice_year/invoice_month preenchidos como nas transações gravadas.
+        """
+        closing_days = {c.id: c.closing_day for c in cards}
+        if plans is None:
+            plans = RecurrenceService.get_card_plans(user_id)
+        plans = [p for p in plans if p.card_id in closing_days]
+
+        # A fatura do mês reúne compras do mês anterior (após o fechamento) e do próprio mês
+        month_start, month_end = TransactionService.get_month_range(year, month)
+        window = RecurrenceService.get_occurrences(
+            user_id, plans, month_start - relativedelta(months=1), month_end - timedelta(days=1), exceptions
+        )
+
+        occurrences = []
+        for occurrence in window:
+            invoice = TransactionService.get_invoice_month(closing_days[occurrence.card_id], occurrence.date)
+            if invoice == (year, month):
+                occurrence.invoice_year, occurrence.invoice_month = invoice
+                occurrences.append(occurrence)
+        return occurrences
+
+    @staticmethod
+    def get_card_totals(user_id, invoice_dates, snapshots, today, plans=None, exceptions=None):
+        """
+        Somas das ocorrências virtuais já vencidas (até hoje) de cada cartão, nas
+        mesmas três faixas de _build_cards_stats: {card_id: [antes da abertura,
+        dentro da fatura, total]}. O que já está num snapshot não é somado de novo.
+        """
+        if plans is None:
+            plans = RecurrenceService.get_card_plans(user_id)
+        plans = [p for p in plans if p.card_id in invoice_dates and p.start_date]
+        if not plans:
+            return {}
+
+        def window_start(card_id, plan):
+            snapshot = snapshots.get(card_id)
+            return snapshot.close_date + timedelta(days=1) if snapshot else plan.start_date
+
+        start = min(window_start(p.card_id, p) for p in plans)
+        totals = {}
+        for occurrence in RecurrenceService.get_occurrences(user_id, plans, start, today, exceptions):
+            if occurrence.date < window_start(occurrence.card_id, occurrence.fixed):
+                continue
+            open_date, close_date, _ = invoice_dates[occurrence.card_id]
+            sums = totals.setdefault(occurrence.card_id, [Decimal('0')] * 3)
+            amount = Decimal(str(occurrence.amount))
+            if occurrence.date < open_date:
+                sums[0] += amount
+            elif occurrence.date <= close_date:
+                sums[1] += amount
+            sums[2] += amount
+        return totals
+
+    @staticmethod
+    def get_next_dates(user_id, after_date, plans=None, exceptions=None):
+        """
+        Próxima ocorrência (posterior a after_date) de cada fixo, gravada ou
+        virtual: ({fixed_expense_id: data}, {fixed_revenue_id: data}).
+        """
+        next_expense_dates, next_revenue_dates = TransactionService.get_next_fixed_dates(user_id, after_date)
+        if plans is None:
+            plans = RecurrenceService.get_card_plans(user_id)
+        occurrences = RecurrenceService.get_occurrences(
+            user_id, plans, after_date + timedelta(days=1), after_date + relativedelta(months=HORIZON_MONTHS), exceptions
+        )
+        for occurrence in occurrences:
+            current = next_expense_dates.get(occurrence.fixed_expense_id)
+            if current is None or occurrence.date < current:
+                next_expense_dates[occurrence.fixed_expense_id] = occurrence.date
+        return next_expense_dates, next_revenue_dates
+
+    # --- EXCEÇÕES E CICLO DE VIDA DO PLANO ---
+
+    @staticmethod
+    def get_plan(type_fixed, fixed_id, user_id):
+        model = FixedExpense if type_fixed == 'expense' else FixedRevenue
+        return model.query.filter_by(id=fixed_id, user_id=user_id).first()
+
+    @staticmethod
+    def is_occurrence(plan, occurrence_date):
+        return occurrence_date in RecurrenceService.occurrence_dates(plan, occurrence_date, occurrence_date)
+
+    @staticmethod
+    def materialize(plan, occurrence_date, **fields):
+        """Grava a ocorrência como Transaction (exceção: antecipada, com outro valor...). Sem commit."""
+        values = dict(
+            user_id=plan.user_id, description=plan.description, amount=plan.amount,
+            date=occurrence_date, category_id=plan.category_id, account_id=plan.account_id,
+            occurrence_date=occurrence_date
+        )
+        if isinstance(plan, FixedExpense):
+            values.update(type='despesa', card_id=plan.card_id, fixed_expense_id=plan.id)
+        else:
+            values.update(type='receita', fixed_revenue_id=plan.id)
+        values.update(fields)
+        trans = Transaction(**values)
+        db.session.add(trans)
+        return trans
+
+    @staticmethod
+    def skip(plan, occurrence_date):
+        """Pula uma ocorrência. Sem commit."""
+        is_expense = isinstance(plan, FixedExpense)
+        db.session.add(FixedSkip(
+            user_id=plan.user_id, occurrence_date=occurrence_date,
+            fixed_expense_id=plan.id if is_expense else None,
+            fixed_revenue_id=None if is_expense else plan.id
+        ))
+        if is_expense and plan.card_id:
+            RecurrenceService.invalidate_snapshots(plan.card_id, occurrence_date)
+
+    @staticmethod
+    def end_plan(plan, last_date):
+        """
+        Encerra o plano em last_date (inclusive), sem apagar o histórico. Remove as
+        ocorrências de cartão ainda não vencidas que foram gravadas depois disso
+        (lançamentos gerados antes do motor de recorrência). Sem commit.
+        """
+        plan.end_date = last_date
+        if not isinstance(plan, FixedExpense):
+            return
+        pending = Transaction.query.filter(
+            Transaction.fixed_expense_id == plan.id,
+            Transaction.card_id != None,
+            Transaction.date > max(last_date, date.today()),
+            Transaction.is_anticipated == False
+        ).all()
+        for trans in pending:
+            db.session.delete(trans)
+
+    @staticmethod
+    def split_plan(plan, today):
+        """
+        Encerra o plano hoje e devolve uma cópia que vale a partir de amanhã: as
+        ocorrências passadas mantêm os valores antigos. As exceções futuras do
+        plano (antecipadas, editadas, puladas) passam para a cópia. Sem commit.
+        """
+        new_plan = FixedExpense(
+            user_id=plan.user_id, description=plan.description, amount=plan.amount,
+            day_of_month=plan.day_of_month, category_id=plan.category_id,
+            account_id=plan.account_id, card_id=plan.card_id,
+            start_date=today + timedelta(days=1), end_date=plan.end_date
+        )
+        db.session.add(new_plan)
+        db.session.flush()
+        # Antes de start_date só há lançamentos gravados pela renovação antiga: esses o end_plan remove
+        for model in (Transaction, FixedSkip):
+            for row in model.query.filter(
+                model.fixed_expense_id == plan.id,
+                model.occurrence_date > today,
+                model.occurrence_date >= plan.start_date
+            ).all():
+                row.fixed_expense_id = new_plan.id
+        RecurrenceService.end_plan(plan, today)
+        return new_plan
+
+    @staticmethod
+    def invalidate_snapshots(card_id, from_date):
+        """Ocorrências de cartão criadas ou puladas no passado mudam as faturas já fechadas."""
+        if card_id and from_date <= date.today():
+            # Importado aqui: invoice_service importa RecurrenceService
+            from app.invoice_service import InvoiceSnapshotService
+            InvoiceSnapshotService.invalidate(db.session, {card_id: from_date})
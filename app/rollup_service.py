@@ -0,0 +1,317 @@
+from app import db
+from app.models import Transaction, CreditCard, Category, MonthlyRollup, User, ROLLUP_KEY
+from app.transaction_service import TransactionService
+from sqlalchemy import event, inspect, func, and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import mysql, sqlite
+from decimal import Decimal, ROUND_HALF_UP
+import click
+from flask.cli import AppGroup
+
+# Atributos da Transaction que influenciam em qual linha do rollup ela cai
+ROLLUP_FIELDS = ('user_id', 'amount', 'date', 'type', 'category_id', 'account_id', 'card_id',
+                 'fixed_expense_id', 'fixed_revenue_id', 'ref_year', 'ref_month', 'is_invoice_payment')
+
+CENT = Decimal('0.01')
+
+class RollupService:
+    """
+    Mantém a tabela monthly_rollups: totais por (usuário, ano, mês, categoria,
+    conta/cartão, tipo), no mesmo "mês de dashboard" em que a transação aparece.
+    Atualizada no before_flush da sessão, ou seja, na mesma transação de banco
+    das rotas de escrita.
+    """
+
+    @staticmethod
+    def get_buckets(values, closing_day=None):
+        """
+        Meses (ano, mês) em que a transação é exibida no dashboard:
+        - compras/pagamentos de cartão: mês da fatura (após o fechamento, fatura seguinte);
+        - demais: mês da data e, se houver, o mês de referência (ref_year/ref_month).
+        """
+        trans_date = values['date']
+        if values['card_id'] and values['type'] in ('despesa', 'pagamento_cartao') and closing_day is not None:
+            return {TransactionService.get_invoice_month(closing_day, trans_date)}
+
+        buckets = {(trans_date.year, trans_date.month)}
+        if values['ref_year'] and values['ref_month']:
+            buckets.add((values['ref_year'], values['ref_month']))
+        return buckets
+
+    @staticmethod
+    def is_payment(values, category_type):
+        if values['type'] != 'despesa':
+            return False
+        return category_type == 'pagamento' or bool(values['is_invoice_payment'])
+
+    @staticmethod
+    def get_deltas(values, sign, closing_days, category_types):
+        """Linhas de rollup afetadas por uma transação: {chave: (total, quantidade)}."""
+        amount = Decimal(str(values['amount'] or 0)).quantize(CENT, rounding=ROUND_HALF_UP)
+        is_fixed = bool(values['fixed_expense_id'] or values['fixed_revenue_id'])
+        is_payment = RollupService.is_payment(values, category_types.get(values['category_id']))
+
+        deltas = {}
+        for year, month in RollupService.get_buckets(values, closing_days.get(values['card_id'])):
+            key = (values['user_id'], year, month, values['category_id'], values['account_id'],
+                   values['card_id'], values['type'], is_fixed, is_payment)
+            deltas[key] = (sign * amount, sign)
+        return deltas
+
+    @staticmethod
+    def apply_deltas(session, deltas):
+        """
+        Soma os deltas nas linhas de rollup com um único upsert atômico
+        (total = total + delta no próprio banco, ON DUPLICATE KEY UPDATE no MySQL,
+        ON CONFLICT no SQLite): escritas concorrentes do mesmo usuário/mês não
+        perdem deltas nem duplicam linhas.
+        """
+        rows = []
+        for key, (total, count) in deltas.items():
+            if total == 0 and count == 0:
+                continue
+            user_id, year, month, category_id, account_id, card_id, trans_type, is_fixed, is_payment = key
+            rows.append({
+                'user_id': user_id, 'year': year, 'month': month, 'category_id': category_id,
+                'account_id': account_id, 'card_id': card_id, 'type': trans_type,
+                'is_fixed': is_fixed, 'is_payment': is_payment, 'total': total, 'count': count
+            })
+        if rows:
+            session.execute(RollupService.upsert_statement(session.get_bind().dialect.name), rows)
+
+    @staticmethod
+    def upsert_statement(dialect_name):
+        table = MonthlyRollup.__table__
+        if dialect_name == 'mysql':
+            statement = mysql.insert(table)
+            return statement.on_duplicate_key_update(
+                total=table.c.total + statement.inserted.total,
+                count=table.c.count + statement.inserted.count
+            )
+        statement = sqlite.insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={'total': table.c.total + statement.excluded.total, 'count': table.c.count + statement.excluded.count}
+        )
+
+    @staticmethod
+    def row_key(row):
+        return (row.user_id, row.year, row.month, row.category_id, row.account_id,
+                row.card_id, row.type, bool(row.is_fixed), bool(row.is_payment))
+
+    @staticmethod
+    def merge_deltas(target, deltas):
+        for key, (total, count) in deltas.items():
+            old_total, old_count = target.get(key, (Decimal('0'), 0))
+            target[key] = (old_total + total, old_count + count)
+
+    @staticmethod
+    def load_lookups(session, card_ids, category_ids):
+        card_ids = {c for c in card_ids if c}
+        category_ids = {c for c in category_ids if c}
+        closing_days = {}
+        category_types = {}
+        if card_ids:
+            closing_days = dict(session.query(CreditCard.id, CreditCard.closing_day).filter(CreditCard.id.in_(card_ids)).all())
+        if category_ids:
+            category_types = dict(session.query(Category.id, Category.type).filter(Category.id.in_(category_ids)).all())
+        return closing_days, category_types
+
+    @staticmethod
+    def collect_changes(session):
+        """Pares (valores, sinal) das transações novas, alteradas e removidas desta flush."""
+        changes = []
+        for obj in session.new:
+            if isinstance(obj, Transaction):
+                changes.append(({f: getattr(obj, f) for f in ROLLUP_FIELDS}, 1))
+
+        for obj in session.deleted:
+            if isinstance(obj, Transaction):
+                changes.append((RollupService.committed_values(obj), -1))
+
+        for obj in session.dirty:
+            if isinstance(obj, Transaction) and session.is_modified(obj):
+                state = inspect(obj)
+                if any(state.attrs[f].history.has_changes() for f in ROLLUP_FIELDS):
+                    changes.append((RollupService.committed_values(obj), -1))
+                    changes.append(({f: getattr(obj, f) for f in ROLLUP_FIELDS}, 1))
+        return changes
+
+    @staticmethod
+    def committed_values(obj):
+        state = inspect(obj)
+        values = {}
+        for f in ROLLUP_FIELDS:
+            history = state.attrs[f].history
+            if history.deleted:
+                values[f] = history.deleted[0]
+            else:
+                values[f] = getattr(obj, f)
+        return values
+
+    @staticmethod
+    def compute_user_rollups(user_id):
+        """Recalcula do zero, a partir do razão (transactions), os rollups de um usuário."""
+        closing_days = dict(db.session.query(CreditCard.id, CreditCard.closing_day).filter_by(user_id=user_id).all())
+        category_types = dict(db.session.query(Category.id, Category.type).filter_by(user_id=user_id).all())
+
+        columns = [getattr(Transaction, f) for f in ROLLUP_FIELDS]
+        rows = db.session.query(*columns).filter(Transaction.user_id == user_id).yield_per(1000)
+
+        deltas = {}
+        for row in rows:
+            values = dict(zip(ROLLUP_FIELDS, row))
+            RollupService.merge_deltas(deltas, RollupService.get_deltas(values, 1, closing_days, category_types))
+        return deltas
+
+    @staticmethod
+    def compare_user_rollups(user_id):
+        """
+        Retorna (esperado, gravado): os rollups recalculados do razão e os que
+        estão hoje na tabela, no formato {chave: (total, quantidade)}.
+        """
+        expected = {
+            k: (t.quantize(CENT), c)
+            for k, (t, c) in RollupService.compute_user_rollups(user_id).items()
+            if (t, c) != (0, 0)
+        }
+        current = {
+            RollupService.row_key(row): (Decimal(str(row.total)).quantize(CENT), row.count)
+            for row in MonthlyRollup.query.filter_by(user_id=user_id).all()
+            if row.count or row.total
+        }
+        return expected, current
+
+    @staticmethod
+    def replace_user_rollups(user_id, rollups):
+        MonthlyRollup.query.filter_by(user_id=user_id).delete()
+        for key, (total, count) in rollups.items():
+            user, year, month, category_id, account_id, card_id, trans_type, is_fixed, is_payment = key
+            db.session.add(MonthlyRollup(
+                user_id=user, year=year, month=month, category_id=category_id,
+                account_id=account_id, card_id=card_id, type=trans_type,
+                is_fixed=is_fixed, is_payment=is_payment, total=total, count=count
+            ))
+
+    @staticmethod
+    def refresh_user(user_id):
+        """Recalcula os rollups do usuário (sem commit), após UPDATE/DELETE em massa."""
+        expected, _ = RollupService.compare_user_rollups(user_id)
+        RollupService.replace_user_rollups(user_id, expected)
+
+    @staticmethod
+    def rebuild(user_id=None, verify_only=False):
+        """
+        Reconstrói (ou apenas verifica, com verify_only) a tabela de rollups.
+        Retorna a lista de usuários cujos rollups divergiam do razão.
+        """
+        if user_id is not None:
+            user_ids = [user_id]
+        else:
+            user_ids = [uid for (uid,) in db.session.query(User.id).order_by(User.id).all()]
+
+        mismatched = []
+        for uid in user_ids:
+            expected, current = RollupService.compare_user_rollups(uid)
+            if expected != current:
+                mismatched.append(uid)
+            if not verify_only:
+                RollupService.replace_user_rollups(uid, expected)
+                db.session.commit()
+
+        return mismatched
+
+    @staticmethod
+    def get_month_rollups(user_id, year, month):
+        return MonthlyRollup.query.filter_by(user_id=user_id, year=year, month=month).all()
+
+    @staticmethod
+    def get_month_summary(user_id, year, month, cards, today, virtual=()):
+        """
+        Totais do card de resumo do dashboard a partir dos rollups do mês:
+        receitas, despesas (já realizadas), receitas avulsas e despesas avulsas de conta.
+        Compras de cartão só contam até hoje: faturas fechadas entram inteiras, faturas
+        futuras não entram e a fatura em andamento é somada com uma consulta indexada.
+        virtual: ocorrências de fixos de cartão e parcelas da fatura do mês, que não
+        estão nos rollups (get_invoice_occurrences / get_invoice_installments).
+        """
+        summary = {
+            'receitas': Decimal('0'),
+            'despesas': Decimal('0'),
+            'receitas_avulsas': Decimal('0'),
+            'despesas_conta_avulsas': Decimal('0'),
+        }
+
+        invoice_dates = {c.id: TransactionService.get_invoice_dates(c, month, year) for c in cards}
+        open_cycles = {}
+
+        for row in RollupService.get_month_rollups(user_id, year, month):
+            total = Decimal(str(row.total))
+            if row.type == 'receita':
+                summary['receitas'] += total
+                if not row.is_fixed:
+                    summary['receitas_avulsas'] += total
+            elif row.type == 'despesa' and not row.is_payment:
+                if not row.card_id:
+                    summary['despesas'] += total
+                    if not row.is_fixed:
+                        summary['despesas_conta_avulsas'] += total
+                elif row.card_id in invoice_dates:
+                    open_date, close_date, _ = invoice_dates[row.card_id]
+                    if close_date <= today:
+                        summary['despesas'] += total
+                    elif open_date <= today:
+                        open_cycles[row.card_id] = open_date
+
+        if open_cycles:
+            pagamento_ids = [cid for (cid,) in db.session.query(Category.id).filter_by(user_id=user_id, type='pagamento').all()]
+            spent = db.session.query(func.sum(Transaction.amount)).filter(
+                Transaction.user_id == user_id,
+                Transaction.type == 'despesa',
+                or_(*[and_(Transaction.card_id == cid, Transaction.date >= open_date) for cid, open_date in open_cycles.items()]),
+                Transaction.date <= today,
+                or_(Transaction.category_id == None, ~Transaction.category_id.in_(pagamento_ids))
+            ).scalar()
+            summary['despesas'] += Decimal(str(spent or 0))
+
+        for trans in virtual:
+            if trans.date <= today and not (trans.category and trans.category.type == 'pagamento'):
+                summary['despesas'] += Decimal(str(trans.amount))
+
+        return summary
+
+
+@event.listens_for(Session, 'before_flush')
+def update_rollups_before_flush(session, flush_context, instances):
+    changes = RollupService.collect_changes(session)
+    if not changes:
+        return
+
+    closing_days, category_types = RollupService.load_lookups(
+        session,
+        [values['card_id'] for values, _ in changes],
+        [values['category_id'] for values, _ in changes]
+    )
+    deltas = {}
+    for values, sign in changes:
+        RollupService.merge_deltas(deltas, RollupService.get_deltas(values, sign, closing_days, category_types))
+    RollupService.apply_deltas(session, deltas)
+
+
+# --- CLI: flask rollups <comando> ---
+
+rollups_cli = AppGroup('rollups', help='Manutenção da tabela monthly_rollups.')
+
+@rollups_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Reconstrói apenas os rollups deste usuário.')
+@click.option('--verify', is_flag=True, help='Apenas compara com o razão, sem gravar.')
+def rebuild_rollups_command(user_id, verify):
+    """Reconstrói (ou verifica) os rollups mensais a partir das transações."""
+    mismatched = RollupService.rebuild(user_id=user_id, verify_only=verify)
+    if verify:
+        if mismatched:
+            click.echo(f"Rollups divergentes para os usuários: {', '.join(map(str, mismatched))}")
+        else:
+            click.echo("Rollups conferem com o razão.")
+    else:
+        click.echo(f"Rollups reconstruídos ({len(mismatched)} usuários estavam divergentes).")
@@ -1,7 +1,11 @@
 from app import create_app
+from app.scheduler import start_scheduler
+from app.email_outbox import start_email_sender
 
 app = create_app()
 
+# Sob o Gunicorn, as threads do agendador e do sender de e-mails sobem em cada worker no post_fork (gunicorn.conf.py)
+
 # --- FILTROS JINJA2 PERSONALIZADOS ---
 
 def format_currency(value):
@@ -31,5 +35,8 @@ app.jinja_env.filters['trim_slash'] = trim_slash
 # -----------------------------------
 
 if __name__ == '__main__':
+    # Thread do agendador (só o líder executa as tarefas)
+    start_scheduler(app)
+    start_email_sender(app)
     # Alterado para '::' para suportar IPv6 (e IPv4 em dual-stack)
     app.run(host='::', port=5000)
\ No newline at end of file
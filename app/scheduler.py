@@ -0,0 +1,139 @@
+import os
+import socket
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import SchedulerLock
+from app.invoice_service import InvoiceSnapshotService
+from app.email_outbox import EmailOutboxService
+
+logger = logging.getLogger("scheduler")
+
+# --- AGENDADOR DE TAREFAS EM SEGUNDO PLANO ---
+# Cada worker do Gunicorn sobe uma thread do agendador, mas apenas o "líder"
+# executa as tarefas. A liderança é um lease gravado em scheduler_locks:
+# quem consegue atualizar a linha (por ser o dono atual ou porque o lease
+# expirou) é o líder até expires_at.
+
+LEADER_LOCK = 'scheduler-leader'
+
+class Job:
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval  # segundos
+        self.func = func
+        self.last_run = None
+
+    def is_due(self, now):
+        return self.last_run is None or (now - self.last_run) >= self.interval
+
+def write_invoice_snapshots_job():
+    count = InvoiceSnapshotService.write_all()
+    if count:
+        logger.info(f"{count} snapshots de fatura gravados.")
+
+def purge_email_outbox_job():
+    count = EmailOutboxService.purge_sent(current_app.config['EMAIL_OUTBOX_RETENTION'])
+    if count:
+        logger.info(f"{count} e-mails enviados removidos da fila.")
+
+JOBS = [
+    Job('write_invoice_snapshots', 3600, write_invoice_snapshots_job),
+    Job('purge_email_outbox', 86400, purge_email_outbox_job),
+]
+
+def get_owner_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_leadership(owner, ttl):
+    """
+    Tenta obter (ou renovar) o lease de líder. Retorna True se este processo é o líder.
+    O UPDATE condicional é atômico no banco, então só um worker vence a disputa.
+    """
+    now = datetime.utcnow()
+    lock_table = SchedulerLock.__table__
+    result = db.session.execute(
+        lock_table.update()
+        .where(
+            lock_table.c.name == LEADER_LOCK,
+            (lock_table.c.owner == owner) | (lock_table.c.expires_at == None) | (lock_table.c.expires_at < now)
+        )
+        .values(owner=owner, expires_at=now + timedelta(seconds=ttl))
+    )
+    if result.rowcount == 1:
+        db.session.commit()
+        return True
+
+    db.session.rollback()
+    if SchedulerLock.query.get(LEADER_LOCK) is None:
+        # Primeira execução: cria a linha do lock (outro worker pode ter criado antes)
+        try:
+            db.session.add(SchedulerLock(name=LEADER_LOCK, owner=owner, expires_at=now + timedelta(seconds=ttl)))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+    return False
+
+def run_due_jobs(now=None, force=False):
+    now = now if now is not None else time.monotonic()
+    for job in JOBS:
+        if not force and not job.is_due(now):
+            continue
+        try:
+            job.func()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Falha na tarefa {job.name}: {e}")
+        job.last_run = now
+
+def scheduler_loop(app, owner):
+    interval = app.config['SCHEDULER_INTERVAL']
+    ttl = app.config['SCHEDULER_LOCK_TTL']
+    while True:
+        try:
+            with app.app_context():
+                if acquire_leadership(owner, ttl):
+                    run_due_jobs()
+        except Exception as e:
+            logger.error(f"Erro no agendador: {e}")
+        time.sleep(interval)
+
+def start_scheduler(app):
+    """
+    Sobe a thread do agendador neste processo (chamado no post_fork do
+    gunicorn.conf.py ou pelo run.py executado direto, ou seja, apenas pelos
+    workers web; preload.py e a CLI não iniciam o agendador).
+    """
+    if not app.config.get('SCHEDULER_ENABLED'):
+        return None
+    owner = get_owner_id()
+    thread = threading.Thread(target=scheduler_loop, args=(app, owner), name='scheduler', daemon=True)
+    thread.start()
+    logger.info(f"Agendador iniciado ({owner}).")
+    return thread
+
+# --- CLI: flask jobs <comando> ---
+
+jobs_cli = AppGroup('jobs', help='Tarefas agendadas (snapshots de fatura, limpeza da fila de e-mails etc.).')
+
+@jobs_cli.command('run')
+def run_jobs_command():
+    """Executa todas as tarefas agendadas uma vez, ignorando o líder."""
+    run_due_jobs(force=True)
+    click.echo("Tarefas executadas.")
+
+@jobs_cli.command('invoice-snapshots')
+@click.option('--user-id', type=int, default=None, help='Grava apenas os snapshots dos cartões deste usuário.')
+def invoice_snapshots_command(user_id):
+    """Grava os snapshots das faturas já fechadas que ainda não existem."""
+    count = InvoiceSnapshotService.write_all(user_id=user_id)
+    click.echo(f"{count} snapshots de fatura gravados.")
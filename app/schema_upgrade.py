@@ -0,0 +1,428 @@
+from sqlalchemy import inspect, text, func, select, update, delete, or_, table, column
+from app import db
+from app.models import SchemaMigration, Transaction, FixedExpense, FixedRevenue, FixedSkip, InstallmentPlan, CreditCard, User, MonthlyRollup
+from app.transaction_service import TransactionService
+from app.rollup_service import RollupService
+from app.invoice_service import InvoiceSnapshotService
+from app.installment_service import InstallmentService
+from app.search_service import SearchService
+from app.avatar_service import AvatarService, AvatarError, AVATAR_PREFIX
+from flask import current_app
+from datetime import date, timedelta
+from decimal import Decimal
+import os
+import re
+
+# --- MIGRAÇÕES INCREMENTAIS DO ESQUEMA ---
+# O db.create_all() só cria tabelas que ainda não existem. Alterações em tabelas
+# já existentes (índices, colunas novas, backfills) ficam registradas aqui e são
+# aplicadas uma única vez pelo preload.py, na ordem em que foram declaradas.
+# Uma migração só lê as colunas que existiam quando foi escrita (select explícito),
+# nunca entidades inteiras: os modelos têm as colunas das migrações seguintes.
+# Backfills feitos pelos serviços (que usam os modelos atuais) vão em `after` e
+# rodam uma única vez, depois de todas as migrações pendentes.
+
+MIGRATIONS = []
+
+def migration(name, after=()):
+    def decorator(func):
+        MIGRATIONS.append((name, func, tuple(after)))
+        return func
+    return decorator
+
+def existing_index_names(table_name):
+    # O inspector do SQLAlchemy omite os índices de expressão (COALESCE) no SQLite
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :t"), {'t': table_name})
+    elif db.engine.dialect.name == 'mysql':
+        rows = db.session.execute(text(
+            "SELECT DISTINCT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = :t"
+        ), {'t': table_name})
+    else:
+        return {ix['name'] for ix in inspect(db.engine).get_indexes(table_name)}
+    return {name for (name,) in rows}
+
+def existing_column_names(table_name):
+    return {col['name'] for col in inspect(db.engine).get_columns(table_name)}
+
+def create_missing_indexes(table):
+    existing = existing_index_names(table.name)
+    columns = existing_column_names(table.name)
+    for index in table.indexes:
+        # Índices sobre colunas que ainda não existem ficam para a migração que cria a coluna
+        if index.name not in existing and {c.name for c in index.columns} <= columns:
+            print(f"--- SCHEMA: Criando índice {index.name} em {table.name}... ---")
+            index.create(bind=db.engine)
+
+def add_missing_columns(table, *column_names):
+    existing = existing_column_names(table.name)
+    for name in column_names:
+        if name in existing:
+            continue
+        col_type = table.columns[name].type.compile(dialect=db.engine.dialect)
+        print(f"--- SCHEMA: Adicionando coluna {table.name}.{name}... ---")
+        db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {col_type}"))
+    db.session.commit()
+
+@migration('0001_transactions_composite_indexes')
+def transactions_composite_indexes():
+    create_missing_indexes(Transaction.__table__)
+
+@migration('0002_fixed_expenses_materialized_until')
+def fixed_expenses_materialized_until():
+    # A marca d'água dos fixos de cartão (materialized_until) saiu com o RecurrenceService:
+    # a 0009 a deduz da última transação gerada de cada fixo e a 0016 remove a coluna
+    pass
+
+@migration('0003_monthly_rollups_backfill', after=[RollupService.rebuild])
+def monthly_rollups_backfill():
+    # A tabela vem do create_all; o recálculo lê as transações pelo modelo atual
+    pass
+
+@migration('0004_invoice_snapshots_backfill', after=[InvoiceSnapshotService.write_all])
+def invoice_snapshots_backfill():
+    # Os snapshots juntam as ocorrências virtuais (colunas da 0009)
+    pass
+
+@migration('0005_transactions_invoice_month')
+def transactions_invoice_month():
+    add_missing_columns(Transaction.__table__, 'invoice_year', 'invoice_month')
+    create_missing_indexes(Transaction.__table__)
+    cards = db.session.execute(select(CreditCard.id, CreditCard.closing_day).order_by(CreditCard.id)).all()
+    for card in cards:
+        TransactionService.refresh_invoice_months(card)
+        db.session.commit()
+
+# Marcadores que, antes das colunas estruturadas, só existiam no texto da descrição
+ANTICIPATED_MARKERS = ('(Ref:', '(Repassado', '(Antecipado)')
+INVOICE_PAYMENT_MARKERS = ('Pagamento Fatura', 'Pagamento de Cartão')
+
+def parse_reference_fields(description):
+    description = description or ''
+    match = re.search(r'Ref: (\d{2})/(\d{4})', description)
+    return {
+        'ref_year': int(match.group(2)) if match else None,
+        'ref_month': int(match.group(1)) if match else None,
+        'is_anticipated': any(m in description for m in ANTICIPATED_MARKERS),
+        'is_invoice_payment': any(m in description for m in INVOICE_PAYMENT_MARKERS),
+    }
+
+@migration('0006_transactions_reference_fields')
+def transactions_reference_fields():
+    add_missing_columns(Transaction.__table__, 'ref_year', 'ref_month', 'is_anticipated', 'is_invoice_payment')
+    create_missing_indexes(Transaction.__table__)
+
+    table = Transaction.__table__
+    db.session.execute(table.update().where(table.c.is_anticipated == None).values(is_anticipated=False))
+    db.session.execute(table.update().where(table.c.is_invoice_payment == None).values(is_invoice_payment=False))
+
+    # Backfill: só as descrições com algum marcador precisam ser interpretadas
+    markers = ('Ref: ',) + ANTICIPATED_MARKERS + INVOICE_PAYMENT_MARKERS
+    rows = db.session.query(Transaction.id, Transaction.description).filter(
+        or_(*[Transaction.description.like(f"%{m}%") for m in markers])
+    ).all()
+    mappings = [dict(id=trans_id, **parse_reference_fields(description)) for trans_id, description in rows]
+    if mappings:
+        db.session.execute(update(Transaction), mappings)
+    db.session.commit()
+
+@migration('0007_users_data_version')
+def users_data_version():
+    add_missing_columns(User.__table__, 'data_version')
+    users = User.__table__
+    db.session.execute(users.update().where(users.c.data_version == None).values(data_version=0))
+    db.session.commit()
+
+@migration('0008_avatars_content_addressed')
+def avatars_content_addressed():
+    """Leva os avatares enviados antes do pipeline para o armazenamento por conteúdo, já com as miniaturas."""
+    upload_folder = os.path.join(current_app.root_path, 'static', 'uploads')
+    users = User.__table__
+    rows = db.session.execute(select(users.c.id, users.c.avatar_path).where(
+        users.c.avatar_path != None, ~users.c.avatar_path.startswith(AVATAR_PREFIX)
+    )).all()
+    for user_id, avatar_path in rows:
+        path = os.path.join(upload_folder, avatar_path)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, 'rb') as f:
+                key = AvatarService.store(f.read())
+            AvatarService.render_all(AvatarService.storage_root(), key)
+        except AvatarError as e:
+            print(f"--- SCHEMA: Avatar {avatar_path} mantido como está: {e} ---")
+            continue
+        # O arquivo antigo continua em uploads/ (páginas ainda em cache apontam para ele)
+        db.session.execute(users.update().where(users.c.id == user_id).values(avatar_path=AVATAR_PREFIX + key))
+    db.session.commit()
+
+def fixed_recurrence_columns():
+    add_missing_columns(FixedExpense.__table__, 'start_date', 'end_date')
+    add_missing_columns(FixedRevenue.__table__, 'start_date', 'end_date')
+    add_missing_columns(Transaction.__table__, 'occurrence_date')
+    create_missing_indexes(Transaction.__table__)
+
+@migration('0009_fixed_recurrence')
+def fixed_recurrence():
+    """
+    Fixos passam a gerar as ocorrências sob demanda (RecurrenceService). Os lançamentos
+    de cartão já gravados ficam como estão e o plano começa depois da marca d'água
+    (materialized_until), então nada é contado duas vezes; os fixos de conta valem
+    desde o início do usuário. As transações ligadas a um fixo ganham o occurrence_date.
+    """
+    fixed_recurrence_columns()
+    today = date.today()
+
+    # Marca d'água: a coluna gravada pela renovação antiga ou, nos bancos em que ela
+    # não existe, a última transação gerada de cada fixo
+    if 'materialized_until' in existing_column_names('fixed_expenses'):
+        legacy = table('fixed_expenses', column('id'), column('materialized_until', db.Date))
+        watermarks = dict(db.session.execute(select(legacy.c.id, legacy.c.materialized_until)).all())
+    else:
+        watermarks = dict(db.session.query(Transaction.fixed_expense_id, func.max(Transaction.date)).filter(
+            Transaction.fixed_expense_id != None
+        ).group_by(Transaction.fixed_expense_id).all())
+
+    first_dates = dict(db.session.query(Transaction.user_id, func.min(Transaction.date)).group_by(Transaction.user_id).all())
+    user_starts = {}
+    for user_id, start_date in db.session.execute(select(User.id, User.start_date)):
+        user_starts[user_id] = (start_date or first_dates.get(user_id) or today).replace(day=1)
+
+    days = {}
+    for model in (FixedExpense, FixedRevenue):
+        columns = [model.id, model.user_id, model.day_of_month, model.start_date]
+        if model is FixedExpense:
+            columns.append(model.card_id)
+        starts = []
+        for fixed in db.session.execute(select(*columns)):
+            days[(model, fixed.id)] = fixed.day_of_month
+            if fixed.start_date is not None:
+                continue
+            if model is FixedExpense and fixed.card_id:
+                materialized_until = watermarks.get(fixed.id)
+                start_date = materialized_until + timedelta(days=1) if materialized_until else today
+            else:
+                start_date = user_starts.get(fixed.user_id, today.replace(day=1))
+            starts.append({'id': fixed.id, 'start_date': start_date})
+        if starts:
+            db.session.execute(update(model), starts)
+
+    rows = db.session.query(
+        Transaction.id, Transaction.date, Transaction.card_id, Transaction.is_anticipated,
+        Transaction.ref_year, Transaction.ref_month, Transaction.fixed_expense_id, Transaction.fixed_revenue_id
+    ).filter(
+        Transaction.occurrence_date == None,
+        or_(Transaction.fixed_expense_id != None, Transaction.fixed_revenue_id != None)
+    ).all()
+    mappings = []
+    for row in rows:
+        if row.fixed_expense_id:
+            day_of_month = days.get((FixedExpense, row.fixed_expense_id))
+        else:
+            day_of_month = days.get((FixedRevenue, row.fixed_revenue_id))
+        if day_of_month is None:
+            continue
+        if row.card_id:
+            # Antecipadas de cartão perderam a data original
+            if not row.is_anticipated:
+                mappings.append({'id': row.id, 'occurrence_date': row.date})
+        else:
+            year, month = (row.ref_year, row.ref_month) if row.ref_year else (row.date.year, row.date.month)
+            mappings.append({'id': row.id, 'occurrence_date': TransactionService.get_safe_date(year, month, day_of_month)})
+    if mappings:
+        db.session.execute(update(Transaction), mappings)
+    db.session.commit()
+
+INSTALLMENT_SUFFIX = re.compile(r'\s*\((\d+)/(\d+)\)$')
+
+def installment_plan_from_rows(rows):
+    """
+    Plano equivalente às parcelas gravadas de uma compra, reconstruído pelas que
+    não foram antecipadas (estas perderam o vencimento original). None se não der.
+    """
+    count = rows[0].installment_total
+    regular = [t for t in rows if '(Antecipado)' not in t.description and 1 <= t.installment_current <= count]
+    if not regular or len({(t.user_id, t.card_id) for t in rows}) > 1:
+        return None
+    reference = regular[0]
+    # O dia do vencimento só é reduzido nos meses curtos: o maior dia é o original
+    day = max(t.date.day for t in regular)
+    first_index = reference.date.year * 12 + reference.date.month - 1 - (reference.installment_current - 1)
+    year, month = divmod(first_index, 12)
+    amounts = [Decimal(str(t.amount)) for t in regular]
+    installment_amount = max(set(amounts), key=amounts.count)
+
+    plan = InstallmentPlan(
+        user_id=reference.user_id, identifier=reference.installment_identifier,
+        description=INSTALLMENT_SUFFIX.sub('', reference.description),
+        total_amount=installment_amount * count, installment_count=count,
+        first_date=TransactionService.get_safe_date(year, month + 1, day),
+        card_id=reference.card_id, category_id=reference.category_id,
+        is_anticipated=reference.is_anticipated, created_at=min((t.created_at for t in rows if t.created_at), default=None)
+    )
+    plan.last_date = InstallmentService.schedule(plan)[-1][1]
+    return plan
+
+@migration('0010_installment_plans', after=[RollupService.rebuild])
+def installment_plans():
+    """
+    Cada compra parcelada vira uma linha em installment_plans. Das parcelas gravadas
+    só ficam as que diferem do que o plano gera (antecipadas, editadas), como
+    exceções; as que faltam (excluídas) são registradas em fixed_skips. Os rollups
+    são recalculados depois (as parcelas virtuais não entram neles).
+    """
+    add_missing_columns(FixedSkip.__table__, 'installment_plan_id')
+    create_missing_indexes(Transaction.__table__)
+
+    known = {identifier for (identifier,) in db.session.query(InstallmentPlan.identifier).all()}
+    rows = db.session.execute(select(
+        Transaction.id, Transaction.user_id, Transaction.description, Transaction.amount, Transaction.date,
+        Transaction.category_id, Transaction.account_id, Transaction.card_id, Transaction.installment_identifier,
+        Transaction.installment_current, Transaction.installment_total, Transaction.is_anticipated, Transaction.created_at
+    ).where(
+        Transaction.installment_identifier != None,
+        Transaction.installment_total > 1,
+        Transaction.card_id != None,
+        Transaction.type == 'despesa',
+        Transaction.fixed_expense_id == None
+    ).order_by(Transaction.installment_identifier, Transaction.installment_current)).all()
+
+    groups = {}
+    for trans in rows:
+        if trans.installment_identifier not in known:
+            groups.setdefault(trans.installment_identifier, []).append(trans)
+
+    redundant, skips = [], []
+    for identifier, group in groups.items():
+        plan = installment_plan_from_rows(group)
+        if plan is None:
+            continue
+        db.session.add(plan)
+        db.session.flush()
+        by_number = {}
+        for trans in group:
+            by_number.setdefault(trans.installment_current, []).append(trans)
+        for number, installment_date, amount in InstallmentService.schedule(plan):
+            stored = by_number.get(number)
+            if not stored:
+                skips.append({'user_id': plan.user_id, 'installment_plan_id': plan.id, 'occurrence_date': installment_date})
+                continue
+            trans = stored[0]
+            generated = (installment_date, amount, f"{plan.description} ({number}/{plan.installment_count})", plan.category_id, plan.is_anticipated)
+            if len(stored) == 1 and trans.account_id is None and \
+                    (trans.date, Decimal(str(trans.amount)), trans.description, trans.category_id, trans.is_anticipated) == generated:
+                redundant.append(trans.id)
+
+    if skips:
+        db.session.execute(FixedSkip.__table__.insert(), skips)
+    for i in range(0, len(redundant), 500):
+        db.session.execute(delete(Transaction).where(Transaction.id.in_(redundant[i:i + 500])))
+    db.session.commit()
+    print(f"--- SCHEMA: {len(groups)} compras parceladas convertidas, {len(redundant)} parcelas gravadas removidas. ---")
+
+@migration('0011_transactions_import_hash')
+def transactions_import_hash():
+    add_missing_columns(Transaction.__table__, 'import_hash')
+    create_missing_indexes(Transaction.__table__)
+
+@migration('0012_transactions_description_search')
+def transactions_description_search():
+    # FULLTEXT no MySQL; no SQLite, tabela FTS5 + triggers, já com as transações existentes
+    SearchService.create_index()
+
+def monthly_rollups_indexes():
+    create_missing_indexes(MonthlyRollup.__table__)
+
+@migration('0013_monthly_rollups_unique_key', after=[RollupService.rebuild, monthly_rollups_indexes])
+def monthly_rollups_unique_key():
+    # O recálculo junta as linhas duplicadas por escritas concorrentes antes do índice UNIQUE
+    pass
+
+@migration('0014_transactions_invoice_payment_link')
+def transactions_invoice_payment_link():
+    add_missing_columns(Transaction.__table__, 'paired_transaction_id')
+    create_missing_indexes(Transaction.__table__)
+
+    # Backfill: liga cada saída 'Pagamento Fatura <cartão>' ao 'pagamento_cartao' do mesmo
+    # dia e valor, preferindo o cartão com esse nome (que pode ter sido renomeado depois)
+    table, cards = Transaction.__table__, CreditCard.__table__
+    bank_rows = db.session.execute(
+        select(table.c.id, table.c.user_id, table.c.date, table.c.amount, table.c.description)
+        .where(table.c.is_invoice_payment == True, table.c.account_id != None,
+               table.c.type == 'despesa', table.c.paired_transaction_id == None)
+        .order_by(table.c.id)
+    ).all()
+    if not bank_rows:
+        return
+
+    card_rows = db.session.execute(
+        select(table.c.id, table.c.user_id, table.c.date, table.c.amount, cards.c.name)
+        .join(cards, cards.c.id == table.c.card_id)
+        .where(table.c.type == 'pagamento_cartao',
+               ~table.c.id.in_(select(table.c.paired_transaction_id).where(table.c.paired_transaction_id != None)))
+        .order_by(table.c.id)
+    ).all()
+    candidates = {}
+    for card_trans_id, user_id, day, amount, card_name in card_rows:
+        candidates.setdefault((user_id, day, amount), []).append((card_trans_id, card_name))
+
+    mappings = []
+    for trans_id, user_id, day, amount, description in bank_rows:
+        group = candidates.get((user_id, day, amount))
+        if not group:
+            continue
+        card_name = description[len('Pagamento Fatura '):] if description.startswith('Pagamento Fatura ') else None
+        match = next((c for c in group if c[1] == card_name), None)
+        if match is None and len(group) == 1:
+            match = group[0]
+        if match is not None:
+            group.remove(match)
+            mappings.append({'id': trans_id, 'paired_transaction_id': match[0]})
+    if mappings:
+        db.session.execute(update(Transaction), mappings)
+    db.session.commit()
+    print(f"--- SCHEMA: {len(mappings)} pagamentos de fatura ligados ao lançamento do cartão. ---")
+
+@migration('0015_credit_cards_snapshot_version')
+def credit_cards_snapshot_version():
+    add_missing_columns(CreditCard.__table__, 'snapshot_version')
+    cards = CreditCard.__table__
+    db.session.execute(cards.update().where(cards.c.snapshot_version == None).values(snapshot_version=0))
+    db.session.commit()
+
+@migration('0016_fixed_expenses_drop_materialized_until')
+def fixed_expenses_drop_materialized_until():
+    # Só a 0009 lia a marca d'água; os fixos de cartão não são mais gravados antecipadamente
+    if 'materialized_until' in existing_column_names('fixed_expenses'):
+        print("--- SCHEMA: Removendo coluna fixed_expenses.materialized_until... ---")
+        db.session.execute(text("ALTER TABLE fixed_expenses DROP COLUMN materialized_until"))
+    db.session.commit()
+
+def upgrade_schema():
+    """
+    Aplica as migrações pendentes e, em seguida, os passos `after` delas (cada um
+    uma vez, na ordem em que aparecem). Uma migração com passos `after` só é
+    registrada depois deles. Pressupõe que db.create_all() já rodou (inclusive
+    para a própria tabela schema_migrations).
+    """
+    applied = {m.name for m in SchemaMigration.query.all()}
+    deferred, waiting = [], []
+    for name, func, after in MIGRATIONS:
+        if name in applied:
+            continue
+        print(f"--- SCHEMA: Aplicando migração {name}... ---")
+        func()
+        if after:
+            deferred += [step for step in after if step not in deferred]
+            waiting.append(name)
+        else:
+            db.session.add(SchemaMigration(name=name))
+            db.session.commit()
+
+    # Com o esquema já igual ao dos modelos
+    for step in deferred:
+        print(f"--- SCHEMA: Executando {step.__qualname__}... ---")
+        step()
+    for name in waiting:
+        db.session.add(SchemaMigration(name=name))
+    db.session.commit()
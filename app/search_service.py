@@ -0,0 +1,218 @@
+import re
+import json
+import base64
+
+from sqlalchemy import select, table, column, literal_column, type_coerce, text, inspect, or_, and_, null, Float
+
+from app import db
+from app.models import Transaction, InstallmentPlan, FixedExpense, FixedRevenue, Category, CreditCard, BankAccount
+from app.export_service import ExportService
+
+# --- BUSCA TEXTUAL NAS DESCRIÇÕES ---
+# A descrição das transações tem um índice de texto: FULLTEXT no MySQL e, no modo
+# local, uma tabela FTS5 de conteúdo externo (transactions_fts) mantida por
+# triggers. Cada palavra buscada vira um prefixo obrigatório ("amaz" acha
+# "Amazon"); os resultados saem por relevância e são paginados por keyset
+# (relevância, id), sem OFFSET. As compras parceladas e os fixos (despesas e
+# receitas), cujas ocorrências não são gravadas, são buscados nos próprios planos
+# (poucos por usuário), com a mesma regra de prefixo por palavra.
+
+FTS_TABLE = 'transactions_fts'
+FULLTEXT_INDEX = 'ft_transactions_description'
+MAX_TERMS = 8
+MAX_PAGE = 100
+
+SQLITE_FTS = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(description, content='transactions', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF description ON transactions BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+)
+
+class SearchService:
+
+    @staticmethod
+    def is_mysql():
+        return db.engine.dialect.name == 'mysql'
+
+    @staticmethod
+    def create_index():
+        """Cria o índice de texto (e, no SQLite, indexa as transações já gravadas)."""
+        if SearchService.is_mysql():
+            if FULLTEXT_INDEX not in {ix['name'] for ix in inspect(db.engine).get_indexes('transactions')}:
+                db.session.execute(text(f"ALTER TABLE transactions ADD FULLTEXT INDEX {FULLTEXT_INDEX} (description)"))
+        else:
+            for statement in SQLITE_FTS:
+                db.session.execute(text(statement))
+        db.session.commit()
+
+    @staticmethod
+    def terms(query_text):
+        return re.findall(r'\w+', query_text or '')[:MAX_TERMS]
+
+    @staticmethod
+    def match_expression(terms):
+        """Todas as palavras, cada uma como prefixo, na sintaxe do índice."""
+        if SearchService.is_mysql():
+            return ' '.join(f'+{term}*' for term in terms)
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    # --- CURSOR ---
+
+    @staticmethod
+    def encode_cursor(score, trans_id):
+        return base64.urlsafe_b64encode(json.dumps([score, trans_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(value):
+        """(relevância, id) da última linha da página anterior. ValueError se inválido."""
+        if not value:
+            return None
+        try:
+            score, trans_id = json.loads(base64.urlsafe_b64decode(value.encode()))
+            return float(score), int(trans_id)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise ValueError('Cursor inválido.')
+
+    # --- BUSCA ---
+
+    @staticmethod
+    def search(user_id, query_text, filters, limit, cursor=None):
+        """
+        Uma página de transações gravadas (como no export, mais 'score'), da mais
+        relevante para a menos; empates pela mais recente. Retorna (itens, próximo cursor).
+        """
+        terms = SearchService.terms(query_text)
+        if not terms:
+            return [], None
+        expression = SearchService.match_expression(terms)
+
+        if SearchService.is_mysql():
+            match = Transaction.description.match(expression)
+            query = ExportService.ledger_query(user_id, filters, type_coerce(match, Float).label('score')).where(match)
+        else:
+            # rank do FTS5 é o bm25 (menor = mais relevante). O MATCH fica numa CTE
+            # materializada: junto com os filtros de data, o planejador percorreria o
+            # índice de data e consultaria o FTS linha a linha.
+            fts = table(FTS_TABLE, column('rowid'), column('rank'))
+            matches = select(fts.c.rowid, fts.c.rank) \
+                .where(literal_column(FTS_TABLE).op('MATCH')(expression)) \
+                .cte('matches').prefix_with('MATERIALIZED')
+            query = ExportService.ledger_query(user_id, filters, (-matches.c.rank).label('score')) \
+                .join(matches, matches.c.rowid == Transaction.id)
+
+        ranked = query.subquery()
+        page = select(ranked)
+        if cursor:
+            last_score, last_id = cursor
+            page = page.where(or_(ranked.c.score < last_score, and_(ranked.c.score == last_score, ranked.c.id < last_id)))
+        rows = db.session.execute(page.order_by(ranked.c.score.desc(), ranked.c.id.desc()).limit(limit + 1)).all()
+
+        items = []
+        for row in rows[:limit]:
+            item = ExportService.ledger_row(row)
+            item['score'] = round(row.score, 4)
+            items.append(item)
+        next_cursor = SearchService.encode_cursor(rows[limit - 1].score, rows[limit - 1].id) if len(rows) > limit else None
+        return items, next_cursor
+
+    # --- PLANOS (PARCELADOS E FIXOS) ---
+
+    @staticmethod
+    def matches_prefixes(description, terms):
+        """Cada palavra buscada é prefixo de alguma palavra da descrição (como no índice)."""
+        words = [word.casefold() for word in re.findall(r'\w+', description or '')]
+        return all(any(word.startswith(term.casefold()) for word in words) for term in terms)
+
+    @staticmethod
+    def plan_matches(query, description_column, terms, limit):
+        """
+        Os planos não têm índice de texto: o LIKE '%palavra%' pré-filtra no banco e
+        matches_prefixes aplica a regra de prefixo. Diferença para as transações:
+        acentos precisam coincidir ("cafe" não acha "Café").
+        """
+        for term in terms:
+            query = query.filter(description_column.contains(term, autoescape=True))
+        found = []
+        for row in query:
+            if SearchService.matches_prefixes(row[0].description, terms):
+                found.append(row)
+                if len(found) == limit:
+                    break
+        return found
+
+    @staticmethod
+    def search_plans(user_id, query_text, filters, limit):
+        """Compras parceladas com todas as palavras na descrição (valor = total da compra)."""
+        terms = SearchService.terms(query_text)
+        if not terms or filters['account_id']:
+            return []
+        query = db.session.query(InstallmentPlan, CreditCard.name, Category.name) \
+            .join(CreditCard, CreditCard.id == InstallmentPlan.card_id) \
+            .outerjoin(Category, Category.id == InstallmentPlan.category_id) \
+            .filter(InstallmentPlan.user_id == user_id)
+
+        if filters['start']: query = query.filter(InstallmentPlan.last_date >= filters['start'])
+        if filters['end']: query = query.filter(InstallmentPlan.first_date <= filters['end'])
+        if filters['card_id']: query = query.filter(InstallmentPlan.card_id == filters['card_id'])
+        if filters['category_id']: query = query.filter(InstallmentPlan.category_id == filters['category_id'])
+        if filters['min_amount'] is not None: query = query.filter(InstallmentPlan.total_amount >= filters['min_amount'])
+        if filters['max_amount'] is not None: query = query.filter(InstallmentPlan.total_amount <= filters['max_amount'])
+
+        query = query.order_by(InstallmentPlan.first_date.desc(), InstallmentPlan.id.desc())
+        return [
+            {
+                'id': plan.id, 'description': plan.description, 'total_amount': round(float(plan.total_amount), 2),
+                'installment_count': plan.installment_count, 'first_date': plan.first_date.isoformat(),
+                'last_date': plan.last_date.isoformat(), 'card': card, 'category': category
+            }
+            for plan, card, category in SearchService.plan_matches(query, InstallmentPlan.description, terms, limit)
+        ]
+
+    @staticmethod
+    def search_fixed(user_id, query_text, filters, limit):
+        """Despesas e receitas fixas com todas as palavras na descrição (valor = valor mensal)."""
+        terms = SearchService.terms(query_text)
+        if not terms:
+            return []
+
+        found = []
+        for model, kind in ((FixedExpense, 'despesa'), (FixedRevenue, 'receita')):
+            card_id = getattr(model, 'card_id', None)
+            if filters['card_id'] and card_id is None:
+                continue
+            card_name = CreditCard.name if card_id is not None else null()
+            query = db.session.query(model, BankAccount.name, card_name, Category.name) \
+                .outerjoin(BankAccount, BankAccount.id == model.account_id) \
+                .outerjoin(Category, Category.id == model.category_id) \
+                .filter(model.user_id == user_id)
+            if card_id is not None:
+                query = query.outerjoin(CreditCard, CreditCard.id == card_id)
+
+            # Vigência do plano sobrepondo o período pedido
+            if filters['start']: query = query.filter(or_(model.end_date.is_(None), model.end_date >= filters['start']))
+            if filters['end']: query = query.filter(or_(model.start_date.is_(None), model.start_date <= filters['end']))
+            if filters['account_id']: query = query.filter(model.account_id == filters['account_id'])
+            if filters['card_id']: query = query.filter(card_id == filters['card_id'])
+            if filters['category_id']: query = query.filter(model.category_id == filters['category_id'])
+            if filters['min_amount'] is not None: query = query.filter(model.amount >= filters['min_amount'])
+            if filters['max_amount'] is not None: query = query.filter(model.amount <= filters['max_amount'])
+
+            query = query.order_by(model.description, model.id)
+            found += [
+                {
+                    'id': fixed.id, 'type': kind, 'description': fixed.description, 'amount': round(float(fixed.amount), 2),
+                    'day_of_month': fixed.day_of_month,
+                    'start_date': fixed.start_date.isoformat() if fixed.start_date else None,
+                    'end_date': fixed.end_date.isoformat() if fixed.end_date else None,
+                    'account': account, 'card': card, 'category': category
+                }
+                for fixed, account, card, category in SearchService.plan_matches(query, model.description, terms, limit)
+            ]
+        return found[:limit]
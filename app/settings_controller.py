@@ -1,18 +1,27 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, session, abort
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 from app import db
 # CORREÇÃO: Removido MonthlyClosing da importação
-from app.models import Category, BankAccount, CreditCard, FixedExpense, FixedRevenue, Transaction
+from app.models import Category, BankAccount, CreditCard, FixedExpense, FixedRevenue, FixedSkip, InstallmentPlan, Transaction, MonthlyRollup, InvoiceSnapshot
 from datetime import datetime, date
+from decimal import Decimal
 import os
 import secrets
 from app.email_utils import send_email 
+from app.rollup_service import RollupService
+from app.transaction_service import TransactionService
+from app.recurrence_service import RecurrenceService
+from app.dashboard_cache import invalidates_dashboard
+from app.user_data import UserData
+from app.user_cache import UserCache
+from app.avatar_service import AvatarService, AvatarError, KEY_PATTERN
+from app.import_service import ImportService, StatementError
 
 settings_bp = Blueprint('settings', __name__)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -21,6 +30,7 @@ def allowed_file(filename):
 @login_required
 def index():
     active_tab = request.args.get('tab', 'categories')
+    UserData.get()
     # used_colors não é mais necessário na view, mas mantemos compatibilidade se precisar
     return render_template('components/settings.html', 
                          user=current_user, 
@@ -29,6 +39,7 @@ def index():
 # --- CATEGORIAS ---
 @settings_bp.route('/settings/category/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_category():
     name = request.form.get('name')
     cat_type = request.form.get('type')
@@ -49,6 +60,7 @@ def add_category():
 
 @settings_bp.route('/settings/category/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_category(id):
     cat = Category.query.get_or_404(id)
     if cat.user_id != current_user.id: return redirect(url_for('settings.index'))
@@ -61,6 +73,7 @@ def edit_category(id):
 
 @settings_bp.route('/settings/category/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_category(id):
     cat = Category.query.get_or_404(id)
     if cat.user_id != current_user.id: return redirect(url_for('settings.index'))
@@ -71,7 +84,7 @@ def delete_category(id):
         return redirect(url_for('settings.index', tab='categories'))
 
     # Verifica uso em transações
-    if Transaction.query.filter_by(category_id=id).first():
+    if Transaction.query.filter_by(category_id=id).first() or InstallmentPlan.query.filter_by(category_id=id).first():
         flash('Não é possível excluir: existem transações usando esta categoria.', 'danger')
     # Verifica uso em fixos
     elif FixedExpense.query.filter_by(category_id=id).first() or FixedRevenue.query.filter_by(category_id=id).first():
@@ -85,6 +98,7 @@ def delete_category(id):
 # --- CONTAS ---
 @settings_bp.route('/settings/account/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_account():
     name = request.form.get('name')
     initial = float(request.form.get('initial_balance', 0))
@@ -97,6 +111,7 @@ def add_account():
 
 @settings_bp.route('/settings/account/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_account(id):
     acc = BankAccount.query.get_or_404(id)
     if acc.user_id != current_user.id: return redirect(url_for('settings.index'))
@@ -108,6 +123,7 @@ def edit_account(id):
 
 @settings_bp.route('/settings/account/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_account(id):
     acc = BankAccount.query.get_or_404(id)
     if acc.user_id != current_user.id: return redirect(url_for('settings.index'))
@@ -124,9 +140,48 @@ def delete_account(id):
         flash('Conta removida!', 'success')
     return redirect(url_for('settings.index', tab='accounts'))
 
+@settings_bp.route('/settings/account/import', methods=['POST'])
+@login_required
+@invalidates_dashboard
+def import_statement():
+    # Antes de ler o formulário: o corpo só é processado se couber no limite
+    # (uploads sem Content-Length esbarram no MAX_CONTENT_LENGTH do Werkzeug)
+    if request.content_length and request.content_length > current_app.config['IMPORT_MAX_BYTES']:
+        flash('Arquivo de extrato muito grande.', 'danger')
+        return redirect(url_for('settings.index', tab='accounts'))
+
+    acc = BankAccount.query.filter_by(id=request.form.get('account_id', type=int), user_id=current_user.id).first()
+    expense_category = Category.query.filter_by(id=request.form.get('expense_category_id', type=int), user_id=current_user.id, type='despesa').first()
+    revenue_category = Category.query.filter_by(id=request.form.get('revenue_category_id', type=int), user_id=current_user.id, type='receita').first()
+    file = request.files.get('statement')
+
+    if not acc or not expense_category or not revenue_category or not file or not file.filename:
+        flash('Selecione a conta, as categorias padrão e o arquivo do extrato.', 'danger')
+    else:
+        try:
+            result = ImportService.import_statement(current_user.id, file, acc, expense_category.id, revenue_category.id,
+                                                    current_user.start_date)
+            db.session.commit()
+        except StatementError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+        else:
+            message = (f'Extrato importado: {result.inserted} lançamentos novos, {result.duplicates} já importados antes '
+                       f'e {result.skipped} linhas ignoradas.')
+            if result.before_start:
+                message += f' {result.before_start} lançamentos anteriores ao seu início no sistema ({current_user.start_date.strftime("%m/%Y")}) não foram importados.'
+            flash(message, 'success')
+    return redirect(url_for('settings.index', tab='accounts'))
+
+@settings_bp.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    flash('Arquivo muito grande.', 'danger')
+    return redirect(url_for('settings.index'))
+
 # --- CARTÕES ---
 @settings_bp.route('/settings/card/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_card():
     name = request.form.get('name')
     limit = float(request.form.get('limit'))
@@ -168,16 +223,23 @@ def add_card():
 
 @settings_bp.route('/settings/card/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_card(id):
     card = CreditCard.query.get_or_404(id)
     if card.user_id != current_user.id: return redirect(url_for('settings.index'))
     
+    old_closing_day = card.closing_day
     card.name = request.form.get('name')
     card.limit_amount = float(request.form.get('limit'))
     card.closing_day = int(request.form.get('closing_day'))
     card.due_day = int(request.form.get('due_day'))
     card.brand = request.form.get('brand') # Atualiza a bandeira
     card.bank = request.form.get('bank')   # Atualiza o banco
+
+    # O fechamento define em qual fatura (mês) cada compra cai
+    if card.closing_day != old_closing_day:
+        TransactionService.refresh_invoice_months(card)
+        RollupService.refresh_user(current_user.id)
     
     db.session.commit()
     flash('Cartão atualizado!', 'success')
@@ -185,14 +247,17 @@ def edit_card(id):
 
 @settings_bp.route('/settings/card/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_card(id):
     card = CreditCard.query.get_or_404(id)
     if card.user_id != current_user.id: return redirect(url_for('settings.index'))
     
-    if Transaction.query.filter_by(card_id=id).first():
+    # Fixos do cartão já em vigor geram compras (virtuais) nas faturas
+    started_fixed = FixedExpense.query.filter(FixedExpense.card_id == id, FixedExpense.start_date <= date.today()).first()
+    if Transaction.query.filter_by(card_id=id).first() or InstallmentPlan.query.filter_by(card_id=id).first() or started_fixed:
         flash('Cartão possui faturas/compras e não pode ser excluído.', 'danger')
     else:
-        FixedExpense.query.filter_by(card_id=id).update({FixedExpense.card_id: None})
+        FixedExpense.query.filter_by(card_id=id).delete()
         db.session.delete(card)
         db.session.commit()
         flash('Cartão removido!', 'success')
@@ -201,6 +266,7 @@ def delete_card(id):
 # --- FIXOS ---
 @settings_bp.route('/settings/fixed/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_fixed():
     desc = request.form.get('description')
     amount = float(request.form.get('amount'))
@@ -220,8 +286,10 @@ def add_fixed():
     new_fix = FixedExpense(
         user_id=current_user.id, description=desc, amount=amount,
         day_of_month=day, category_id=cat_id, 
-        account_id=acc_id, card_id=card_id
+        account_id=acc_id, card_id=card_id,
+        start_date=date.today().replace(day=1)
     )
+    RecurrenceService.invalidate_snapshots(card_id, new_fix.start_date)
     db.session.add(new_fix)
     db.session.commit()
     flash('Despesa fixa agendada!', 'success')
@@ -229,23 +297,35 @@ def add_fixed():
 
 @settings_bp.route('/settings/fixed/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_fixed(id):
     fix = FixedExpense.query.get_or_404(id)
     if fix.user_id != current_user.id: return redirect(url_for('settings.index'))
     
-    fix.description = request.form.get('description')
-    fix.amount = float(request.form.get('amount'))
-    fix.day_of_month = int(request.form.get('day'))
-    fix.category_id = int(request.form.get('category_id'))
+    values = {
+        'description': request.form.get('description'),
+        'amount': Decimal(request.form.get('amount')),
+        'day_of_month': int(request.form.get('day')),
+        'category_id': int(request.form.get('category_id'))
+    }
     
     payment_method = request.form.get('payment_method')
     
     if payment_method == 'credit':
-        fix.card_id = int(request.form.get('card_id'))
-        fix.account_id = None
+        values['card_id'] = int(request.form.get('card_id'))
+        values['account_id'] = None
     else:
-        fix.account_id = int(request.form.get('account_id'))
-        fix.card_id = None
+        values['account_id'] = int(request.form.get('account_id'))
+        values['card_id'] = None
+    
+    # Fixo de cartão já em vigor: as ocorrências passadas (geradas, não gravadas)
+    # mantêm os valores antigos e os novos valem a partir de amanhã
+    today = date.today()
+    changed = any(getattr(fix, key) != value for key, value in values.items())
+    if changed and (fix.card_id or values['card_id']) and fix.start_date and fix.start_date <= today:
+        fix = RecurrenceService.split_plan(fix, today)
+    for key, value in values.items():
+        setattr(fix, key, value)
     
     db.session.commit()
     flash('Despesa fixa atualizada!', 'success')
@@ -257,15 +337,14 @@ def edit_fixed(id):
 
 @settings_bp.route('/settings/fixed/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_fixed(id):
     fix = FixedExpense.query.get_or_404(id)
     if fix.user_id != current_user.id: return redirect(url_for('settings.index'))
     
     try:
-        # Desvincula transações passadas para evitar erro de integridade
-        Transaction.query.filter_by(fixed_expense_id=id).update({Transaction.fixed_expense_id: None})
-        
-        db.session.delete(fix)
+        # Encerra o plano hoje: as ocorrências passadas continuam valendo
+        RecurrenceService.end_plan(fix, date.today())
         db.session.commit()
         flash('Despesa fixa encerrada! O histórico foi mantido.', 'success')
     except Exception as e:
@@ -277,6 +356,7 @@ def delete_fixed(id):
 
 @settings_bp.route('/settings/revenue/add', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def add_fixed_revenue():
     desc = request.form.get('description')
     amount = float(request.form.get('amount'))
@@ -286,7 +366,8 @@ def add_fixed_revenue():
     
     new_rev = FixedRevenue(
         user_id=current_user.id, description=desc, amount=amount,
-        day_of_month=day, category_id=cat_id, account_id=acc_id
+        day_of_month=day, category_id=cat_id, account_id=acc_id,
+        start_date=date.today().replace(day=1)
     )
     db.session.add(new_rev)
     db.session.commit()
@@ -295,6 +376,7 @@ def add_fixed_revenue():
 
 @settings_bp.route('/settings/revenue/edit/<int:id>', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def edit_fixed_revenue(id):
     rev = FixedRevenue.query.get_or_404(id)
     if rev.user_id != current_user.id: return redirect(url_for('settings.index'))
@@ -315,15 +397,13 @@ def edit_fixed_revenue(id):
 
 @settings_bp.route('/settings/revenue/delete/<int:id>')
 @login_required
+@invalidates_dashboard
 def delete_fixed_revenue(id):
     rev = FixedRevenue.query.get_or_404(id)
     if rev.user_id != current_user.id: return redirect(url_for('settings.index'))
     
     try:
-        # Desvincula transações passadas
-        Transaction.query.filter_by(fixed_revenue_id=id).update({Transaction.fixed_revenue_id: None})
-        
-        db.session.delete(rev)
+        RecurrenceService.end_plan(rev, date.today())
         db.session.commit()
         flash('Receita fixa encerrada! O histórico foi mantido.', 'success')
     except Exception as e:
@@ -337,6 +417,7 @@ def delete_fixed_revenue(id):
 
 @settings_bp.route('/settings/profile/update', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def update_profile():
     name = request.form.get('name')
     last_name = request.form.get('last_name')
@@ -349,6 +430,7 @@ def update_profile():
 
 @settings_bp.route('/settings/profile/avatar', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def upload_avatar():
     if 'avatar' not in request.files:
         flash('Nenhum arquivo enviado.', 'danger')
@@ -361,31 +443,35 @@ def upload_avatar():
         return redirect(url_for('settings.index', tab='account'))
         
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        unique_filename = f"{current_user.id}_{int(datetime.utcnow().timestamp())}_{filename}"
-        
-        upload_folder = os.path.join(current_app.root_path, 'static', 'uploads')
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-            
-        file.save(os.path.join(upload_folder, unique_filename))
-        
-        if current_user.avatar_path:
-            old_path = os.path.join(upload_folder, current_user.avatar_path)
-            if os.path.exists(old_path):
-                try: os.remove(old_path)
-                except Exception as e: print(f"Erro ao deletar avatar antigo: {e}")
+        try:
+            # Grava o original (endereçado pelo conteúdo); as miniaturas são geradas em segundo plano
+            avatar_path = AvatarService.save_upload(file)
+        except AvatarError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('settings.index', tab='account'))
 
-        current_user.avatar_path = unique_filename
+        if current_user.avatar_path != avatar_path:
+            AvatarService.release(current_user.avatar_path, current_user.id)
+
+        current_user.avatar_path = avatar_path
         db.session.commit()
         flash('Foto de perfil atualizada!', 'success')
     else:
-        flash('Tipo de arquivo não permitido (apenas PNG, JPG, JPEG, GIF).', 'danger')
+        flash('Tipo de arquivo não permitido (apenas PNG, JPG, JPEG, GIF, WEBP).', 'danger')
         
     return redirect(url_for('settings.index', tab='account'))
 
+@settings_bp.route('/avatars/<key>/<variant>')
+def serve_avatar(key, variant):
+    if not KEY_PATTERN.match(key) or not AvatarService.is_variant(variant):
+        abort(404)
+    if not os.path.exists(os.path.join(AvatarService.storage_root(), key, 'source')):
+        abort(404)
+    return AvatarService.send(key, variant)
+
 @settings_bp.route('/settings/security/email', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def request_email_change():
     new_email = request.form.get('new_email')
     
@@ -398,8 +484,6 @@ def request_email_change():
     current_user.auth_token = token
     current_user.token_expiration = datetime.utcnow().replace(hour=23, minute=59) 
     
-    db.session.commit()
-    
     link = url_for('settings.confirm_email_change', token=token, _external=True)
     try:
         # --- CÓDIGO NOVO ---
@@ -417,9 +501,12 @@ def request_email_change():
             subject="Confirme seu novo e-mail",
             html_content=html_content
         )
+        # Token e e-mail na mesma transação
+        db.session.commit()
         
         flash(f'Link de confirmação enviado para {new_email}. Verifique sua caixa de entrada.', 'info')
     except Exception as e:
+        db.session.rollback()
         print(f"Erro no envio de email: {e}")
         flash('Erro ao enviar e-mail. Tente novamente mais tarde.', 'danger')
         
@@ -440,6 +527,7 @@ def confirm_email_change(token):
     user.pending_email = None
     user.auth_token = None
     user.is_verified = True
+    UserCache.invalidate(user.id)
     db.session.commit()
     
     flash('E-mail alterado com sucesso! Faça login com o novo endereço.', 'success')
@@ -447,6 +535,7 @@ def confirm_email_change(token):
 
 @settings_bp.route('/settings/security/password', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def change_password():
     current_pass = request.form.get('current_password')
     new_pass = request.form.get('new_password')
@@ -472,6 +561,7 @@ def change_password():
 
 @settings_bp.route('/settings/account/reset', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def reset_data():
     password = request.form.get('password')
     # ALTERAÇÃO: Removido start_option e retro_date. Data sempre é HOJE.
@@ -485,7 +575,11 @@ def reset_data():
 
     try:
         Transaction.query.filter_by(user_id=current_user.id).delete()
+        MonthlyRollup.query.filter_by(user_id=current_user.id).delete()
+        InvoiceSnapshot.query.filter_by(user_id=current_user.id).delete()
         # CORREÇÃO: Linha de MonthlyClosing removida
+        FixedSkip.query.filter_by(user_id=current_user.id).delete()
+        InstallmentPlan.query.filter_by(user_id=current_user.id).delete()
         FixedExpense.query.filter_by(user_id=current_user.id).delete()
         FixedRevenue.query.filter_by(user_id=current_user.id).delete()
         
@@ -522,6 +616,7 @@ def reset_data():
 
 @settings_bp.route('/settings/account/delete', methods=['POST'])
 @login_required
+@invalidates_dashboard
 def delete_user_account():
     password = request.form.get('password')
     
@@ -531,7 +626,11 @@ def delete_user_account():
     
     try:
         Transaction.query.filter_by(user_id=current_user.id).delete()
+        MonthlyRollup.query.filter_by(user_id=current_user.id).delete()
+        InvoiceSnapshot.query.filter_by(user_id=current_user.id).delete()
         # CORREÇÃO: Linha de MonthlyClosing removida
+        FixedSkip.query.filter_by(user_id=current_user.id).delete()
+        InstallmentPlan.query.filter_by(user_id=current_user.id).delete()
         FixedExpense.query.filter_by(user_id=current_user.id).delete()
         FixedRevenue.query.filter_by(user_id=current_user.id).delete()
         
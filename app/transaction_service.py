@@ -1,9 +1,24 @@
 from app import db
-from app.models import Transaction, CreditCard, BankAccount, User, Category
-from sqlalchemy import func, extract, and_, or_
+from app.models import Transaction, CreditCard, BankAccount, User, Category, InvoiceSnapshot
+from sqlalchemy import func, extract, and_, or_, case, event, inspect, update, insert
+from sqlalchemy.orm import Session
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import calendar
+from decimal import Decimal
+
+# Atributos da Transaction que definem em qual fatura ela cai
+INVOICE_FIELDS = ('card_id', 'date', 'type')
+INVOICE_TYPES = ('despesa', 'pagamento_cartao')
+
+# Colunas opcionais preenchidas em todas as linhas do INSERT em lote (o executemany exige as mesmas chaves)
+BULK_DEFAULTS = {
+    'category_id': None, 'account_id': None, 'card_id': None,
+    'fixed_expense_id': None, 'fixed_revenue_id': None,
+    'installment_identifier': None, 'installment_current': None, 'installment_total': None,
+    'ref_year': None, 'ref_month': None, 'is_anticipated': False, 'is_invoice_payment': False,
+    'occurrence_date': None, 'import_hash': None, 'paired_transaction_id': None
+}
 
 class TransactionService:
     
@@ -12,10 +27,104 @@ class TransactionService:
         last_day = calendar.monthrange(year, month)[1]
         return date(year, month, min(day, last_day))
 
+    @staticmethod
+    def get_month_range(year, month):
+        """
+        Intervalo semiaberto [primeiro dia do mês, primeiro dia do mês seguinte).
+        Usado como 'date >= inicio AND date < fim', que aproveita os índices em date
+        (ao contrário de extract('month', ...), que obriga a varrer todas as linhas).
+        """
+        first_day = date(year, month, 1)
+        return first_day, first_day + relativedelta(months=1)
+
+    @staticmethod
+    def get_invoice_month(closing_day, trans_date):
+        """Fatura (ano, mês) de uma compra: depois do fechamento, cai na fatura seguinte."""
+        inv_date = trans_date + relativedelta(months=1) if trans_date.day > closing_day else trans_date
+        return inv_date.year, inv_date.month
+
+    @staticmethod
+    def refresh_invoice_months(card):
+        """
+        Recalcula invoice_year/invoice_month das transações do cartão (sem commit),
+        após mudança no dia de fechamento. UPDATE em lote pela chave primária.
+        """
+        rows = db.session.query(Transaction.id, Transaction.date).filter(
+            Transaction.card_id == card.id,
+            Transaction.type.in_(INVOICE_TYPES)
+        ).all()
+        mappings = []
+        for trans_id, trans_date in rows:
+            year, month = TransactionService.get_invoice_month(card.closing_day, trans_date)
+            mappings.append({'id': trans_id, 'invoice_year': year, 'invoice_month': month})
+        if mappings:
+            db.session.execute(update(Transaction), mappings)
+        return len(mappings)
+
     @staticmethod
     def calculate_card_date(purchase_date, card):
         return purchase_date
 
+    @staticmethod
+    def monthly_dates(start_date, day_of_month, count):
+        """
+        `count` datas mensais a partir do mês de start_date, no dia day_of_month
+        (ajustado ao último dia nos meses mais curtos), calculadas de uma vez.
+        """
+        first = start_date.year * 12 + start_date.month - 1
+        dates = []
+        for i in range(count):
+            year, month = divmod(first + i, 12)
+            dates.append(TransactionService.get_safe_date(year, month + 1, day_of_month))
+        return dates
+
+    @staticmethod
+    def bulk_insert(rows):
+        """
+        Grava as transações (dicionários de colunas) num único INSERT executemany,
+        sem a unit of work. Como os before_flush não rodam para elas, faz aqui o
+        mesmo: fatura (invoice_year/invoice_month), rollups mensais e invalidação
+        dos snapshots de fatura. Sem commit. Retorna a quantidade gravada.
+        """
+        if not rows:
+            return 0
+        # Importado aqui: rollup_service importa TransactionService
+        from app.rollup_service import RollupService
+
+        rows = [dict(BULK_DEFAULTS, **row) for row in rows]
+        closing_days, category_types = RollupService.load_lookups(
+            db.session, [r['card_id'] for r in rows], [r['category_id'] for r in rows]
+        )
+
+        for row in rows:
+            closing_day = closing_days.get(row['card_id'])
+            if row['card_id'] and row['type'] in INVOICE_TYPES and closing_day is not None:
+                row['invoice_year'], row['invoice_month'] = TransactionService.get_invoice_month(closing_day, row['date'])
+            else:
+                row['invoice_year'] = row['invoice_month'] = None
+
+        db.session.execute(insert(Transaction), rows)
+        TransactionService.apply_bulk_changes([(row, 1) for row in rows], closing_days, category_types)
+        return len(rows)
+
+    @staticmethod
+    def apply_bulk_changes(changes, closing_days, category_types):
+        """
+        Rollups mensais e invalidação dos snapshots para gravações em lote (que
+        não passam pelos before_flush). `changes` no formato de
+        RollupService.collect_changes: pares (valores das colunas, sinal).
+        """
+        from app.rollup_service import RollupService
+        from app.invoice_service import InvoiceSnapshotService
+
+        deltas, cutoffs = {}, {}
+        for values, sign in changes:
+            RollupService.merge_deltas(deltas, RollupService.get_deltas(values, sign, closing_days, category_types))
+            if values['card_id']:
+                cutoffs[values['card_id']] = min(cutoffs.get(values['card_id'], values['date']), values['date'])
+        RollupService.apply_deltas(db.session, deltas)
+        InvoiceSnapshotService.invalidate(db.session, cutoffs)
+
     @staticmethod
     def get_invoice_dates(card, ref_month, ref_year):
         closing_date = TransactionService.get_safe_date(ref_year, ref_month, card.closing_day)
@@ -33,98 +142,149 @@ class TransactionService:
     @staticmethod
     def get_card_stats(user_id, card_id, month, year):
         card = CreditCard.query.get(card_id)
+        return TransactionService._build_cards_stats(user_id, [card], month, year)[0]
+
+    @staticmethod
+    def get_all_card_stats(user_id, month, year, cards=None, card_plans=None, exceptions=None):
+        """
+        Calcula as estatísticas de TODOS os cartões do usuário de uma vez.
+        Uma única consulta agrupada por cartão substitui as seis somas
+        que get_card_stats fazia para cada cartão individualmente.
+        cards: os cartões do usuário já carregados (ordenados por id), se houver.
+        card_plans/exceptions: fixos de cartão e exceções deles, se já carregados.
+        """
+        if cards is None:
+            cards = CreditCard.query.filter_by(user_id=user_id).order_by(CreditCard.id).all()
+        return TransactionService._build_cards_stats(user_id, cards, month, year, card_plans, exceptions)
+
+    @staticmethod
+    def _build_cards_stats(user_id, cards, month, year, card_plans=None, exceptions=None):
+        if not cards:
+            return []
+
         today = date.today()
+        invoice_dates = {c.id: TransactionService.get_invoice_dates(c, month, year) for c in cards}
 
-        open_date, close_date, due_date = TransactionService.get_invoice_dates(card, month, year)
-        
-        # --- 1. CÁLCULO DA DÍVIDA ANTERIOR (ROLLOVER) ---
-        # Soma tudo que foi gasto ANTES da abertura desta fatura
-        past_expenses = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.card_id == card_id,
+        # Cada cartão tem sua própria janela de fatura: as datas entram na query via CASE
+        open_col = case({cid: d[0] for cid, d in invoice_dates.items()}, value=Transaction.card_id)
+        close_col = case({cid: d[1] for cid, d in invoice_dates.items()}, value=Transaction.card_id)
+        pay_limit_col = case({cid: d[2] + timedelta(days=20) for cid, d in invoice_dates.items()}, value=Transaction.card_id)
+
+        # Último snapshot de fatura já fechada de cada cartão: o histórico anterior a ele
+        # não precisa mais ser somado (rollover = snapshot + movimento desde o fechamento)
+        snapshots = TransactionService.get_base_snapshots(invoice_dates, today)
+        history_filter = or_(*[
+            and_(Transaction.card_id == cid, Transaction.date > snapshots[cid].close_date) if cid in snapshots
+            else Transaction.card_id == cid
+            for cid in invoice_dates
+        ])
+
+        is_expense = and_(
             Transaction.type == 'despesa',
-            Transaction.date < open_date,
-            or_(
-                Transaction.fixed_expense_id == None,
-                Transaction.date <= today
-            )
-        ).scalar() or 0
+            or_(Transaction.fixed_expense_id == None, Transaction.date <= today)
+        )
+        is_payment = Transaction.type == 'pagamento_cartao'
 
-        # Soma tudo que foi pago ANTES da abertura desta fatura
-        past_payments = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.card_id == card_id,
-            Transaction.type == 'pagamento_cartao',
-            Transaction.date < open_date
-        ).scalar() or 0
+        def conditional_sum(condition):
+            return func.sum(case((condition, Transaction.amount), else_=0))
 
-        # O que sobrou é a dívida trazida para o mês atual
-        past_balance = float(past_expenses) - float(past_payments)
+        rows = db.session.query(
+            Transaction.card_id,
+            # Dívida anterior (rollover): tudo antes da abertura desta fatura
+            conditional_sum(and_(is_expense, Transaction.date < open_col)),
+            conditional_sum(and_(is_payment, Transaction.date < open_col)),
+            # Ciclo atual
+            conditional_sum(and_(is_expense, Transaction.date >= open_col, Transaction.date <= close_col)),
+            conditional_sum(and_(is_payment, Transaction.date >= open_col, Transaction.date <= pay_limit_col)),
+            # Limite global
+            conditional_sum(is_expense),
+            conditional_sum(is_payment)
+        ).filter(
+            Transaction.user_id == user_id,
+            history_filter,
+            Transaction.type.in_(['despesa', 'pagamento_cartao'])
+        ).group_by(Transaction.card_id).all()
 
-        # --- 2. CÁLCULO DO CICLO ATUAL ---
-        # Total gasto NESTE mês (no período da fatura)
-        invoice_expenses = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.card_id == card_id,
-            Transaction.type == 'despesa',
-            Transaction.date >= open_date,
-            Transaction.date <= close_date,
-            or_(
-                Transaction.fixed_expense_id == None,
-                Transaction.date <= today
-            )
-        ).scalar() or 0
-        
-        # Pagamentos feitos para ESTA fatura (Consideramos pagamentos até 20 dias após vencimento para abater visualmente)
-        invoice_payments = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.card_id == card_id,
-            Transaction.type == 'pagamento_cartao',
-            Transaction.date >= open_date,
-            Transaction.date <= (due_date + timedelta(days=20)) 
-        ).scalar() or 0
-        
-        # Fatura Final = (Dívida Passada) + (Gastos do Mês) - (Pagamentos Feitos)
-        current_invoice = past_balance + float(invoice_expenses) - float(invoice_payments)
-
-        # --- 3. Limite Global ---
-        total_spent = db.session.query(func.sum(Transaction.amount))\
-            .filter(
-                Transaction.card_id == card_id, 
-                Transaction.type == 'despesa',
-                or_(
-                    Transaction.date <= today,
-                    Transaction.fixed_expense_id == None
-                )
-            )\
-            .scalar() or 0
-            
-        total_paid = db.session.query(func.sum(Transaction.amount))\
-            .filter(
-                Transaction.card_id == card_id, 
-                Transaction.type == 'pagamento_cartao'
-            )\
-            .scalar() or 0
-            
-        used_limit = total_spent - total_paid
-        available = float(card.limit_amount) - float(used_limit)
-        
-        percent = 0
-        if card.limit_amount > 0:
-            percent = (float(used_limit) / float(card.limit_amount)) * 100
-
-        # Consideramos paga se o valor restante for irrisório (ex: centavos de arredondamento)
-        is_paid = current_invoice <= 0.01
-
-        return {
-            'obj': card,
-            'limit': card.limit_amount,
-            'used': used_limit,
-            'available': available,
-            'percent': min(percent, 100),
-            'invoice_amount': max(current_invoice, 0), # Mostra o valor acumulado a pagar
-            'is_paid': is_paid,
-            'full_due_date': due_date.strftime('%d/%m/%Y'),
-            'full_closing_date': close_date.strftime('%d/%m/%Y'),
-            'target_month': due_date.month,
-            'target_year': due_date.year
-        }
+        sums = {row[0]: [v or 0 for v in row[1:]] for row in rows}
+
+        # Ocorrências virtuais de fixos de cartão já vencidas e parcelas dos planos entram como despesas comuns
+        from app.recurrence_service import RecurrenceService
+        from app.installment_service import InstallmentService
+        virtual_totals = [
+            RecurrenceService.get_card_totals(user_id, invoice_dates, snapshots, today, card_plans, exceptions),
+            InstallmentService.get_card_totals(user_id, invoice_dates, snapshots)
+        ]
+
+        stats = []
+        for card in cards:
+            open_date, close_date, due_date = invoice_dates[card.id]
+            past_expenses, past_payments, invoice_expenses, invoice_payments, total_spent, total_paid = sums.get(card.id, [0] * 6)
+            for virtual in virtual_totals:
+                if card.id in virtual:
+                    virtual_past, virtual_invoice, virtual_total = virtual[card.id]
+                    past_expenses = Decimal(str(past_expenses)) + virtual_past
+                    invoice_expenses = Decimal(str(invoice_expenses)) + virtual_invoice
+                    total_spent = Decimal(str(total_spent)) + virtual_total
+
+            snapshot = snapshots.get(card.id)
+            if snapshot:
+                past_expenses += snapshot.total_expenses
+                past_payments += snapshot.total_payments
+                total_spent += snapshot.total_expenses
+                total_paid += snapshot.total_payments
+
+            # O que sobrou é a dívida trazida para o mês atual
+            past_balance = float(past_expenses) - float(past_payments)
+
+            # Fatura Final = (Dívida Passada) + (Gastos do Mês) - (Pagamentos Feitos)
+            # (Pagamentos até 20 dias após o vencimento abatem visualmente esta fatura)
+            current_invoice = past_balance + float(invoice_expenses) - float(invoice_payments)
+
+            used_limit = total_spent - total_paid
+            available = float(card.limit_amount) - float(used_limit)
+
+            percent = 0
+            if card.limit_amount > 0:
+                percent = (float(used_limit) / float(card.limit_amount)) * 100
+
+            # Consideramos paga se o valor restante for irrisório (ex: centavos de arredondamento)
+            is_paid = current_invoice <= 0.01
+
+            stats.append({
+                'obj': card,
+                'limit': card.limit_amount,
+                'used': used_limit,
+                'available': available,
+                'percent': min(percent, 100),
+                'invoice_amount': max(current_invoice, 0), # Mostra o valor acumulado a pagar
+                'is_paid': is_paid,
+                'full_due_date': due_date.strftime('%d/%m/%Y'),
+                'full_closing_date': close_date.strftime('%d/%m/%Y'),
+                'target_month': due_date.month,
+                'target_year': due_date.year
+            })
+        return stats
+
+    @staticmethod
+    def get_base_snapshots(invoice_dates, today):
+        """
+        Para cada cartão, o snapshot mais recente fechado antes da abertura da fatura
+        consultada (e antes de hoje). invoice_dates: {card_id: (abertura, fechamento, vencimento)}.
+        """
+        open_col = case({cid: d[0] for cid, d in invoice_dates.items()}, value=InvoiceSnapshot.card_id)
+        latest = db.session.query(InvoiceSnapshot.card_id, func.max(InvoiceSnapshot.close_date)).filter(
+            InvoiceSnapshot.card_id.in_(list(invoice_dates.keys())),
+            InvoiceSnapshot.close_date < open_col,
+            InvoiceSnapshot.close_date < today
+        ).group_by(InvoiceSnapshot.card_id).all()
+        if not latest:
+            return {}
+
+        rows = InvoiceSnapshot.query.filter(or_(*[
+            and_(InvoiceSnapshot.card_id == cid, InvoiceSnapshot.close_date == close_date)
+            for cid, close_date in latest
+        ])).all()
+        return {snap.card_id: snap for snap in rows}
 
     @staticmethod
     def check_card_limit(user_id, card_id, amount):
@@ -157,54 +317,144 @@ class TransactionService:
             db.session.add(pay_cat)
             db.session.flush()
 
-        t_bank = Transaction(
-            user_id=user_id, account_id=account.id,
-            description=f"Pagamento Fatura {card.name}",
-            amount=amount, date=date_payment, type='despesa',
-            category_id=pay_cat.id
-        )
-        db.session.add(t_bank)
-        
         t_card = Transaction(
             user_id=user_id, card_id=card.id,
             description=f"Pagamento Recebido",
             amount=amount, date=date_payment, type='pagamento_cartao' 
         )
         db.session.add(t_card)
+        db.session.flush()
+
+        t_bank = Transaction(
+            user_id=user_id, account_id=account.id,
+            description=f"Pagamento Fatura {card.name}",
+            amount=amount, date=date_payment, type='despesa',
+            category_id=pay_cat.id, is_invoice_payment=True,
+            paired_transaction_id=t_card.id
+        )
+        db.session.add(t_bank)
         
         card.last_paid_date = date_payment
         db.session.commit()
         return True, "Pagamento registrado com sucesso!"
 
     @staticmethod
-    def get_future_installments(user_id, card_id):
-        today = date.today()
-        installments = Transaction.query.filter(
+    def future_installments_filter(user_id, card_id):
+        return and_(
             Transaction.user_id == user_id,
             Transaction.card_id == card_id,
-            Transaction.date > today,
+            Transaction.date > date.today(),
             Transaction.type == 'despesa',
             Transaction.installment_total > 1
+        )
+
+    @staticmethod
+    def get_future_installment_items(user_id, card_id, identifier):
+        """Parcelas futuras gravadas de uma compra (o identifier de InstallmentService.get_future_groups)."""
+        return Transaction.query.filter(
+            TransactionService.future_installments_filter(user_id, card_id),
+            or_(
+                Transaction.installment_identifier == identifier,
+                and_(Transaction.installment_identifier == None, Transaction.description == identifier)
+            )
         ).order_by(Transaction.date.asc()).all()
-        return installments
+
+    @staticmethod
+    def get_next_fixed_dates(user_id, after_date):
+        """
+        Retorna a data da próxima ocorrência (posterior a after_date) de cada
+        despesa/receita fixa do usuário, numa única consulta agrupada:
+        ({fixed_expense_id: data}, {fixed_revenue_id: data}).
+        """
+        rows = db.session.query(
+            Transaction.fixed_expense_id,
+            Transaction.fixed_revenue_id,
+            func.min(Transaction.date)
+        ).filter(
+            Transaction.user_id == user_id,
+            Transaction.date > after_date,
+            or_(Transaction.fixed_expense_id != None, Transaction.fixed_revenue_id != None)
+        ).group_by(Transaction.fixed_expense_id, Transaction.fixed_revenue_id).all()
+
+        next_expense_dates = {}
+        next_revenue_dates = {}
+        for expense_id, revenue_id, next_date in rows:
+            if expense_id:
+                current = next_expense_dates.get(expense_id)
+                next_expense_dates[expense_id] = min(current, next_date) if current else next_date
+            if revenue_id:
+                current = next_revenue_dates.get(revenue_id)
+                next_revenue_dates[revenue_id] = min(current, next_date) if current else next_date
+        return next_expense_dates, next_revenue_dates
 
     @staticmethod
     def advance_specific_installments(user_id, transaction_ids, advance_date=None):
-        if not transaction_ids: return False, "Nada selecionado."
-        
+        """
+        Antecipa as parcelas para advance_date. As gravadas (ids) vão num único
+        UPDATE, que também marca is_anticipated e a descrição e só alcança transações
+        do usuário (a posse é conferida no próprio WHERE); os valores antigos são
+        lidos antes, numa consulta, para acertar rollups e snapshots. As parcelas
+        ainda virtuais ('plan_id:número') são gravadas já antecipadas.
+        """
         target_date = advance_date if advance_date else date.today()
-        
-        count = 0
-        for tid in transaction_ids:
-            trans = Transaction.query.get(tid)
-            if trans and trans.user_id == user_id:
-                trans.date = target_date
-                if "(Antecipado)" not in trans.description:
-                    trans.description = f"{trans.description} (Antecipado)"
-                count += 1
+
+        # Importado aqui: installment_service importa TransactionService
+        from app.installment_service import InstallmentService
+        count = InstallmentService.advance(user_id, [tid for tid in transaction_ids if ':' in str(tid)], target_date)
+
+        ids = {int(tid) for tid in transaction_ids if str(tid).isdigit()}
+        if ids:
+            count += TransactionService.advance_stored_installments(user_id, ids, target_date)
+
+        if not count: return False, "Nada selecionado."
         db.session.commit()
         return True, f"{count} parcelas antecipadas."
 
+    @staticmethod
+    def advance_stored_installments(user_id, ids, target_date):
+        """UPDATE em lote das parcelas gravadas (advance_specific_installments). Sem commit."""
+        from app.rollup_service import RollupService, ROLLUP_FIELDS
+        owned = and_(Transaction.id.in_(ids), Transaction.user_id == user_id)
+        old_rows = [
+            dict(row._mapping)
+            for row in db.session.query(*[getattr(Transaction, f) for f in ROLLUP_FIELDS]).filter(owned).all()
+        ]
+        if not old_rows: return 0
+
+        closing_days, category_types = RollupService.load_lookups(
+            db.session, [r['card_id'] for r in old_rows], [r['category_id'] for r in old_rows]
+        )
+        # Todas vão para a mesma data: a fatura só depende do fechamento de cada cartão
+        invoice_months = {
+            card_id: TransactionService.get_invoice_month(closing_day, target_date)
+            for card_id, closing_day in closing_days.items()
+        }
+        in_invoice = Transaction.type.in_(INVOICE_TYPES)
+        invoice_year = invoice_month = None
+        if invoice_months:
+            invoice_year = case(*[(and_(Transaction.card_id == cid, in_invoice), y) for cid, (y, m) in invoice_months.items()], else_=None)
+            invoice_month = case(*[(and_(Transaction.card_id == cid, in_invoice), m) for cid, (y, m) in invoice_months.items()], else_=None)
+
+        result = db.session.execute(
+            update(Transaction).where(owned).values(
+                date=target_date,
+                is_anticipated=True,
+                description=case(
+                    (Transaction.description.contains('(Antecipado)'), Transaction.description),
+                    else_=Transaction.description + ' (Antecipado)'
+                ),
+                invoice_year=invoice_year,
+                invoice_month=invoice_month
+            ).execution_options(synchronize_session=False)
+        )
+
+        changes = []
+        for old in old_rows:
+            changes.append((old, -1))
+            changes.append((dict(old, date=target_date), 1))
+        TransactionService.apply_bulk_changes(changes, closing_days, category_types)
+        return result.rowcount
+
     @staticmethod
     def transfer_funds(user_id, source_id, target_id, amount, date_trans, description=None):
         if source_id == target_id: return False, "Contas iguais."
@@ -251,12 +501,13 @@ class TransactionService:
         card = CreditCard.query.get(card_id)
         if not card: return False
 
-        if purchase_date.day > card.closing_day:
-            ref_date = purchase_date + relativedelta(months=1)
-        else:
-            ref_date = purchase_date
-            
-        open_date, close_date, due_date = TransactionService.get_invoice_dates(card, ref_date.month, ref_date.year)
+        ref_year, ref_month = TransactionService.get_invoice_month(card.closing_day, purchase_date)
+        open_date, close_date, due_date = TransactionService.get_invoice_dates(card, ref_month, ref_year)
+
+        # Fatura já fechada e com snapshot válido: responde direto pela tabela invoice_snapshots
+        snapshot = InvoiceSnapshot.query.filter_by(card_id=card.id, cycle_year=ref_year, cycle_month=ref_month).first()
+        if snapshot and snapshot.close_date == close_date:
+            return snapshot.paid_after_close > 0
 
         payment = db.session.query(Transaction).filter(
             Transaction.user_id == user_id,
@@ -266,4 +517,29 @@ class TransactionService:
             Transaction.date <= (due_date + timedelta(days=10))
         ).first()
 
-        return payment is not None
\ No newline at end of file
+        return payment is not None
+
+
+@event.listens_for(Session, 'before_flush')
+def assign_invoice_month_before_flush(session, flush_context, instances):
+    """Preenche invoice_year/invoice_month das transações novas ou que mudaram de cartão, data ou tipo."""
+    pending = [obj for obj in session.new if isinstance(obj, Transaction)]
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            state = inspect(obj)
+            if any(state.attrs[f].history.has_changes() for f in INVOICE_FIELDS):
+                pending.append(obj)
+    if not pending:
+        return
+
+    card_ids = {obj.card_id for obj in pending if obj.card_id}
+    closing_days = {}
+    if card_ids:
+        closing_days = dict(session.query(CreditCard.id, CreditCard.closing_day).filter(CreditCard.id.in_(card_ids)).all())
+
+    for obj in pending:
+        closing_day = closing_days.get(obj.card_id)
+        if obj.card_id and obj.type in INVOICE_TYPES and closing_day is not None:
+            obj.invoice_year, obj.invoice_month = TransactionService.get_invoice_month(closing_day, obj.date)
+        else:
+            obj.invoice_year = obj.invoice_month = None
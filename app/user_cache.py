@@ -0,0 +1,134 @@
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from app import db
+from app.models import User
+from app.cache_backends import make_backend
+
+# Colunas que não vão para o cache (segredos). Num usuário vindo do cache elas
+# ficam "expiradas" e são lidas do banco só se alguém as acessar.
+PRIVATE_COLUMNS = ('password_hash', 'auth_token', 'token_expiration', 'two_factor_secret', 'backup_codes')
+
+@event.listens_for(Session, 'after_commit')
+def drop_versions_after_commit(session):
+    # Só depois do commit: antes dele, uma requisição concorrente leria do banco a
+    # versão antiga e a gravaria de novo no cache
+    for user_id, backend in session.info.pop('user_cache_invalidated', {}).items():
+        backend.delete(UserCache.version_key(user_id))
+
+@event.listens_for(Session, 'after_rollback')
+def forget_versions_after_rollback(session):
+    session.info.pop('user_cache_invalidated', None)
+
+class UserCache:
+    """
+    Cache do user_loader do Flask-Login: guarda um snapshot das colunas do
+    usuário por USER_CACHE_TTL segundos, para que as requisições autenticadas
+    montem o current_user sem consultar o banco.
+
+    A chave do snapshot inclui o data_version do usuário, que também fica no
+    próprio cache (version_key). Invalidar é incrementar o data_version no banco
+    e, após o commit, apagar essa versão do cache: a próxima requisição relê o
+    usuário do banco. Com o backend 'filesystem' isso vale na hora para todos os
+    workers; com o 'lru' (um cache por worker), os outros workers veem a
+    alteração quando a versão deles expira, em até USER_CACHE_TTL segundos.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def init_app(app):
+        backend = make_backend(
+            app.config.get('USER_CACHE_BACKEND', 'lru'),
+            app.config.get('USER_CACHE_SIZE', 1024),
+            app.config.get('USER_CACHE_TTL', 60),
+            app.config.get('USER_CACHE_DIR')
+        )
+        app.extensions['user_cache'] = UserCache(backend)
+
+    @staticmethod
+    def current():
+        cache = current_app.extensions.get('user_cache')
+        return cache.backend if cache else None
+
+    @staticmethod
+    def make_key(user_id, version):
+        return f"user:{user_id}:{version}"
+
+    @staticmethod
+    def version_key(user_id):
+        return f"user:{user_id}:version"
+
+    @staticmethod
+    def remember_version(user_id, version):
+        if has_request_context():
+            g.setdefault('user_data_versions', {})[user_id] = version
+
+    @staticmethod
+    def data_version(user_id):
+        """
+        data_version atual do usuário (None se não existir), lido uma vez por
+        requisição: do cache e, se não estiver lá (ou sem cache), do banco.
+        """
+        versions = g.setdefault('user_data_versions', {}) if has_request_context() else {}
+        if user_id in versions:
+            return versions[user_id]
+
+        backend = UserCache.current()
+        version = backend.get(UserCache.version_key(user_id)) if backend else None
+        if version is None:
+            version = db.session.query(User.data_version).filter(User.id == user_id).scalar()
+            if backend and version is not None:
+                backend.set(UserCache.version_key(user_id), version)
+        versions[user_id] = version
+        return version
+
+    @staticmethod
+    def snapshot(user):
+        return {c.key: getattr(user, c.key) for c in User.__table__.columns if c.key not in PRIVATE_COLUMNS}
+
+    @staticmethod
+    def store(backend, user):
+        version = user.data_version or 0
+        backend.set(UserCache.make_key(user.id, version), UserCache.snapshot(user))
+        backend.set(UserCache.version_key(user.id), version)
+        UserCache.remember_version(user.id, version)
+
+    @staticmethod
+    def load(user_id):
+        backend = UserCache.current()
+        if backend is None:
+            return db.session.get(User, user_id)
+
+        version = backend.get(UserCache.version_key(user_id))
+        values = backend.get(UserCache.make_key(user_id, version)) if version is not None else None
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                UserCache.store(backend, user)
+            return user
+
+        # Reconstrói o usuário como se tivesse vindo de uma consulta, sem SELECT:
+        # alterações e relacionamentos (accounts, cards...) funcionam normalmente
+        UserCache.remember_version(user_id, version)
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def invalidate(user_id):
+        """
+        Incrementa o data_version do usuário (sem commit). Após o commit, a versão
+        sai do cache: o snapshot e os dashboards em cache dele deixam de valer.
+        """
+        users = User.__table__
+        db.session.execute(
+            users.update().where(users.c.id == user_id).values(data_version=db.func.coalesce(users.c.data_version, 0) + 1)
+        )
+        if has_request_context():
+            g.setdefault('user_data_versions', {}).pop(user_id, None)
+        backend = UserCache.current()
+        if backend is not None:
+            db.session.info.setdefault('user_cache_invalidated', {})[user_id] = backend
@@ -0,0 +1,29 @@
+from flask import g
+from flask_login import current_user
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.models import Category, BankAccount, CreditCard
+
+class UserData:
+    """
+    Coleções do usuário logado (categorias, contas e cartões), carregadas uma
+    única vez por requisição e guardadas em flask.g. Também preenche os
+    relacionamentos de current_user, então os templates que percorrem
+    current_user.accounts/categories/cards não disparam novas consultas, e
+    t.category/t.account/t.card das transações saem do identity map da sessão.
+    """
+
+    def __init__(self, user):
+        self.categories = Category.query.filter_by(user_id=user.id).order_by(Category.id).all()
+        self.accounts = BankAccount.query.filter_by(user_id=user.id).order_by(BankAccount.id).all()
+        self.cards = CreditCard.query.filter_by(user_id=user.id).order_by(CreditCard.id).all()
+
+        set_committed_value(user, 'categories', self.categories)
+        set_committed_value(user, 'accounts', self.accounts)
+        set_committed_value(user, 'cards', self.cards)
+
+    @staticmethod
+    def get():
+        if 'user_data' not in g:
+            g.user_data = UserData(current_user._get_current_object())
+        return g.user_data
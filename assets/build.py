@@ -0,0 +1,178 @@
+"""
+Build dos assets do frontend, gerados em app/static/dist:
+
+1. Tailwind compilado apenas com as classes usadas em app/templates (CLI do tailwindcss);
+2. Font Awesome reduzido aos ícones citados nos templates (regras CSS e glifos das fontes);
+3. @font-face da fonte Inter (usada na tela de verificação 2FA);
+4. Arquivos renomeados com o hash do conteúdo + manifest.json (nome lógico -> arquivo),
+   lido pelo app (app/assets.py) para emitir as URLs.
+
+Uso: cd assets && npm install && npm run build
+Requer Node (tailwindcss) e Python com fontTools + brotli (subset das fontes em woff2).
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+from fontTools import subset
+
+ASSETS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(ASSETS_DIR)
+TEMPLATES_DIR = os.path.join(ROOT_DIR, 'app', 'templates')
+DIST_DIR = os.path.join(ROOT_DIR, 'app', 'static', 'dist')
+
+NODE_MODULES = os.path.join(ASSETS_DIR, 'node_modules')
+FONTAWESOME_DIR = os.path.join(NODE_MODULES, '@fortawesome', 'fontawesome-free')
+INTER_DIR = os.path.join(NODE_MODULES, '@fontsource', 'inter', 'files')
+INTER_WEIGHTS = (300, 400, 500, 600, 700)
+
+ICON_PATTERN = re.compile(r'\bfa-[a-z0-9-]+')
+ICON_SELECTOR = re.compile(r'^\.(fa-[a-z0-9-]+)::?before$')
+CONTENT_PATTERN = re.compile(r'content:\s*"\\([0-9a-fA-F]+)"')
+FONT_URL = re.compile(r'url\(["\']?\.\./webfonts/([\w-]+)\.\w+["\']?\)\s*format\(["\']?[\w-]+["\']?\)')
+
+# --- TAILWIND ---
+
+def build_tailwind(out_path):
+    subprocess.run(
+        ['npx', 'tailwindcss', '-c', 'tailwind.config.js', '-i', os.path.join('src', 'app.css'), '-o', out_path, '--minify'],
+        cwd=ASSETS_DIR, check=True
+    )
+
+# --- FONT AWESOME ---
+
+def find_used_icons():
+    icons = set()
+    for folder, _, files in os.walk(TEMPLATES_DIR):
+        for name in files:
+            if name.endswith('.html'):
+                with open(os.path.join(folder, name), encoding='utf-8') as f:
+                    icons.update(ICON_PATTERN.findall(f.read()))
+    return icons
+
+def split_rules(css):
+    """Quebra o CSS em blocos de primeiro nível (regras, @font-face, @keyframes...)."""
+    rules, depth, start = [], 0, 0
+    for i, char in enumerate(css):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append(css[start:i + 1].strip())
+                start = i + 1
+    return [r for r in rules if r]
+
+def build_icons(used_icons, work_dir):
+    """
+    Mantém do all.css do Font Awesome as regras gerais (.fa, .fas, animações...)
+    e só as regras de ícones usados; as fontes são reduzidas aos glifos deles.
+    Retorna o CSS, com url() apontando para as fontes geradas em work_dir.
+    """
+    with open(os.path.join(FONTAWESOME_DIR, 'css', 'all.css'), encoding='utf-8') as f:
+        css = f.read()
+
+    kept, codepoints, fonts = [], set(), set()
+    for rule in split_rules(css):
+        selectors = [s.strip() for s in rule.split('{', 1)[0].split(',')]
+        matches = [ICON_SELECTOR.match(s) for s in selectors]
+        if all(matches) and CONTENT_PATTERN.search(rule):
+            selectors = [s for s, m in zip(selectors, matches) if m.group(1) in used_icons]
+            if not selectors:
+                continue
+            codepoints.add(int(CONTENT_PATTERN.search(rule).group(1), 16))
+            rule = ','.join(selectors) + '{' + rule.split('{', 1)[1]
+        elif rule.startswith('@font-face'):
+            # Só woff2 (todos os navegadores atuais), apontando para a fonte reduzida
+            fonts.update(FONT_URL.findall(rule))
+            rule = re.sub(r'src:[^;}]*', lambda m: 'src:' + ','.join(
+                f'url({name}.woff2) format("woff2")' for name in dict.fromkeys(FONT_URL.findall(m.group(0)))
+            ), rule)
+        kept.append(rule)
+
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    for name in sorted(fonts):
+        font = subset.load_font(os.path.join(FONTAWESOME_DIR, 'webfonts', f'{name}.woff2'), options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=codepoints)
+        subsetter.subset(font)
+        subset.save_font(font, os.path.join(work_dir, f'{name}.woff2'), options)
+
+    print(f"Font Awesome: {len(codepoints)} ícones em {len(fonts)} fontes.")
+    return '\n'.join(kept)
+
+# --- INTER ---
+
+def build_inter(work_dir):
+    rules = []
+    for weight in INTER_WEIGHTS:
+        name = f'inter-latin-{weight}-normal.woff2'
+        shutil.copy(os.path.join(INTER_DIR, name), os.path.join(work_dir, name))
+        rules.append(
+            "@font-face{font-family:'Inter';font-style:normal;font-display:swap;"
+            f"font-weight:{weight};src:url({name}) format(\"woff2\")}}"
+        )
+    return '\n'.join(rules)
+
+# --- FINGERPRINT ---
+
+def fingerprint(path):
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:10]
+    base, ext = os.path.splitext(os.path.basename(path))
+    return f'{base}.{digest}{ext}'
+
+def write_dist(work_dir, stylesheets):
+    """
+    Copia as fontes e folhas de estilo para dist com o hash no nome (primeiro as
+    fontes, para que os url() das folhas já apontem para os nomes finais).
+    """
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    manifest = {}
+    for name in sorted(os.listdir(work_dir)):
+        if name.endswith('.woff2'):
+            hashed = fingerprint(os.path.join(work_dir, name))
+            shutil.copy(os.path.join(work_dir, name), os.path.join(DIST_DIR, hashed))
+            manifest[name] = f'dist/{hashed}'
+
+    for name, css in stylesheets.items():
+        for font, hashed in manifest.items():
+            css = css.replace(f'url({font})', f'url({hashed[len("dist/"):]})')
+        path = os.path.join(work_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(css)
+        hashed = fingerprint(path)
+        shutil.copy(path, os.path.join(DIST_DIR, hashed))
+        manifest[name] = f'dist/{hashed}'
+
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def main():
+    with tempfile.TemporaryDirectory() as work_dir:
+        tailwind_path = os.path.join(work_dir, 'tailwind.css')
+        build_tailwind(tailwind_path)
+        with open(tailwind_path, encoding='utf-8') as f:
+            tailwind_css = f.read()
+        os.remove(tailwind_path)
+
+        # Uma única folha de estilo por página: Tailwind + ícones + Inter
+        app_css = '\n'.join([tailwind_css, build_icons(find_used_icons(), work_dir), build_inter(work_dir)])
+        manifest = write_dist(work_dir, {'app.css': app_css})
+
+    for name, path in sorted(manifest.items()):
+        size = os.path.getsize(os.path.join(DIST_DIR, os.path.basename(path)))
+        print(f"{name:<40} -> {path} ({size / 1024:.1f} KB)")
+
+if __name__ == '__main__':
+    main()
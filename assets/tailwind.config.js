@@ -0,0 +1,15 @@
+/** Compila apenas as classes usadas nos templates (inclusive as montadas no JS dos templates). */
+module.exports = {
+  content: ['../app/templates/**/*.html'],
+  theme: {
+    extend: {
+      colors: {
+        slate: {
+          750: '#2d3748', // Custom dark shade
+          850: '#1a202c',
+          950: '#0f172a'
+        }
+      }
+    }
+  }
+}
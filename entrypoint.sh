@@ -7,5 +7,5 @@ python preload.py
 export FLASK_APP=run
 
 echo "Iniciando servidor Gunicorn (IPv4 + IPv6)..."
-# Usar apenas [::]:5000 habilita Dual-Stack (IPv4 e IPv6) automaticamente no Linux
-exec gunicorn --bind "[::]:5000" --workers 4 --timeout 120 run:app
\ No newline at end of file
+# Bind, workers, threads e preload ficam em gunicorn.conf.py (ajustáveis por variáveis GUNICORN_*)
+exec gunicorn --config gunicorn.conf.py run:app
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+Fixtures dos testes de serviço: app com um banco SQLite temporário (criado e
+apagado a cada teste) e um usuário com conta, cartão e categorias.
+"""
+import os
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+from app import create_app, db
+from app.config import Config
+from app.models import User, BankAccount, CreditCard, Category
+
+
+class ServiceTestConfig(Config):
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    TESTING = True
+    SCHEDULER_ENABLED = False
+    EMAIL_SENDER_ENABLED = False
+    DASHBOARD_CACHE_BACKEND = 'none'
+    USER_CACHE_BACKEND = 'none'
+
+
+@pytest.fixture
+def app(tmp_path):
+    config = type('Config', (ServiceTestConfig,), {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp_path, 'test.db')
+    })
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def user(app):
+    today = date.today()
+    user = User(email='teste@exemplo.com', name='Teste', is_verified=True,
+                start_date=today.replace(day=1) - timedelta(days=365), welcome_seen=True)
+    user.set_password('senha-teste')
+    db.session.add(user)
+    db.session.flush()
+
+    db.session.add_all([
+        BankAccount(user_id=user.id, name='Conta', current_balance=Decimal('1000')),
+        CreditCard(user_id=user.id, name='Cartão', limit_amount=Decimal('5000'), closing_day=5, due_day=12),
+        Category(user_id=user.id, name='Compras', type='despesa'),
+        Category(user_id=user.id, name='Salário', type='receita'),
+        Category(user_id=user.id, name='Pagamento', type='pagamento')
+    ])
+    db.session.commit()
+    return user
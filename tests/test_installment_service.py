@@ -0,0 +1,118 @@
+"""
+Compras parceladas (InstallmentService): divisão do total, antecipação,
+exclusão de parcelas e totais dos cartões com e sem snapshots.
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+
+from app import db
+from app.models import Transaction, InstallmentPlan, CreditCard, Category, InvoiceSnapshot
+from app.installment_service import InstallmentService
+from app.transaction_service import TransactionService
+from app.forecast_service import ForecastService
+
+
+def installment_plan(user, identifier, total, count, first_date, card=None):
+    card = card or CreditCard.query.filter_by(user_id=user.id).first()
+    category = Category.query.filter_by(user_id=user.id, type='despesa').first()
+    plan = InstallmentService.create_plan(user.id, identifier, 'Compra', Decimal(total), count, first_date, card.id, category.id)
+    db.session.commit()
+    return plan
+
+
+def expected_card_totals(plans, invoice_dates, snapshots):
+    """Somas percorrendo o calendário de todos os planos, sem janelas."""
+    totals = {}
+    for plan, _, installment_date, amount in InstallmentService.iter_schedule(plans):
+        snapshot = snapshots.get(plan.card_id)
+        if snapshot and installment_date <= snapshot.close_date:
+            continue
+        open_date, close_date, _ = invoice_dates[plan.card_id]
+        sums = totals.setdefault(plan.card_id, [Decimal('0')] * 3)
+        if installment_date < open_date:
+            sums[0] += amount
+        elif installment_date <= close_date:
+            sums[1] += amount
+        sums[2] += amount
+    return totals
+
+
+def test_amounts_put_remainder_on_last_installment(user):
+    plan = installment_plan(user, 'a', '100.00', 3, date(2024, 1, 31))
+
+    assert InstallmentService.amounts(plan) == [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')]
+    assert [(n, d) for n, d, _ in InstallmentService.schedule(plan)] == [(1, date(2024, 1, 31)), (2, date(2024, 2, 29)), (3, date(2024, 3, 31))]
+    assert plan.last_date == date(2024, 3, 31)
+    assert sum(InstallmentService.amounts(installment_plan(user, 'b', '10.00', 7, date(2024, 1, 1)))) == Decimal('10.00')
+
+
+def test_forecast_puts_remainder_on_last_installment(user):
+    today = date.today()
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    # Vencimento no dia 1, antes do fechamento (dia 5): cada parcela cai na fatura do próprio mês
+    installment_plan(user, 'a', '100.00', 3, today.replace(day=1) + relativedelta(months=1), card)
+
+    forecast = ForecastService.build(user.id, [], [card], today)
+    assert forecast['cards'][0]['invoices'][:5] == [0.0, 33.33, 33.33, 33.34, 0.0]
+
+
+def test_skip_removes_installment(user):
+    plan = installment_plan(user, 'a', '90.00', 3, date(2024, 1, 10))
+
+    InstallmentService.skip(plan, date(2024, 2, 10))
+    db.session.commit()
+
+    assert [(i.installment_current, i.date) for i in InstallmentService.get_installments([plan])] == [(1, date(2024, 1, 10)), (3, date(2024, 3, 10))]
+    assert InstallmentService.get_installment(user.id, plan.id, 2) is None
+    assert InstallmentService.get_installment(user.id, plan.id, 3)[1:] == (date(2024, 3, 10), Decimal('30.00'))
+
+
+def test_advance_records_installments_on_target_date(user):
+    today = date.today()
+    plan = installment_plan(user, 'a', '600.00', 6, today.replace(day=1) - relativedelta(months=1) + timedelta(days=9))
+
+    # Parcelas já vencidas, de outro plano ou inexistentes são ignoradas
+    keys = [f'{plan.id}:1', f'{plan.id}:5', f'{plan.id}:6', f'{plan.id}:9', f'{plan.id + 1}:2', 'x']
+    assert InstallmentService.advance(user.id, keys, today) == 2
+    db.session.commit()
+
+    rows = Transaction.query.filter_by(installment_identifier=plan.identifier).order_by(Transaction.installment_current).all()
+    assert [(t.installment_current, t.date, t.amount, t.is_anticipated) for t in rows] == [
+        (5, today, Decimal('100.00'), True), (6, today, Decimal('100.00'), True)
+    ]
+    assert rows[0].description == 'Compra (5/6) (Antecipado)'
+    assert [i.installment_current for i in InstallmentService.get_installments([plan])] == [1, 2, 3, 4]
+    # As antecipadas saem das parcelas futuras a antecipar
+    assert InstallmentService.advance(user.id, [f'{plan.id}:5'], today) == 0
+
+
+def test_card_totals_windows_with_and_without_snapshots(user):
+    today = date.today()
+    first_card = CreditCard.query.filter_by(user_id=user.id).first()
+    second_card = CreditCard(user_id=user.id, name='Outro', limit_amount=Decimal('5000'), closing_day=20, due_day=28)
+    db.session.add(second_card)
+    db.session.commit()
+
+    month_start = today.replace(day=1)
+    for card in (first_card, second_card):
+        # Encerrado antes da fatura atual (com e sem exceção), em andamento e futuro
+        installment_plan(user, f'{card.id}-old', '300.00', 3, month_start - relativedelta(months=8), card)
+        skipped = installment_plan(user, f'{card.id}-old-skip', '200.00', 4, month_start - relativedelta(months=9), card)
+        installment_plan(user, f'{card.id}-open', '1000.00', 10, month_start - relativedelta(months=4) + timedelta(days=14), card)
+        installment_plan(user, f'{card.id}-future', '99.99', 2, month_start + relativedelta(months=2), card)
+        InstallmentService.skip(skipped, InstallmentService.schedule(skipped)[1][1])
+    db.session.commit()
+
+    plans = InstallmentPlan.query.order_by(InstallmentPlan.id).all()
+    invoice_dates = {c.id: TransactionService.get_invoice_dates(c, today.month, today.year) for c in (first_card, second_card)}
+    snapshot = lambda card, months: InvoiceSnapshot(card_id=card.id, close_date=month_start - relativedelta(months=months))
+
+    cases = [
+        {},
+        {first_card.id: snapshot(first_card, 6), second_card.id: snapshot(second_card, 2)},
+        {second_card.id: snapshot(second_card, 7)}
+    ]
+    for snapshots in cases:
+        assert InstallmentService.get_card_totals(user.id, invoice_dates, snapshots) == expected_card_totals(plans, invoice_dates, snapshots)
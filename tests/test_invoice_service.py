@@ -0,0 +1,65 @@
+"""
+Snapshots das faturas fechadas (InvoiceSnapshotService): recálculo e
+lançamentos retroativos gravados durante o cálculo.
+"""
+from datetime import date
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Transaction, CreditCard, Category, InvoiceSnapshot
+from app.invoice_service import InvoiceSnapshotService
+from app.recurrence_service import RecurrenceService
+
+
+def purchase(user, card, amount, purchase_date):
+    category = Category.query.filter_by(user_id=user.id, type='despesa').first()
+    return Transaction(user_id=user.id, description='Compra', amount=Decimal(amount), date=purchase_date,
+                       type='despesa', card_id=card.id, category_id=category.id)
+
+
+def latest_total(card):
+    snapshot = InvoiceSnapshot.query.filter_by(card_id=card.id).order_by(InvoiceSnapshot.close_date.desc()).first()
+    return snapshot.total_expenses if snapshot else None
+
+
+def test_backdated_purchase_invalidates_snapshots(user):
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    month_start = date.today().replace(day=1)
+    db.session.add(purchase(user, card, '100.00', month_start - relativedelta(months=5)))
+    db.session.commit()
+
+    assert InvoiceSnapshotService.write_all(user.id) > 0
+    assert latest_total(card) == Decimal('100.00')
+
+    db.session.add(purchase(user, card, '50.00', month_start - relativedelta(months=3)))
+    db.session.commit()
+    assert InvoiceSnapshotService.write_all(user.id) > 0
+    assert latest_total(card) == Decimal('150.00')
+
+
+def test_purchase_committed_during_calculation_discards_snapshots(user, monkeypatch):
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    month_start = date.today().replace(day=1)
+    db.session.add(purchase(user, card, '100.00', month_start - relativedelta(months=5)))
+    db.session.commit()
+
+    # Outra requisição grava uma compra retroativa depois que as somas do cartão foram lidas
+    get_occurrences = RecurrenceService.get_occurrences
+
+    def concurrent_write(*args, **kwargs):
+        monkeypatch.setattr(RecurrenceService, 'get_occurrences', get_occurrences)
+        with Session(db.engine) as other:
+            other.add(purchase(user, card, '50.00', month_start - relativedelta(months=3)))
+            other.commit()
+        return get_occurrences(*args, **kwargs)
+
+    monkeypatch.setattr(RecurrenceService, 'get_occurrences', concurrent_write)
+    assert InvoiceSnapshotService.write_all(user.id) == 0
+    assert InvoiceSnapshot.query.filter_by(card_id=card.id).count() == 0
+
+    # A execução seguinte já vê a compra
+    assert InvoiceSnapshotService.write_all(user.id) > 0
+    assert latest_total(card) == Decimal('150.00')
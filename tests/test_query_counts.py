@@ -0,0 +1,108 @@
+"""
+Limite de comandos SQL por renderização do dashboard e das configurações.
+
+Um listener before_cursor_execute conta os comandos de cada requisição; os dados
+de teste têm dezenas de transações e várias contas, cartões e categorias: uma consulta por
+linha (N+1) estoura o limite com folga.
+"""
+import os
+import tempfile
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db
+from app.config import Config
+from app.models import User, BankAccount, CreditCard, Category, Transaction, FixedExpense, FixedRevenue
+from app.run import format_currency, trim_slash
+
+DASHBOARD_MAX_STATEMENTS = 21
+SETTINGS_MAX_STATEMENTS = 6
+
+
+class QueryCountConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    TESTING = True
+    SCHEDULER_ENABLED = False
+    EMAIL_SENDER_ENABLED = False
+    DASHBOARD_CACHE_BACKEND = 'none'
+    USER_CACHE_BACKEND = 'none'
+
+
+@pytest.fixture
+def client():
+    app = create_app(QueryCountConfig)
+    app.jinja_env.filters['currency'] = format_currency
+    app.jinja_env.filters['trim_slash'] = trim_slash
+
+    with app.app_context():
+        db.create_all()
+        today = date.today()
+        user = User(email='teste@exemplo.com', name='Teste', is_verified=True,
+                    start_date=today.replace(day=1) - timedelta(days=365), welcome_seen=True)
+        user.set_password('senha-teste')
+        db.session.add(user)
+        db.session.flush()
+
+        accounts = [BankAccount(user_id=user.id, name=f'Conta {i}', current_balance=Decimal('1000')) for i in range(5)]
+        cards = [CreditCard(user_id=user.id, name=f'Cartão {i}', limit_amount=Decimal('5000'), closing_day=5 + i * 5, due_day=12)
+                 for i in range(5)]
+        categories = [Category(user_id=user.id, name=f'Despesa {i}', type='despesa') for i in range(6)]
+        categories += [Category(user_id=user.id, name='Salário', type='receita'), Category(user_id=user.id, name='Pagamento', type='pagamento')]
+        db.session.add_all(accounts + cards + categories)
+        db.session.flush()
+
+        for i in range(60):
+            day = today.replace(day=1 + i % 28)
+            category = categories[i % 6]
+            if i % 2:
+                db.session.add(Transaction(user_id=user.id, description=f'Compra {i}', amount=Decimal('10') + i, date=day,
+                                           type='despesa', card_id=cards[i % 5].id, category_id=category.id))
+            else:
+                db.session.add(Transaction(user_id=user.id, description=f'Conta {i}', amount=Decimal('5') + i, date=day,
+                                           type='despesa', account_id=accounts[i % 5].id, category_id=category.id))
+        for i, card in enumerate(cards):
+            db.session.add(FixedExpense(user_id=user.id, description=f'Assinatura {i}', amount=Decimal('29.90'), day_of_month=10,
+                                        category_id=categories[0].id, card_id=card.id, start_date=today.replace(day=1)))
+        db.session.add(FixedRevenue(user_id=user.id, description='Salário', amount=Decimal('3000'), day_of_month=5,
+                                    category_id=categories[6].id, account_id=accounts[0].id, start_date=user.start_date))
+        db.session.commit()
+        user_id = user.id
+
+    test_client = app.test_client()
+    with test_client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    yield app, test_client
+
+    with app.app_context():
+        db.drop_all()
+
+
+def count_statements(app, test_client, url):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = test_client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    return statements
+
+
+def test_dashboard_statement_count(client):
+    statements = count_statements(*client, '/dashboard')
+    assert len(statements) <= DASHBOARD_MAX_STATEMENTS, '\n'.join(statements)
+
+
+def test_settings_statement_count(client):
+    statements = count_statements(*client, '/settings')
+    assert len(statements) <= SETTINGS_MAX_STATEMENTS, '\n'.join(statements)
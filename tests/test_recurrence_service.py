@@ -0,0 +1,156 @@
+"""
+Ocorrências virtuais dos fixos (RecurrenceService): calendário, exceções
+(puladas e gravadas), divisão do plano e totais dos cartões.
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from flask_login import login_user
+
+from app import db
+from app.models import Transaction, FixedExpense, FixedRevenue, FixedSkip, BankAccount, CreditCard, Category, InvoiceSnapshot
+from app.recurrence_service import RecurrenceService
+from app.transaction_service import TransactionService
+from app.invoice_service import InvoiceSnapshotService
+from app.installment_service import InstallmentService
+from app.forecast_service import ForecastService
+from app.user_data import UserData
+
+
+def card_plan(user, day, start_date, amount='10.00', end_date=None):
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    category = Category.query.filter_by(user_id=user.id, type='despesa').first()
+    plan = FixedExpense(user_id=user.id, description='Assinatura', amount=Decimal(amount), day_of_month=day,
+                        category_id=category.id, card_id=card.id, start_date=start_date, end_date=end_date)
+    db.session.add(plan)
+    db.session.commit()
+    return plan
+
+
+def occurrence_dates(user, plan, start, end):
+    return [o.date for o in RecurrenceService.get_occurrences(user.id, [plan], start, end)]
+
+
+def test_occurrences_fall_on_last_day_of_short_months(user):
+    plan = card_plan(user, 31, date(2023, 12, 31))
+
+    assert occurrence_dates(user, plan, date(2023, 12, 1), date(2024, 4, 30)) == [
+        date(2023, 12, 31), date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31), date(2024, 4, 30)
+    ]
+    assert occurrence_dates(user, plan, date(2025, 2, 1), date(2025, 2, 28)) == [date(2025, 2, 28)]
+
+
+def test_occurrences_respect_plan_validity(user):
+    plan = card_plan(user, 15, date(2024, 2, 20), end_date=date(2024, 5, 14))
+
+    assert occurrence_dates(user, plan, date(2024, 1, 1), date(2024, 12, 31)) == [date(2024, 3, 15), date(2024, 4, 15)]
+
+
+def test_skip_and_materialize_round_trip(user):
+    plan = card_plan(user, 10, date(2024, 1, 1))
+    window = (date(2024, 1, 1), date(2024, 3, 31))
+    assert occurrence_dates(user, plan, *window) == [date(2024, 1, 10), date(2024, 2, 10), date(2024, 3, 10)]
+
+    # Gravada com outro valor: sai das virtuais; excluída, volta a ser gerada
+    trans = RecurrenceService.materialize(plan, date(2024, 2, 10), amount=Decimal('25.00'))
+    db.session.commit()
+    assert trans.occurrence_date == date(2024, 2, 10) and trans.fixed_expense_id == plan.id
+    assert occurrence_dates(user, plan, *window) == [date(2024, 1, 10), date(2024, 3, 10)]
+
+    db.session.delete(trans)
+    db.session.commit()
+    assert occurrence_dates(user, plan, *window) == [date(2024, 1, 10), date(2024, 2, 10), date(2024, 3, 10)]
+
+    RecurrenceService.skip(plan, date(2024, 3, 10))
+    db.session.commit()
+    assert occurrence_dates(user, plan, *window) == [date(2024, 1, 10), date(2024, 2, 10)]
+    assert (plan.id, None, date(2024, 3, 10)) in RecurrenceService.get_exceptions(user.id, *window)
+
+
+def test_split_plan_moves_future_exceptions(user):
+    today = date.today()
+    plan = card_plan(user, 10, today.replace(day=1) - relativedelta(months=3))
+    past = next(RecurrenceService.occurrence_dates(plan, plan.start_date, today))
+    future = list(RecurrenceService.occurrence_dates(plan, today + timedelta(days=1), today + relativedelta(months=4)))
+
+    RecurrenceService.skip(plan, past)
+    RecurrenceService.skip(plan, future[0])
+    anticipated = RecurrenceService.materialize(plan, future[1], date=today, is_anticipated=True)
+    db.session.commit()
+
+    new_plan = RecurrenceService.split_plan(plan, today)
+    new_plan.amount = Decimal('15.00')
+    db.session.commit()
+
+    assert plan.end_date == today
+    assert new_plan.start_date == today + timedelta(days=1)
+    assert FixedSkip.query.filter_by(occurrence_date=past).one().fixed_expense_id == plan.id
+    assert FixedSkip.query.filter_by(occurrence_date=future[0]).one().fixed_expense_id == new_plan.id
+    assert db.session.get(Transaction, anticipated.id).fixed_expense_id == new_plan.id
+
+    # O plano novo continua sem gerar as ocorrências que já tinham exceção
+    window = (today + timedelta(days=1), future[-1])
+    occurrences = RecurrenceService.get_occurrences(user.id, [plan, new_plan], *window)
+    assert [o.date for o in occurrences] == future[2:]
+    assert {o.fixed_expense_id for o in occurrences} == {new_plan.id}
+    assert {o.amount for o in occurrences} == {Decimal('15.00')}
+
+
+def test_card_totals_with_and_without_snapshot(user):
+    today = date.today()
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    plan = card_plan(user, 1, today.replace(day=1) - relativedelta(months=6))
+    RecurrenceService.skip(plan, plan.start_date + relativedelta(months=1))
+    db.session.commit()
+
+    invoice_dates = {card.id: TransactionService.get_invoice_dates(card, today.month, today.year)}
+    due = [d for d in RecurrenceService.occurrence_dates(plan, plan.start_date, today) if d != plan.start_date + relativedelta(months=1)]
+
+    totals = RecurrenceService.get_card_totals(user.id, invoice_dates, {}, today)
+    assert totals[card.id][2] == Decimal('10.00') * len(due)
+    assert totals[card.id][0] + totals[card.id][1] <= totals[card.id][2]
+
+    # Com um snapshot, só entram as ocorrências depois do fechamento dele
+    snapshot = InvoiceSnapshot(card_id=card.id, close_date=today.replace(day=1) - relativedelta(months=2))
+    totals = RecurrenceService.get_card_totals(user.id, invoice_dates, {card.id: snapshot}, today)
+    assert totals[card.id][2] == Decimal('10.00') * len([d for d in due if d > snapshot.close_date])
+
+    # O cartão no dashboard dá o mesmo resultado somando tudo ou partindo dos snapshots
+    before = TransactionService.get_all_card_stats(user.id, today.month, today.year)
+    assert InvoiceSnapshotService.write_all(user.id) > 0
+    assert TransactionService.get_base_snapshots(invoice_dates, today)
+    after = TransactionService.get_all_card_stats(user.id, today.month, today.year)
+    assert [(s['invoice_amount'], s['available']) for s in after] == [(s['invoice_amount'], s['available']) for s in before]
+
+
+def test_forecast_matches_dashboard_for_current_month(app, user):
+    today = date.today()
+    account = BankAccount.query.filter_by(user_id=user.id).first()
+    card = CreditCard.query.filter_by(user_id=user.id).first()
+    expense_category = Category.query.filter_by(user_id=user.id, type='despesa').first()
+    revenue_category = Category.query.filter_by(user_id=user.id, type='receita').first()
+    start = today.replace(day=1) - relativedelta(months=4)
+
+    # Fixo de cartão que vence hoje (já somado na fatura do dashboard), fixos de conta e uma compra parcelada
+    card_plan(user, today.day, start, amount='39.90')
+    db.session.add_all([
+        FixedRevenue(user_id=user.id, description='Salário', amount=Decimal('3000.00'), day_of_month=5,
+                     category_id=revenue_category.id, account_id=account.id, start_date=start),
+        FixedExpense(user_id=user.id, description='Aluguel', amount=Decimal('900.00'), day_of_month=28,
+                     category_id=expense_category.id, account_id=account.id, start_date=start),
+        Transaction(user_id=user.id, description='Mercado', amount=Decimal('120.00'), date=start + timedelta(days=3),
+                    type='despesa', card_id=card.id, category_id=expense_category.id)
+    ])
+    InstallmentService.create_plan(user.id, 'tv', 'TV', Decimal('1000.00'), 7, start + timedelta(days=10), card.id, expense_category.id)
+    db.session.commit()
+
+    with app.test_request_context():
+        login_user(user)
+        from app.finance_controller import build_dashboard_context
+        context = build_dashboard_context(today.month, today.year, today)
+        user_data = UserData.get()
+        forecast = ForecastService.build(user.id, user_data.accounts, user_data.cards, today)
+
+    assert forecast['cards'][0]['invoices'][0] == round(float(context['cards_data'][0]['invoice_amount']), 2)
+    assert forecast['totals']['net'][0] == round(float(context['saldo_previsao']), 2)